@@ -6,11 +6,65 @@ data = dict(
     output_dir='./outputs',
     shuffle_load=True,
     batch_size=4,
+    prefetch=0,  # batches read and decoded ahead by background threads, 0 to load synchronously
+    io_threads=4,
+    native_depth=False,  # keep 16-bit depth as single channel 16-bit images instead of 8-bit RGB
+    cache_mb=0,  # memory budget of the decoded image cache kept across epochs, 0 to disable
+    schedule='epoch',  # choice of ('epoch', 'image'), image produces every epoch of a batch while it is loaded
+    # choice of ('files', 'shards', 'recipes'), shards packs records into large files with an index, recipes only
+    # records the sampled parameters of every variant, see recipes.RecipeRenderer
+    output_format='files',
+    # codec of every output file per source name, 'default' for the other sources, see encoders.CODECS
+    output_codecs=dict(default='png:1'),
+    dedup_outputs=False,  # hardlink unchanged outputs identical to an earlier one instead of encoding them again
+    shard_encoding='png',  # choice of ('png', 'raw') for the shards output format
+    shard_mb=1024,  # size after which a new shard file is started
+    writer_threads=0,  # threads encoding and saving outputs in the background, 0 to save synchronously
+    writer_backlog=16,  # image groups queued for saving before augmentation waits
+    index_path='',  # dataset index cache, <parent of the first source>/.dataset_index.json if empty
+    prepared_dir='',  # store of pre-decoded sources written by prepared.py, read instead of decoding if set
+)
+
+# Execution settings
+# choice of ('pil', 'numpy', 'tiled'), numpy runs vectorised kernels over (N, H, W, C) batches, tiled runs the same
+# kernels tile by tile on one image at a time with the intermediate images on disk, for very large images. Only the
+# intermediate images are bounded by the tile size, the decoded sources and the results are full frames in memory.
+# numpy and tiled are experimental: end to end they are about 2x slower than pil whatever the batch size, and their
+# outputs differ from pil. RandomResizedCrop samples bilinearly without antialiasing where PIL resizes bicubic, which
+# moves pixels by up to 125 levels, the point ops estimate some statistics from channel means
+backend = 'pil'
+tile_size = 512  # tile height and width of the tiled backend
+tile_dir = ''  # where the tiled backend keeps its intermediate images, on local disk, the system temp dir if empty
+buffer_pool = False  # numpy backend only, transforms write into two buffers per source reused across batches
+# pil backend only, memory budget of the memo of deterministic transform results (AutoContrast, Equalize, Invert,
+# Mirror, Flip) per input image, which serves inputs reused across epochs, with cache_mb or schedule='image'
+memo_mb = 0
+workers = 1  # more than 1 spreads the (image, epoch) work items over a pool of worker processes
+seed = None  # run seed, None draws one, recorded in the output directory and reused when resuming
+resume = False  # skip the (image, epoch) outputs recorded as done in the output directory by an earlier run
+num_shards = 1  # number of nodes the job is split over, the (image, epoch) items are partitioned by pixel count
+shard_index = 0  # the shard run by this node, in [0, num_shards)
+profile = ''  # path of a JSON profiling report of the stages and transforms, empty to disable
+metrics_path = ''  # path of a Prometheus text format metrics file updated during the run, empty to disable
+metrics_port = 0  # local HTTP port serving the metrics on /metrics, 0 to disable
+metrics_interval = 10  # seconds between metrics updates
+
+# Auto-tuning settings of --autotune, see autotune.AutoTuner
+autotune = dict(
+    sample_images=16,  # images of the dataset the trials run on
+    trial_epochs=4,  # epochs of the sample produced by every trial
+    memory_mb=0,  # peak memory limit of a trial, 0 for 80% of the memory available at the start
+    output='',  # path of the tuned config overlay, autotuned_<host>.py next to the config file if empty
 )
 
 # Augmentation settings
 photo_metric_distortion_for_all = [False]
 pipeline = 'default'  # choice of ('default', 'RL_searched')
+# fuse neighbouring geometric operations (Mirror, Flip, Rotate, Shear, Translate) into a single affine warp
+fuse_geometric = False
+# compile neighbouring point operations (Brightness, Contrast, AutoContrast, Invert, Equalize, Solarize, Posterize)
+# into a single lookup table per channel
+fuse_point_ops = False
 default_pipeline = [
     # sequence & magnitudes of the applied augmentations
     dict(type='Brightness', apply_prob=0.2, value_range=(0.1, 1.9), apply_all=photo_metric_distortion_for_all),
@@ -0,0 +1,7 @@
+# benchmark the transforms and the end-to-end augmentation, compare against a saved baseline if there is one
+python src/benchmark.py \
+    --config ./configs/synthetic_3d_config.py \
+    --sizes 240x320 480x640 960x1280 \
+    --num-images 16 --count 2 --seed 0 \
+    --output ./benchmark.json \
+    $([ -f ./benchmark_baseline.json ] && echo --baseline ./benchmark_baseline.json)
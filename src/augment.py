@@ -1,11 +1,25 @@
-from os.path import isfile, isdir, join, splitext
-from os import listdir, makedirs, mkdir
+from os.path import join
+from os import makedirs
 import argparse
+import time
+from contextlib import ExitStack
 from PIL import Image, ImageMath
 
-from config import load_config
-from dataloader import DataLoader
-from augmentor import Augmentor
+from config import load_config, load_overlay
+from dataloader import DataLoader, unstack_batch
+from augmentor import Augmentor, get_item_rng, get_modified
+from parallel import augment_parallel
+from writer import AsyncWriter, OutputDedup, get_output_dir, write_output
+from encoders import get_codecs
+from shards import ShardWriter
+from profiler import Profiler
+from metrics import MetricsReporter, metrics_enabled
+from manifest import RunManifest
+from partition import get_node_prefix, partition_items
+from recipes import write_recipes
+from index import DatasetIndex
+from prepared import open_store
+from autotune import autotune
 
 
 def parse_args():
@@ -13,15 +27,79 @@ def parse_args():
     parser.add_argument('--config', type=str,
                         default='./configs/synthetic_3d_config.py',
                         help='The config file path.')
+    parser.add_argument('--config-overlay', type=str, help='A config overlay merged into the config, e.g. the '
+                        'settings written by --autotune.')
     parser.add_argument('--source-dirs', nargs='+',
                         help='<Required> Specify which sources to do augmentation', required=True)
     parser.add_argument('--output-dir', type=str, help='The output directory path.')
     parser.add_argument('--count', type=int, help='Number of times to do augmentation.')
     parser.add_argument('--photo-distort-all', action='store_true', help='Whether to do photo metric distortion'
                         'for all sources. If not, only RGB will be applied with photo metric distortions.')
-    parser.add_argument('--shuffle-load', action='store_true', help='Whether to shuffle the data before loading batches.')
+    parser.add_argument('--shuffle-load', action='store_true', help='Whether to shuffle the data before loading '
+                        'batches.')
     parser.add_argument('--pipeline', type=str, choices=['default', 'RL_searched'], help='Which pipeline to apply.')
     parser.add_argument('--batch-size', type=int, help='Batch size.')
+    parser.add_argument('--backend', type=str, choices=['pil', 'numpy', 'tiled'], help='Which execution backend to '
+                        'use. tiled runs the numpy kernels tile by tile, for images too large for memory. numpy and '
+                        'tiled are experimental, slower than pil and their outputs differ from it.')
+    parser.add_argument('--tile-size', type=int, help='Tile height and width of the tiled backend.')
+    parser.add_argument('--tile-dir', type=str, help='Where the tiled backend keeps its intermediate images.')
+    parser.add_argument('--prefetch', type=int, help='Number of batches read and decoded ahead in the background.')
+    parser.add_argument('--io-threads', type=int, help='Number of background threads used for prefetching.')
+    parser.add_argument('--native-depth', action='store_true', help='Whether to keep 16-bit depth maps as single '
+                        'channel 16-bit images instead of converting them to 8-bit RGB.')
+    parser.add_argument('--cache-mb', type=int, help='Memory budget in MB of the decoded image cache kept across '
+                        'epochs. 0 disables the cache.')
+    parser.add_argument('--schedule', type=str, choices=['epoch', 'image'], help='epoch: augment the whole dataset '
+                        'once per epoch. image: produce every epoch of a batch while it is loaded.')
+    parser.add_argument('--output-format', type=str, choices=['files', 'shards', 'recipes'], help='files: one png '
+                        'per image per epoch. shards: records packed into large append-only shard files with an index. '
+                        'recipes: only the sampled parameters of every variant, rendered on demand by recipes.py.')
+    parser.add_argument('--output-codecs', nargs='+', help='Codec of the files output format, per source as '
+                        '<source>=<codec> or for every other source as <codec>, e.g. png:1 depth=png16. Codecs: '
+                        'png[:level], png16[:level], npy, float16[:scale], webp[:method] (lossless), tiff (LZW).')
+    parser.add_argument('--shard-encoding', type=str, choices=['png', 'raw'], help='How images are stored in shards.')
+    parser.add_argument('--dedup-outputs', action='store_true', help='Whether to hardlink the sources left unchanged '
+                        'by every transform to an identical earlier output instead of encoding them again. The rate '
+                        'of skipped outputs is printed at the end of the run.')
+    parser.add_argument('--writer-threads', type=int, help='Number of threads encoding and saving outputs in the '
+                        'background. 0 saves synchronously.')
+    parser.add_argument('--buffer-pool', action='store_true', help='With the numpy backend, run the transforms on '
+                        'two preallocated buffers per source, reused across batches, instead of new arrays per op.')
+    parser.add_argument('--memo-mb', type=int, help='With the pil backend, memory budget in MB of the memo of '
+                        'deterministic transform results per input image, reused for inputs decoded once for several '
+                        'epochs. 0 disables the memo.')
+    parser.add_argument('--workers', type=int, help='Number of worker processes. More than 1 spreads the '
+                        '(image, epoch) work items over a process pool.')
+    parser.add_argument('--rescan', action='store_true', help='Check every file of the sources instead of trusting '
+                        'the dataset index for the source directories that did not change.')
+    parser.add_argument('--prepared-dir', type=str, help='Store of pre-decoded sources written by prepared.py, '
+                        'read through memory maps instead of decoding the images it holds.')
+    parser.add_argument('--seed', type=int, help='Run seed. Every (image, epoch) is augmented with its own generator '
+                        'derived from it, so that runs are reproducible whatever the batching or worker count.')
+    parser.add_argument('--resume', action='store_true', help='Resume the run recorded in the output directory, '
+                        'only producing the outputs it has not recorded as done.')
+    parser.add_argument('--no-resume', action='store_true', help='Produce every output again, also when the config '
+                        'enables resuming.')
+    parser.add_argument('--num-shards', type=int, help='Number of nodes the job is split over. The (image, epoch) '
+                        'items are partitioned by pixel count, every node runs one shard with --shard-index.')
+    parser.add_argument('--shard-index', type=int, help='The shard run by this node, in [0, num_shards).')
+    parser.add_argument('--profile', type=str, help='Path of a JSON profiling report of the stages and transforms. '
+                        'A summary table is printed at the end of the run.')
+    parser.add_argument('--metrics-path', type=str, help='Path of a metrics file in the Prometheus text format, '
+                        'updated periodically with the items done, their rate, the ETA, bytes read and written and '
+                        'the utilisation of every stage.')
+    parser.add_argument('--metrics-port', type=int, help='Local HTTP port serving the same metrics on /metrics.')
+    parser.add_argument('--metrics-interval', type=float, help='Seconds between metrics updates.')
+    parser.add_argument('--autotune', action='store_true', help='Instead of augmenting, run short timed trials of '
+                        'the pipeline on a sample of the dataset to tune the worker count, batch size, prefetch depth, '
+                        'writer threads and PNG compress level of this machine, and save them as a config overlay.')
+    parser.add_argument('--autotune-memory-mb', type=int, help='Peak memory limit of the autotune trials, 80%% of '
+                        'the available memory by default.')
+    parser.add_argument('--fuse-geometric', action='store_true', help='Whether to fuse neighbouring geometric '
+                        'operations into a single affine warp per image.')
+    parser.add_argument('--fuse-point-ops', action='store_true', help='Whether to compile neighbouring point '
+                        'operations into a single lookup table per image.')
 
     args = parser.parse_args()
     return args
@@ -35,48 +113,270 @@ def concat(img1, img2, img3):
     return dst
 
 
-def save_results(src_names, img_names, data, epoch, output_dir):
+def save_results(src_names, img_names, data, epoch, output_dir, profiler=None, codecs=None, dedup=None,
+                 modified=None):
     makedirs(output_dir, exist_ok=True)
+    codecs = codecs or get_codecs({}, src_names)
     for i, image_group in enumerate(data):
         img_name = img_names[i]
         for j, src_name in enumerate(src_names):
-            save_image_dir = join(output_dir, '{}-{}'.format(src_name, splitext(img_name)[0]))
+            start = time.perf_counter()
+            save_image_dir = get_output_dir(output_dir, src_name, img_name)
             img = image_group[j]
-            if not isdir(save_image_dir):
-                mkdir(save_image_dir)
-            img.save(join(save_image_dir, '{:04d}.png'.format(epoch)), compress_level=1)
+            # exist_ok, workers may save other epochs of the same image concurrently
+            makedirs(save_image_dir, exist_ok=True)
+            referenced = write_output(join(save_image_dir, '{:04d}'.format(epoch)), img, codecs[j], profiler, dedup,
+                                      modified[i][j] if modified is not None else True)
+            if dedup is not None:
+                dedup.count(src_name, referenced)
+            if profiler is not None:
+                profiler.record_stage('save/' + src_name, time.perf_counter() - start)
     return
 
 
 def main():
     config = load_config(args.config, args.photo_distort_all)
+    if args.config_overlay:
+        load_overlay(config, args.config_overlay)
     if args.output_dir:
         config.data.output_dir = args.output_dir
     if args.count:
         config.aug_times = args.count
     if args.shuffle_load:
         config.data.shuffle = args.shuffle_load
+    if args.pipeline:
+        config.pipeline = args.pipeline
     if args.batch_size:
         config.data.batch_size = args.batch_size
+    if args.prefetch is not None:
+        config.data.prefetch = args.prefetch
+    if args.io_threads:
+        config.data.io_threads = args.io_threads
+    if args.native_depth:
+        config.data.native_depth = args.native_depth
+    if args.cache_mb is not None:
+        config.data.cache_mb = args.cache_mb
+    if args.schedule:
+        config.data.schedule = args.schedule
+    if args.output_format:
+        config.data.output_format = args.output_format
+    if args.output_codecs:
+        for entry in args.output_codecs:
+            src_name, _, spec = entry.rpartition('=')
+            config.data.output_codecs[src_name or 'default'] = spec
+    if args.shard_encoding:
+        config.data.shard_encoding = args.shard_encoding
+    if args.dedup_outputs:
+        config.data.dedup_outputs = args.dedup_outputs
+    if args.writer_threads is not None:
+        config.data.writer_threads = args.writer_threads
+    if args.backend:
+        config.backend = args.backend
+    if args.tile_size:
+        config.tile_size = args.tile_size
+    if args.tile_dir:
+        config.tile_dir = args.tile_dir
+    if args.buffer_pool:
+        config.buffer_pool = args.buffer_pool
+    if args.memo_mb is not None:
+        config.memo_mb = args.memo_mb
+    if args.workers:
+        config.workers = args.workers
+    if args.prepared_dir:
+        config.data.prepared_dir = args.prepared_dir
+    if args.seed is not None:
+        config.seed = args.seed
+    if args.resume:
+        config.resume = True
+    if args.no_resume:
+        config.resume = False
+    if args.num_shards:
+        config.num_shards = args.num_shards
+    if args.shard_index is not None:
+        config.shard_index = args.shard_index
+    if args.profile:
+        config.profile = args.profile
+    if args.metrics_path:
+        config.metrics_path = args.metrics_path
+    if args.metrics_port:
+        config.metrics_port = args.metrics_port
+    if args.metrics_interval:
+        config.metrics_interval = args.metrics_interval
+    if args.autotune_memory_mb:
+        config.autotune.memory_mb = args.autotune_memory_mb
+    if args.fuse_geometric:
+        config.fuse_geometric = args.fuse_geometric
+    if args.fuse_point_ops:
+        config.fuse_point_ops = args.fuse_point_ops
+
+    if config.backend != 'pil':
+        print(f"The {config.backend} backend is experimental: it is slower than pil and its outputs differ from it, "
+              f"RandomResizedCrop resamples bilinearly where pil is bicubic")
 
     source_dirs = args.source_dirs
     src_names = [src_dir.split('/')[-1] for src_dir in source_dirs]
     raw_input_idx = src_names.index('rgb') if 'rgb' in src_names else -1
-    image_names = [img_name for img_name in listdir(source_dirs[0])
-                   if isfile(join(source_dirs[0], img_name))]
+    index = DatasetIndex(source_dirs, config.data.index_path, threads=config.data.io_threads, rescan=args.rescan)
+    if index.excluded:
+        examples = ', '.join(f'{img_name} ({reason})' for img_name, reason in list(index.excluded.items())[:5])
+        print(f"Skipping {len(index.excluded)} images not usable in every source: {examples}")
+    image_names = index.img_names
+    image_sizes = index.get_sizes()
+    if args.autotune:
+        path = autotune(config, args.config, source_dirs, image_names)
+        print(f"Tuned settings saved to {path}, use them with --config-overlay {path}")
+        return
+    codecs = get_codecs(config.data.output_codecs, src_names)
+    store = open_store(config.data.prepared_dir, source_dirs, index, config.data.native_depth)
+    if store is not None:
+        print(f"Reading {sum(img_name in store for img_name in image_names)}/{len(image_names)} images from "
+              f"the prepared store")
+
+    # metrics are derived from the stages the profiler records
+    profiler = Profiler(src_names) if config.profile or metrics_enabled(config) else None
+    if config.num_shards > 1 and config.seed is None:
+        raise ValueError("A run seed is required with more than one shard, every node must use the same one")
+    manifest = RunManifest(config.data.output_dir, config.seed, config.resume, config.num_shards, config.shard_index)
+    if len(manifest):
+        print(f"Resuming run with seed {manifest.seed}: skipping {len(manifest)} items recorded as done in "
+              f"{config.data.output_dir}, run without --resume to produce them again")
+    if config.num_shards > 1:
+        pixel_counts = [image_sizes[img_name][0] * image_sizes[img_name][1] for img_name in image_names]
+        items, pixels = partition_items(image_names, pixel_counts, config.aug_times, config.num_shards,
+                                        config.shard_index)
+        manifest.assign(items)
+        print(f"Shard {config.shard_index}/{config.num_shards}: {len(items)} items, "
+              f"{pixels / max(sum(pixel_counts) * config.aug_times, 1):.1%} of the pixels")
+    if config.data.output_format == 'recipes':
+        try:
+            save_recipes(config, src_names, image_names, image_sizes, manifest)
+        finally:
+            manifest.close()
+        return
+    dedup = OutputDedup() if config.data.dedup_outputs else None
+    reporter = None
+    if metrics_enabled(config):
+        total_items = sum(len(manifest.pending_epochs(img_name, config.aug_times)) for img_name in image_names)
+        reporter = MetricsReporter(profiler, manifest, total_items, config.metrics_path, config.metrics_port,
+                                   config.metrics_interval)
+    if config.workers and config.workers > 1:
+        try:
+            if reporter is not None:
+                reporter.start()
+            augment_parallel(config, source_dirs, image_names, raw_input_idx, config.workers, manifest, profiler,
+                             store, dedup)
+        finally:
+            try:
+                if reporter is not None:
+                    reporter.close()
+            finally:
+                manifest.close()
+        if dedup is not None:
+            print(dedup.summary())
+        report_profile(config, profiler)
+        return
+    # only images with pending epochs are loaded at all
+    image_names = [img_name for img_name in image_names if manifest.pending_epochs(img_name, config.aug_times)]
 
     # initialize dataloader and augmentor
-    dataloader = DataLoader(source_dirs, image_names, batch_size=config.data.batch_size)
-    augmentor = Augmentor(config)
-    for epoch in range(config.aug_times):
-        if config.data.shuffle_load:
-            dataloader.shuffle()
-        print(f"Epoch: {epoch}")
-        for i, batch_tuple in enumerate(dataloader):
-            print(f"Augmenting batch {i}")
-            img_names, batch = batch_tuple
-            augmented = augmentor.augment(batch, raw_input_idx)
-            save_results(src_names, img_names, augmented, epoch, config.data.output_dir)
+    dataloader = DataLoader(source_dirs, image_names, batch_size=config.data.batch_size, backend=config.backend,
+                            prefetch=config.data.prefetch, io_threads=config.data.io_threads,
+                            cache_bytes=config.data.cache_mb * 2 ** 20, native_depth=config.data.native_depth,
+                            profiler=profiler, image_sizes=image_sizes, store=store)
+    augmentor = Augmentor(config, profiler)
+    writer = None
+    if config.data.output_format == 'shards':
+        writer = ShardWriter(src_names, config.data.output_dir, threads=max(config.data.writer_threads, 1),
+                             max_backlog=config.data.writer_backlog, encoding=config.data.shard_encoding,
+                             shard_bytes=config.data.shard_mb * 2 ** 20,
+                             prefix='shard-' + get_node_prefix(config.num_shards, config.shard_index),
+                             profiler=profiler, manifest=manifest, dedup=dedup)
+    elif config.data.writer_threads:
+        writer = AsyncWriter(src_names, config.data.output_dir, threads=config.data.writer_threads,
+                             max_backlog=config.data.writer_backlog, profiler=profiler, manifest=manifest,
+                             codecs=codecs, dedup=dedup)
+    if reporter is not None:
+        reporter.add_gauge('prefetched_batches', 'Batches read or being read ahead.', lambda: len(dataloader.pending))
+        if writer is not None:
+            reporter.add_gauge('writer_backlog', 'Image groups queued or being saved.', lambda: writer.queued)
+        reporter.start()
+
+    def augment_and_save(img_names, batch, epoch):
+        # the instances of the batch still to do for this epoch
+        idx = [n for n, img_name in enumerate(img_names) if manifest.is_pending(img_name, epoch)]
+        if not idx:
+            return
+        if len(idx) < len(img_names):
+            img_names = [img_names[n] for n in idx]
+            batch = [images[idx] for images in batch] if config.backend == 'numpy' else [batch[n] for n in idx]
+        rngs = [get_item_rng(manifest.seed, img_name, epoch) for img_name in img_names]
+        start = time.perf_counter()
+        augmented = augmentor.augment(batch, raw_input_idx, rngs)
+        modified = get_modified(batch, augmented) if dedup is not None else None
+        if config.backend == 'numpy':
+            augmented = unstack_batch(augmented)
+        if profiler is not None:
+            profiler.record_stage('augment', time.perf_counter() - start)
+        if writer is not None:
+            writer.submit(img_names, augmented, epoch, modified)
+        else:
+            save_results(src_names, img_names, augmented, epoch, config.data.output_dir, profiler, codecs, dedup,
+                         modified)
+            for img_name in img_names:
+                manifest.mark_done(img_name, epoch)
+
+    with ExitStack() as stack:
+        # closed in reverse order, each one even if closing a later one raised, e.g. the writer on a failed save
+        stack.callback(manifest.close)
+        if reporter is not None:
+            stack.callback(reporter.close)
+        if writer is not None:
+            stack.callback(writer.close)
+        stack.callback(dataloader.close)
+        if config.data.schedule == 'image':
+            # every epoch of a batch is produced while it is loaded, sources are decoded once
+            if config.data.shuffle_load:
+                dataloader.shuffle()
+            for i, (img_names, batch) in enumerate(dataloader):
+                print(f"Augmenting batch {i}")
+                for epoch in range(config.aug_times):
+                    augment_and_save(img_names, batch, epoch)
+        else:
+            for epoch in range(config.aug_times):
+                # a resumed epoch only loads what is left of it
+                dataloader.img_names = [img_name for img_name in image_names if manifest.is_pending(img_name, epoch)]
+                if config.data.shuffle_load:
+                    dataloader.shuffle()
+                print(f"Epoch: {epoch}")
+                for i, (img_names, batch) in enumerate(dataloader):
+                    print(f"Augmenting batch {i}")
+                    augment_and_save(img_names, batch, epoch)
+    if dataloader.cache is not None:
+        print(f"Decode cache: {dataloader.cache}")
+    if augmentor.memo is not None:
+        print(f"Transform memo: {augmentor.memo}")
+    if dedup is not None:
+        print(dedup.summary())
+    report_profile(config, profiler)
+
+
+def save_recipes(config, src_names, image_names, image_sizes, manifest):
+    items = [(img_name, epoch) for img_name in sorted(image_names)
+             for epoch in manifest.pending_epochs(img_name, config.aug_times)]
+    file_name = 'recipes.npz' if config.num_shards == 1 else \
+        f'recipes-{config.shard_index:05d}-of-{config.num_shards:05d}.npz'
+    path = join(config.data.output_dir, file_name)
+    write_recipes(path, config, src_names, manifest.seed, items, image_sizes,
+                  lambda img_name, epoch: get_item_rng(manifest.seed, img_name, epoch))
+    print(f"Recorded the recipes of {len(items)} variants to {path}")
+
+
+def report_profile(config, profiler):
+    if not config.profile:
+        return
+    profiler.save(config.profile)
+    print(profiler.summary())
+    print(f"Profiling report saved to {config.profile}")
 
 
 if __name__ == '__main__':
@@ -1,5 +1,14 @@
 import random
-from transform import build_transform
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+
+from dataloader import image_nbytes
+from tiled import TiledExecutor
+from transform import build_transform, fuse_transforms, get_rngs, GeometricTransform, AffineGroup, PointTransform, \
+    PointOpGroup
 
 
 class Augmentor:
@@ -9,12 +18,39 @@ class Augmentor:
     Augmentor.transform_pipeline is a list of transform.Transform.
     When config.pipeline == 'RL_searched', use the auto-aug searched pipeline for selected operations.
     And the Augmentor.transform_pipeline is a list of sub-policies, which are lists of transform.Transform.
+    When config.fuse_geometric is set, neighbouring geometric operations are fused into one transform.AffineGroup
+    so that every image is warped once per run instead of once per operation.
+    When config.fuse_point_ops is set, neighbouring point operations are compiled into one transform.PointOpGroup
+    so that every image goes through a single lookup table per run.
+    When config.memo_mb is set, the pil backend serves the results of the deterministic transforms of the pipeline
+    from a TransformMemo, fused ones excepted.
+    When a profiler.Profiler is given, every transform of the pipeline is wrapped to record its timings.
+    When config.backend == 'numpy', augment() takes and returns one (N, H, W, C) uint8 array per source and every
+    transform runs its vectorised Transform.apply_batch kernel over the whole batch. With config.buffer_pool set,
+    the kernels write into the two buffers per source of a BufferPool kept across batches, see BufferPool.
+    When config.backend == 'tiled', augment() takes and returns Images like the pil backend, but every instance is
+    augmented tile by tile with the numpy kernels, out of core, see tiled.TiledExecutor.
+    Given one random.Random per instance, see get_item_rng, the augmentation of an instance only depends on its own
+    generator, not on the batch it is in nor on the order instances are processed in.
 
     Args:
         config (addict.Dict): config specs.
+        profiler (profiler.Profiler): Optional profiler.
     """
-    def __init__(self, config):
+    def __init__(self, config, profiler=None):
         self.config = config
+        self.profiler = profiler
+        self.pool = None
+        if config.buffer_pool:
+            if config.backend != 'numpy':
+                raise ValueError(f"The buffer pool needs the numpy backend, got backend {config.backend}")
+            self.pool = BufferPool()
+        self.tiled = TiledExecutor(config.tile_size, config.tile_dir) if config.backend == 'tiled' else None
+        self.memo = None
+        if config.memo_mb:
+            if config.backend != 'pil':
+                raise ValueError(f"The transform memo needs the pil backend, got backend {config.backend}")
+            self.memo = TransformMemo(config.memo_mb * 2 ** 20)
         self.transform_pipeline = self.build_pipeline()
 
     def build_pipeline(self):
@@ -22,33 +58,254 @@ class Augmentor:
         if self.config.pipeline == 'default':
             for transform_config in self.config.default_pipeline:
                 transform_pipeline.append(build_transform(transform_config))
+            transform_pipeline = self.prepare(transform_pipeline)
         elif self.config.pipeline == 'RL_searched':
             for sub_policy in self.config.RL_searched_pipeline:
                 sub_pipeline = []
                 for transform_config in sub_policy:
                     sub_pipeline.append(build_transform(transform_config))
-                transform_pipeline.append(sub_pipeline)
+                transform_pipeline.append(self.prepare(sub_pipeline))
         else:
             raise ValueError(f"Expect pipeline types: (default, RL_searched), got {self.config.pipeline}")
         return transform_pipeline
 
-    def augment(self, data, raw_input_idx):
+    def prepare(self, transform_pipeline):
+        if self.memo is not None:
+            for trans_op in transform_pipeline:
+                if trans_op.deterministic:
+                    trans_op.memo = self.memo
+        if self.config.fuse_geometric:
+            transform_pipeline = fuse_transforms(transform_pipeline, GeometricTransform, AffineGroup)
+        if self.config.fuse_point_ops:
+            transform_pipeline = fuse_transforms(transform_pipeline, PointTransform, PointOpGroup)
+        if self.profiler is not None:
+            transform_pipeline = self.profiler.wrap(transform_pipeline)
+        return transform_pipeline
+
+    def augment(self, data, raw_input_idx, rngs=None):
         """
         Take a batch of data and do augmentation sequentially according to the pipeline.
         Args:
             data (list): List of list. The inner list contains the different sources, Images, for one instance.
                   The sequence of the inner list follows the given source_dirs.
             raw_input_idx (int): The index of the rgb input. -1 means rgb not existed.
+            rngs (list): Optional list of random.Random, one per instance. The global random module if not given.
         """
+        if self.config.backend == 'numpy':
+            return self.augment_batch(data, raw_input_idx, rngs)
+        if self.tiled is not None:
+            return self.augment_tiled(data, raw_input_idx, rngs)
         augmented = []
         cur_batch_size = len(data)
+        rngs = get_rngs(rngs, cur_batch_size)
         for i in range(cur_batch_size):
             image_group = data[i]
             batch_pipeline = self.transform_pipeline if self.config.pipeline == 'default'\
-                else random.choice(self.transform_pipeline)
+                else rngs[i].choice(self.transform_pipeline)
             for trans_op in batch_pipeline:
-                image_group = trans_op(image_group, raw_input_idx)
+                image_group = trans_op(image_group, raw_input_idx, rngs[i])
             augmented.append(image_group)
         return augmented
 
+    def augment_batch(self, batch, raw_input_idx, rngs=None):
+        """
+        Numpy backend of augment. Each instance of an RL_searched batch draws its own sub-policy, instances sharing
+        a sub-policy are augmented together.
+        Args:
+            batch (list): List of np.ndarray, one (N, H, W, C) uint8 array per source.
+            raw_input_idx (int): The index of the rgb input. -1 means rgb not existed.
+            rngs (list): Optional list of random.Random, one per instance.
+        """
+        rngs = get_rngs(rngs, len(batch[0]))
+        if self.config.pipeline == 'default':
+            return self.run_batch(self.transform_pipeline, batch, raw_input_idx, rngs)
+
+        choices = np.array([rng.randrange(len(self.transform_pipeline)) for rng in rngs])
+        augmented = [np.empty_like(images) for images in batch]
+        for k, sub_pipeline in enumerate(self.transform_pipeline):
+            idx = np.flatnonzero(choices == k)
+            if len(idx) == 0:
+                continue
+            sub_batch = [images[idx] for images in batch]
+            sub_rngs = [rngs[n] for n in idx]
+            sub_batch = self.run_batch(sub_pipeline, sub_batch, raw_input_idx, sub_rngs, detach=False)
+            for images, sub_images in zip(augmented, sub_batch):
+                images[idx] = sub_images
+        return augmented
 
+    def augment_tiled(self, data, raw_input_idx, rngs=None):
+        """
+        Tiled backend of augment, one instance at a time, same arguments.
+        """
+        augmented = []
+        for image_group, rng in zip(data, get_rngs(rngs, len(data))):
+            transform_pipeline = self.transform_pipeline if self.config.pipeline == 'default' \
+                else rng.choice(self.transform_pipeline)
+            arrays = [np.asarray(img) for img in image_group]
+            arrays = self.tiled.run(transform_pipeline, [array if array.ndim == 3 else array[..., None]
+                                                         for array in arrays], raw_input_idx, rng)
+            augmented.append([Image.fromarray(array if array.shape[2] > 1 else array[..., 0]) for array in arrays])
+        return augmented
+
+    def run_batch(self, transform_pipeline, batch, raw_input_idx, rngs, detach=True):
+        if self.pool is not None:
+            return self.pool.run(transform_pipeline, batch, raw_input_idx, rngs, detach)
+        for trans_op in transform_pipeline:
+            batch = trans_op.apply_batch(batch, raw_input_idx, rngs)
+        return batch
+
+
+class BufferPool:
+    """
+    Numpy backend execution on preallocated buffers. Every source gets two buffers, reused from batch to batch:
+    each transform reads the current one and writes into the other, and sources a transform leaves untouched, e.g.
+    on a failed apply_prob roll, stay where they are. The input batch is never written to. Memory is bounded by
+    2 x N x H x W x C per source for the largest batch seen, buffers are only reallocated when the image size
+    changes or a larger batch comes in, instead of one new array per transform and source.
+    """
+    def __init__(self):
+        self.buffers = {}
+
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for pair in self.buffers.values() for buffer in pair)
+
+    def get_buffers(self, j, images):
+        """The two buffers of source j, as views of the size of images."""
+        pair = self.buffers.get(j)
+        if pair is None or pair[0].shape[1:] != images.shape[1:] or pair[0].dtype != images.dtype or \
+                len(pair[0]) < len(images):
+            pair = tuple(np.empty(images.shape, dtype=images.dtype) for _ in range(2))
+            self.buffers[j] = pair
+        return pair[0][:len(images)], pair[1][:len(images)]
+
+    def run(self, transform_pipeline, batch, raw_input_idx, rngs, detach=True):
+        """
+        Args:
+            transform_pipeline (list): List of Transform.
+            batch (list): List of np.ndarray, one (N, H, W, C) array per source.
+            raw_input_idx (int): The index of the rgb input. -1 means rgb not existed.
+            rngs (list): List of random.Random, one per instance.
+            detach (bool): Whether to copy the results out of the pool, which the next batch overwrites.
+        Returns:
+            list: List of np.ndarray, one (N, H, W, C) array per source.
+        """
+        buffers = [self.get_buffers(j, images) for j, images in enumerate(batch)]
+        # which buffer of each source holds its current array, None for an array outside the pool
+        current = [None] * len(batch)
+        for trans_op in transform_pipeline:
+            out = [pair[1] if k == 0 else pair[0] for pair, k in zip(buffers, current)]
+            augmented = trans_op.apply_batch(batch, raw_input_idx, rngs, out)
+            for j, images in enumerate(augmented):
+                if images is out[j]:
+                    current[j] = 1 if current[j] == 0 else 0
+                elif images is not batch[j]:
+                    current[j] = None
+            batch = augmented
+        if detach:
+            batch = [images.copy() if k is not None else images for images, k in zip(batch, current)]
+        return batch
+
+
+# rough bookkeeping size of a memo entry, charged on top of the images it holds
+ENTRY_BYTES = 256
+
+
+class TransformMemo:
+    """
+    A least recently used cache of the results of the deterministic transforms (AutoContrast, Equalize, Invert,
+    Mirror, Flip), with a byte budget. Results are keyed on the identity of the input Image and the transform type,
+    inputs being only weakly referenced, so that an input reused across epochs, e.g. served by the decode cache or
+    kept by the image schedule, goes through every chain of deterministic transforms once only, the two Equalize of
+    a sub-policy included. The result of an involution (Invert, Mirror, Flip) is also recorded with a weak reference
+    to its input as result, so that applying it again gives the input back for free while it is alive, without
+    keeping it alive, e.g. a view of the shared memory block of a worker.
+    Results are shared by the epochs they serve, like the Images of the decode cache, never modified in place.
+    Args:
+        max_bytes (int): Byte budget.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # (id of the input, transform type) to (weak reference to the input, result or weak reference to it,
+        # charged bytes)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def apply(self, trans_op, img, value):
+        """
+        Args:
+            trans_op (transform.Transform): A deterministic transform.
+            img (Image): Its input.
+            value: Its parameter, None for deterministic transforms.
+        Returns:
+            Image: trans_op.apply_image(img, value).
+        """
+        key = (id(img), trans_op.config.type)
+        with self.lock:
+            entry = self.entries.get(key)
+            # an id is only reused once its object is gone, which the dead reference tells
+            if entry is not None and entry[0]() is img:
+                result = entry[1]() if isinstance(entry[1], weakref.ref) else entry[1]
+                if result is not None:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return result
+            self.misses += 1
+        result = trans_op.apply_image(img, value)
+        if result is img:
+            return result
+        with self.lock:
+            self.put(key, img, result, image_nbytes(result) + ENTRY_BYTES)
+            if trans_op.involution:
+                self.put((id(result), trans_op.config.type), result, weakref.ref(img), ENTRY_BYTES)
+        return result
+
+    def put(self, key, img, result, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[2]
+        self.entries[key] = (weakref.ref(img), result, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, _, evicted_nbytes) = self.entries.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+
+    def __str__(self):
+        return f"{self.hits} hits, {self.misses} misses, {len(self.entries)} results, {self.nbytes / 2 ** 20:.1f} MB"
+
+
+def get_modified(data, augmented):
+    """
+    Which sources of every instance the pipeline modified. Like for profiler.ProfiledTransform, a source is unchanged
+    when the very input is handed back, so that the pil backend tells every instance apart, while a numpy batch only
+    counts as unchanged for the sources no instance had modified. The tiled backend always returns new images.
+    Args:
+        data (list): The input of Augmentor.augment, list of list of Image or one np.ndarray per source.
+        augmented (list): What Augmentor.augment returned for it.
+    Returns:
+        list: List of list, whether each source of each instance was modified.
+    """
+    if isinstance(data[0], np.ndarray):
+        modified = [augmented_images is not images for images, augmented_images in zip(data, augmented)]
+        return [list(modified) for _ in range(len(data[0]))]
+    return [[augmented_img is not img for img, augmented_img in zip(image_group, augmented_group)]
+            for image_group, augmented_group in zip(data, augmented)]
+
+
+def get_item_rng(seed, img_name, epoch):
+    """
+    The random generator of one (image, epoch) work item, derived from the run seed only, so that the item is
+    augmented the same way whatever the process, batch or order it runs in.
+    Args:
+        seed (int): Run seed.
+        img_name (str): Image name.
+        epoch (int): Augmentation epoch.
+    Returns:
+        random.Random: The generator.
+    """
+    # str seeds are hashed with sha512, stable across processes unlike hash()
+    return random.Random(f'{seed}/{img_name}/{epoch}')
@@ -0,0 +1,250 @@
+import copy
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+from os import makedirs
+from os.path import abspath, dirname, join
+
+from addict import Dict
+
+from config import write_config
+
+# a candidate this close to the fastest of its parameter counts as fast, the one writing and using the least wins
+TOLERANCE = 0.05
+
+
+def get_available_bytes():
+    """MemAvailable of /proc/meminfo, the physical memory size elsewhere."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def get_tree_rss(pid):
+    """Resident bytes of a process and all of its descendants, from /proc, shared pages counted once per process."""
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                total += int(f.read().split()[1]) * page_size
+            for task in os.listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{task}/children') as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            # exited meanwhile
+            continue
+    return total
+
+
+def read_metrics(path):
+    """The unlabelled values of a metrics file written by metrics.MetricsReporter."""
+    values = {}
+    with open(path) as f:
+        for line in f:
+            if line.startswith('augtool_') and '{' not in line:
+                name, value = line.split()
+                values[name[len('augtool_'):]] = float(value)
+    return values
+
+
+def get_settings(config):
+    """The tuned settings of a config, png_level only when the default output codec is PNG."""
+    settings = dict(workers=config.workers or 1, batch_size=config.data.batch_size, prefetch=config.data.prefetch,
+                    writer_threads=config.data.writer_threads)
+    name, _, level = config.data.output_codecs.get('default', 'png:1').partition(':')
+    if config.data.output_format == 'files' and name == 'png':
+        settings['png_level'] = int(level or 1)
+    return settings
+
+
+def apply_settings(config, settings):
+    config.workers = settings['workers']
+    for key in ('batch_size', 'prefetch', 'writer_threads'):
+        config.data[key] = settings[key]
+    if 'png_level' in settings:
+        config.data.output_codecs['default'] = f"png:{settings['png_level']}"
+
+
+def get_candidates(settings, cpu_count):
+    """
+    Returns:
+        list: List of (name, values), the tuned settings in search order.
+    """
+    candidates = [('workers', sorted({1, cpu_count} | {2 ** k for k in range(1, 6) if 2 ** k < cpu_count})),
+                  ('batch_size', [1, 2, 4, 8, 16]),
+                  ('prefetch', [0, 1, 2, 4]),
+                  ('writer_threads', [0, 1, 2, 4, 8])]
+    if 'png_level' in settings:
+        candidates.append(('png_level', [0, 1, 3, 6]))
+    return candidates
+
+
+class AutoTuner:
+    """
+    Search the throughput settings of this machine with short timed trials of the real pipeline on a sample of the
+    real dataset: worker processes, then with a single process the batch size, prefetch depth and writer threads,
+    which the worker pool does not use, and the PNG compress level of the default output codec.
+    Every trial is a run of augment.py in its own process, on trial_epochs epochs of sample_images images linked
+    into <output_dir>/.autotune, so that outputs go to the real output disk, with the config of the run and the
+    settings of the trial. Its rate is read from the metrics it writes, its peak memory is the resident size of its
+    process tree polled from /proc, and a trial going over the memory limit is killed and discarded.
+    The parameters are tuned one at a time in that order, each one starting from the best settings so far. Of the
+    values within TOLERANCE of the fastest, the one writing the fewest bytes, then using the least memory, wins.
+    Args:
+        config (addict.Dict): The config of the run, CLI overrides included.
+        source_dirs (list): List of source directories.
+        image_names (list): The image names of the dataset.
+        sample_images (int): Number of images the trials run on.
+        trial_epochs (int): Number of epochs of the sample produced by every trial.
+        memory_bytes (int): Peak memory limit of a trial, 0 for 80% of the memory available now.
+    """
+    def __init__(self, config, source_dirs, image_names, sample_images=16, trial_epochs=4, memory_bytes=0):
+        self.config = copy.deepcopy(config)
+        self.source_dirs = source_dirs
+        self.trial_epochs = trial_epochs
+        self.memory_bytes = memory_bytes or int(0.8 * get_available_bytes())
+        self.work_dir = join(config.data.output_dir, '.autotune')
+        self.sample = sorted(random.Random(0).sample(list(image_names), min(sample_images, len(image_names))))
+        self.trials = []
+
+    def link_sample(self):
+        """Link the sampled images of every source into the work directory, returns the sample source dirs."""
+        sample_dirs = []
+        for src_dir in self.source_dirs:
+            sample_dir = join(self.work_dir, 'sample', src_dir.rstrip('/').split('/')[-1])
+            makedirs(sample_dir, exist_ok=True)
+            for img_name in self.sample:
+                os.symlink(abspath(join(src_dir, img_name)), join(sample_dir, img_name))
+            sample_dirs.append(sample_dir)
+        return sample_dirs
+
+    def run_trial(self, config, sample_dirs, settings):
+        """
+        Returns:
+            dict: The trial settings, its status, rate in items per second, bytes written and peak memory.
+        """
+        trial_dir = join(self.work_dir, f'trial-{len(self.trials):03d}')
+        makedirs(trial_dir)
+        # the trial itself is not profiled nor served, only its final metrics are read
+        config = copy.deepcopy(config)
+        config.update(profile='', metrics_path=join(trial_dir, 'metrics.prom'), metrics_port=0,
+                      metrics_interval=3600, seed=0, resume=True, num_shards=1, shard_index=0)
+        config.data.update(output_dir=join(trial_dir, 'outputs'), index_path=join(trial_dir, 'index.json'),
+                           prepared_dir='')
+        config_path = join(trial_dir, 'trial_config.py')
+        write_config(config, config_path)
+        command = [sys.executable, join(dirname(abspath(__file__)), 'augment.py'), '--config', config_path,
+                   '--source-dirs', *sample_dirs, '--count', str(self.trial_epochs)]
+        if config.photo_metric_distortion_for_all[0]:
+            command.append('--photo-distort-all')
+        trial = dict(settings, status='ok', rate=0.0, written=0, peak=0)
+        with open(join(trial_dir, 'log.txt'), 'w') as log:
+            process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+            while process.poll() is None:
+                trial['peak'] = max(trial['peak'], get_tree_rss(process.pid))
+                if trial['peak'] > self.memory_bytes:
+                    # the whole session, worker processes included
+                    os.killpg(process.pid, signal.SIGKILL)
+                    process.wait()
+                    trial['status'] = 'over memory'
+                    return trial
+                time.sleep(0.05)
+        if process.returncode != 0:
+            trial['status'] = f'failed, see {join(trial_dir, "log.txt")}'
+            return trial
+        metrics = read_metrics(config.metrics_path)
+        trial.update(rate=metrics['items_done_total'] / max(metrics['elapsed_seconds'], 1e-9),
+                     written=int(metrics['written_bytes_total']))
+        # only the log of a failed trial is worth keeping
+        shutil.rmtree(trial_dir)
+        return trial
+
+    def run(self):
+        """
+        Returns:
+            tuple: (overlay, best), the tuned settings as a config overlay and the best trial.
+        """
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        makedirs(self.work_dir)
+        sample_dirs = self.link_sample()
+        settings = get_settings(self.config)
+        best = None
+        for name, values in get_candidates(settings, os.cpu_count() or 1):
+            if name in ('batch_size', 'prefetch', 'writer_threads') and settings['workers'] > 1:
+                continue
+            results = []
+            for value in values:
+                trial_settings = dict(settings, **{name: value})
+                trial_config = copy.deepcopy(self.config)
+                apply_settings(trial_config, trial_settings)
+                trial = self.run_trial(trial_config, sample_dirs, trial_settings)
+                self.trials.append(trial)
+                print(format_trial(trial))
+                if trial['status'] == 'ok':
+                    results.append(trial)
+            if not results:
+                continue
+            fastest = max(trial['rate'] for trial in results)
+            best = min((trial for trial in results if trial['rate'] >= (1 - TOLERANCE) * fastest),
+                       key=lambda trial: (trial['written'], trial['peak']))
+            settings[name] = best[name]
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        if best is None:
+            raise RuntimeError(f"Every autotune trial failed or went over the memory limit of "
+                               f"{self.memory_bytes / 2 ** 20:.0f} MB")
+        overlay = Dict()
+        apply_settings(overlay, settings)
+        return overlay, best
+
+
+def format_trial(trial):
+    settings = ' '.join(f'{name}={trial[name]}' for name in trial if name not in ('status', 'rate', 'written', 'peak'))
+    if trial['status'] != 'ok':
+        return f"Trial {settings}: {trial['status']}"
+    return f"Trial {settings}: {trial['rate']:.2f} items/s, {trial['written'] / 2 ** 20:.1f} MB written, " \
+           f"peak {trial['peak'] / 2 ** 20:.0f} MB"
+
+
+def get_overlay_path(config, config_path):
+    """The overlay path of the config, autotuned_<host>.py next to the config file by default."""
+    if config.autotune.output:
+        return config.autotune.output
+    return join(dirname(abspath(config_path)), 'autotuned_' + re.sub(r'\W', '_', socket.gethostname()) + '.py')
+
+
+def autotune(config, config_path, source_dirs, image_names):
+    """
+    Tune the throughput settings of this machine, see AutoTuner, and save them as a config overlay for later runs
+    with --config-overlay.
+    Args:
+        config (addict.Dict): The config of the run, CLI overrides included.
+        config_path (str): Path of the config file.
+        source_dirs (list): List of source directories.
+        image_names (list): The image names of the dataset.
+    Returns:
+        str: The overlay path.
+    """
+    tuner = AutoTuner(config, source_dirs, image_names, config.autotune.sample_images, config.autotune.trial_epochs,
+                      config.autotune.memory_mb * 2 ** 20)
+    print(f"Autotuning on {len(tuner.sample)} images x {tuner.trial_epochs} epochs, memory limit "
+          f"{tuner.memory_bytes / 2 ** 20:.0f} MB")
+    overlay, best = tuner.run()
+    path = get_overlay_path(config, config_path)
+    write_config(overlay, path, f"Tuned by augment.py --autotune on {socket.gethostname()}, "
+                                f"{time.strftime('%Y-%m-%d %H:%M')}\n"
+                                f"{len(tuner.trials)} trials, best {format_trial(best)[len('Trial '):]}")
+    return path
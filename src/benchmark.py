@@ -0,0 +1,256 @@
+from os.path import exists, getsize, join
+from os import makedirs, walk
+import argparse
+import json
+import os
+import platform
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+
+from config import load_config
+from dataloader import DataLoader, stack_batch
+from transform import build_transform
+
+# metrics where a larger value is an improvement, every other metric is better when smaller
+HIGHER_IS_BETTER = ('images_per_s',)
+# metrics that depend on the sampled parameters, only compared between runs with the same seed
+SEEDED_METRICS = ('bytes_written',)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the transforms and the end-to-end augmentation on a '
+                                     'synthetic rgb/depth/normal dataset.')
+    parser.add_argument('--config', type=str, default='./configs/synthetic_3d_config.py', help='The config file path.')
+    parser.add_argument('--sizes', nargs='+', default=['240x320', '480x640', '960x1280'],
+                        help='Resolutions of the synthetic datasets, HEIGHTxWIDTH.')
+    parser.add_argument('--num-images', type=int, default=16, help='Number of image triplets per resolution.')
+    parser.add_argument('--count', type=int, default=2, help='Number of augmentation epochs of the end-to-end runs.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of passes over the dataset per transform.')
+    parser.add_argument('--pipelines', nargs='+', default=['default', 'RL_searched'],
+                        help='Pipelines of the end-to-end runs.')
+    parser.add_argument('--backend', type=str, default='pil', choices=['pil', 'numpy'],
+                        help='Which execution backend to benchmark.')
+    parser.add_argument('--augment-args', type=str, default='', help='Extra arguments of the end-to-end augment.py '
+                        'runs, e.g. "--workers 4 --fuse-geometric".')
+    parser.add_argument('--skip-transforms', action='store_true', help='Skip the per transform benchmarks.')
+    parser.add_argument('--skip-e2e', action='store_true', help='Skip the end-to-end benchmarks.')
+    parser.add_argument('--work-dir', type=str, help='Where the synthetic datasets and outputs are written. '
+                        'Defaults to a temporary directory removed at the end.')
+    parser.add_argument('--seed', type=int, help='Seed of the synthetic data, of the transforms and run seed of the '
+                        'end-to-end augment.py runs. Without it the data uses seed 0, every run draws its own run '
+                        'seed and the output sizes are not compared against the baseline.')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='Path of the JSON results.')
+    parser.add_argument('--baseline', type=str, help='Path of earlier JSON results to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative change against the baseline '
+                        'reported as a regression.')
+    args = parser.parse_args()
+    return args
+
+
+def generate_dataset(root, num_images, height, width, seed=0):
+    """
+    Write a synthetic dataset, root/rgb, root/depth (16-bit png) and root/normal, with smooth gradients, blobs and
+    noise so that encoders and histogram based transforms see realistic content.
+    Args:
+        root (str): The dataset directory.
+        num_images (int): Number of image triplets.
+        height (int): Image height.
+        width (int): Image width.
+        seed (int): Random seed.
+    Returns:
+        list: List of source directories, rgb, depth, normal.
+    """
+    rng = np.random.default_rng(seed)
+    source_dirs = [join(root, src_name) for src_name in ('rgb', 'depth', 'normal')]
+    for src_dir in source_dirs:
+        makedirs(src_dir, exist_ok=True)
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    for i in range(num_images):
+        # a sloped floor plus a few spheres in front of it
+        depth = 2000 + 3000 * ys / height + 500 * np.sin(xs / width * rng.uniform(1, 6))
+        for _ in range(4):
+            cy, cx = rng.uniform(0, height), rng.uniform(0, width)
+            radius = rng.uniform(0.05, 0.25) * min(height, width)
+            dist = np.sqrt((ys - cy) ** 2 + (xs - cx) ** 2)
+            inside = dist < radius
+            depth[inside] = np.minimum(depth[inside], 1000 + dist[inside] * 2)
+        depth += rng.normal(0, 5, depth.shape)
+        depth = np.clip(depth, 0, 65535).astype(np.uint16)
+
+        grad_y, grad_x = np.gradient(depth.astype(np.float32))
+        normal = np.stack([-grad_x, -grad_y, np.ones_like(grad_x) * 8], axis=-1)
+        normal /= np.linalg.norm(normal, axis=-1, keepdims=True)
+        normal = ((normal + 1) * 127.5).astype(np.uint8)
+
+        shade = 1 - (depth.astype(np.float32) - 1000) / 5000
+        rgb = shade[..., None] * rng.uniform(80, 255, size=3) + rng.normal(0, 8, (height, width, 3))
+        rgb = np.clip(rgb, 0, 255).astype(np.uint8)
+
+        img_name = f'{i:05d}.png'
+        Image.fromarray(rgb).save(join(source_dirs[0], img_name))
+        Image.fromarray(depth).save(join(source_dirs[1], img_name))
+        Image.fromarray(normal).save(join(source_dirs[2], img_name))
+    return source_dirs
+
+
+def load_dataset(source_dirs, native_depth=False):
+    img_names = sorted(os.listdir(source_dirs[0]))
+    dataloader = DataLoader(source_dirs, img_names, native_depth=native_depth)
+    return [dataloader.load_group(img_name) for img_name in img_names]
+
+
+def bench_transforms(config, data, raw_input_idx, repeat, backend):
+    """
+    Throughput of every transform type of the default pipeline, applied with probability 1.
+    Args:
+        config (addict.Dict): config specs.
+        data (list): List of list. The inner list contains the different sources, Images, for one instance.
+        raw_input_idx (int): The index of the rgb input.
+        repeat (int): Number of passes over data.
+        backend (str): 'pil' or 'numpy'.
+    Returns:
+        dict: Transform type to {'images_per_s', 'ms_per_image'}.
+    """
+    results = {}
+    batch = stack_batch(data) if backend == 'numpy' else None
+    for transform_config in config.default_pipeline:
+        transform_config = transform_config.copy()
+        if 'apply_prob' in transform_config:
+            transform_config.apply_prob = 1.0
+        trans_op = build_transform(transform_config)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            if backend == 'numpy':
+                trans_op.apply_batch(batch, raw_input_idx)
+            else:
+                for image_group in data:
+                    trans_op(image_group, raw_input_idx)
+        elapsed = time.perf_counter() - start
+        num_images = repeat * len(data)
+        results[transform_config.type] = dict(images_per_s=num_images / elapsed,
+                                              ms_per_image=elapsed / num_images * 1e3)
+    return results
+
+
+def directory_bytes(path):
+    return sum(getsize(join(dir_path, file_name)) for dir_path, _, file_names in walk(path) for file_name in file_names)
+
+
+def bench_end_to_end(config_path, source_dirs, output_dir, pipeline, count, backend, augment_args, seed=None):
+    """
+    Run augment.py in a child process and measure its wall time, peak RSS and output size. The outputs, and so
+    their size, only repeat from run to run with a run seed.
+    Returns:
+        dict: {'images_per_s', 'seconds', 'peak_rss_mb', 'bytes_written'}, images are output image groups.
+    """
+    shutil.rmtree(output_dir, ignore_errors=True)
+    command = [sys.executable, join(os.path.dirname(os.path.abspath(__file__)), 'augment.py'),
+               '--config', config_path, '--source-dirs', *source_dirs, '--output-dir', output_dir,
+               '--count', str(count), '--pipeline', pipeline, '--backend', backend] + shlex.split(augment_args)
+    if seed is not None:
+        command += ['--seed', str(seed)]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    # wait4 gives the resource usage of this child alone, RUSAGE_CHILDREN would be the maximum over all runs
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"augment.py failed with exit code {process.returncode}: {shlex.join(command)}")
+    num_images = len(os.listdir(source_dirs[0])) * count
+    # ru_maxrss is in KB on linux and in bytes on macOS
+    peak_rss = usage.ru_maxrss / 2 ** 20 if sys.platform == 'darwin' else usage.ru_maxrss / 2 ** 10
+    return dict(images_per_s=num_images / elapsed, seconds=elapsed, peak_rss_mb=peak_rss,
+                bytes_written=directory_bytes(output_dir))
+
+
+def compare(results, baseline, threshold, seeded=False):
+    """
+    Compare every metric present in both results, SEEDED_METRICS only if seeded.
+    Args:
+        results (dict): Current results, benchmark name to metrics.
+        baseline (dict): Earlier results of the same layout.
+        threshold (float): Relative change beyond which a worse metric is a regression.
+        seeded (bool): Whether both results come from runs with the same seed.
+    Returns:
+        tuple: (lines, regressions), a report line per compared metric and the lines of the regressions.
+    """
+    lines, regressions = [], []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(name, {}).get(metric)
+            if not base or (metric in SEEDED_METRICS and not seeded):
+                continue
+            change = (value - base) / base
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            line = f'{name:<40} {metric:<14} {base:>14.3f} {value:>14.3f} {change:>+8.1%}'
+            if worse > threshold:
+                line += '  REGRESSION'
+                regressions.append(line)
+            lines.append(line)
+    return lines, regressions
+
+
+def main():
+    random.seed(args.seed or 0)
+    config = load_config(args.config, False)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='augtool-bench-')
+    results = {}
+    try:
+        for size in args.sizes:
+            height, width = (int(v) for v in size.split('x'))
+            data_dir = join(work_dir, f'data-{size}')
+            source_dirs = [join(data_dir, src_name) for src_name in ('rgb', 'depth', 'normal')]
+            if not exists(join(data_dir, 'normal')) or len(os.listdir(source_dirs[2])) != args.num_images:
+                print(f"Generating {args.num_images} images at {size}")
+                source_dirs = generate_dataset(data_dir, args.num_images, height, width, args.seed or 0)
+
+            if not args.skip_transforms:
+                data = load_dataset(source_dirs)
+                for name, metrics in bench_transforms(config, data, 0, args.repeat, args.backend).items():
+                    results[f'transform/{name}/{size}'] = metrics
+                    print(f"transform/{name}/{size}: {metrics['images_per_s']:.1f} images/s")
+
+            if not args.skip_e2e:
+                for pipeline in args.pipelines:
+                    metrics = bench_end_to_end(args.config, source_dirs, join(work_dir, 'outputs'), pipeline,
+                                               args.count, args.backend, args.augment_args, args.seed)
+                    results[f'e2e/{pipeline}/{size}'] = metrics
+                    print(f"e2e/{pipeline}/{size}: {metrics['images_per_s']:.1f} images/s, "
+                          f"peak RSS {metrics['peak_rss_mb']:.0f} MB, "
+                          f"{metrics['bytes_written'] / 2 ** 20:.1f} MB written")
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = dict(meta=dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                            platform=platform.platform(), cpus=os.cpu_count(), backend=args.backend,
+                            num_images=args.num_images, count=args.count, repeat=args.repeat,
+                            augment_args=args.augment_args, seed=args.seed),
+                  results=results)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        seeded = args.seed is not None and baseline['meta'].get('seed') == args.seed
+        lines, regressions = compare(results, baseline['results'], args.threshold, seeded)
+        print(f'{"benchmark":<40} {"metric":<14} {"baseline":>14} {"current":>14} {"change":>8}')
+        print('\n'.join(lines))
+        if regressions:
+            print(f"{len(regressions)} regressions beyond {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main()
@@ -5,20 +5,18 @@ from importlib import import_module
 from addict import Dict
 
 
-def load_config(file_path, photo_metric_distortion_for_all):
+def import_config(file_path):
     """
-    Convert python config file to an addict.Dict.
+    Import a python config file.
     Args:
         file_path (str): config file path.
-        photo_metric_distortion_for_all (bool): whether to apply photo metric distortion for all sources.
     Returns:
-        addict.Dict: the configuration dict
+        dict: the top level names of the file and their values
     """
     temp_config_dir = file_path[:file_path.rfind('/')]
     temp_module_name = osp.splitext(file_path.split('/')[-1])[0]
     sys.path.insert(0, temp_config_dir)
     mod = import_module(temp_module_name)
-    mod.photo_metric_distortion_for_all[0] = photo_metric_distortion_for_all
     sys.path.pop(0)
     cfg_dict = {
         name: value
@@ -27,9 +25,49 @@ def load_config(file_path, photo_metric_distortion_for_all):
     }
     # delete imported module
     del sys.modules[temp_module_name]
+    return cfg_dict
+
+
+def load_config(file_path, photo_metric_distortion_for_all):
+    """
+    Convert python config file to an addict.Dict.
+    Args:
+        file_path (str): config file path.
+        photo_metric_distortion_for_all (bool): whether to apply photo metric distortion for all sources.
+    Returns:
+        addict.Dict: the configuration dict
+    """
+    cfg_dict = import_config(file_path)
+    # the pipelines share this list, set in place
+    cfg_dict['photo_metric_distortion_for_all'][0] = photo_metric_distortion_for_all
     return Dict(cfg_dict)
 
 
+def load_overlay(config, file_path):
+    """
+    Merge a python config overlay, e.g. written by autotune.py, into a config. Nested dicts are merged key by key,
+    so an overlay only lists the settings it changes.
+    Args:
+        config (addict.Dict): the configuration dict, updated in place.
+        file_path (str): overlay file path.
+    """
+    config.update(Dict(import_config(file_path)))
+
+
+def write_config(config, file_path, comment=''):
+    """
+    Write a config, or an overlay of some of its settings, as a python config file.
+    Args:
+        config (dict): the configuration dict, of python literals only.
+        file_path (str): config file path.
+        comment (str): optional lines written as a comment at the top.
+    """
+    lines = [f'# {line}' for line in comment.splitlines()]
+    lines += [f'{name} = {value!r}' for name, value in config.items()]
+    with open(file_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
 if __name__ == '__main__':
     config_path = '../configs/synthetic_3d_config.py'
     config = load_config(config_path)
@@ -1,9 +1,54 @@
 import random
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from os import listdir
-from os.path import isfile, isdir, join
+from os.path import getsize, isfile, isdir, join
 from PIL import Image, ImageOps, ImageMath
 
 
+class DecodeCache:
+    """
+    A least recently used cache of decoded Images with a byte budget, shared by the loading threads.
+    Args:
+        max_bytes (int): Byte budget. Images larger than the budget are never cached.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, img):
+        nbytes = image_nbytes(img)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (img, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+
+    def __str__(self):
+        return f"{self.hits} hits, {self.misses} misses, {len(self.entries)} images, {self.nbytes / 2 ** 20:.1f} MB"
+
+
 class DataLoader:
     """
     A dataloader to retrieve images batch to batch.
@@ -12,20 +57,73 @@ class DataLoader:
         img_names (list): List of image names.
         batch_size (int): Batch size.
         keep_last_batch (Bool): Whether to keep the last batch when its size < batch_size.
+        backend (str): 'pil' or 'tiled' to return Images, 'numpy' to stack every source into a (N, H, W, C) uint8
+                 array.
+        prefetch (int): Number of batches read and decoded ahead by background threads. 0 loads synchronously.
+        io_threads (int): Number of background threads reading and decoding image groups when prefetching.
+        cache_bytes (int): Byte budget of the decoded image cache kept across epochs. 0 disables the cache.
+        native_depth (bool): Whether to keep 16-bit depth maps as single channel 'I;16' Images instead of
+                  scaling them down to 8-bit RGB.
+        profiler (profiler.Profiler): Optional profiler, records a load/<source> stage per decoded image.
+        image_sizes (dict): Optional image name to (height, width), e.g. from index.DatasetIndex. When given, every
+                  batch only holds images of one size, which the numpy backend requires.
+        store (prepared.PreparedStore): Optional store of pre-decoded sources, read instead of decoding the images
+                  it holds.
     """
-    def __init__(self, source_dirs, img_names, batch_size=4, keep_last_batch=True):
+    def __init__(self, source_dirs, img_names, batch_size=4, keep_last_batch=True, backend='pil',
+                 prefetch=0, io_threads=4, cache_bytes=0, native_depth=False, profiler=None, image_sizes=None,
+                 store=None):
         self.index = 0
         assert len(source_dirs) > 0, "Source directories should not be empty."
         self.source_dirs = source_dirs
         self.img_names = img_names
         self.batch_size = batch_size
         self.keep_last_batch = keep_last_batch
+        if backend not in ('pil', 'numpy', 'tiled'):
+            raise ValueError(f"Expect backend types: (pil, numpy, tiled), got {backend}")
+        self.backend = backend
+        self.prefetch = prefetch
+        self.io_threads = io_threads
+        self.executor = None
+        self.pending = deque()
+        self.cache = DecodeCache(cache_bytes) if cache_bytes > 0 else None
+        self.native_depth = native_depth
+        self.profiler = profiler
+        self.image_sizes = image_sizes
+        self.store = store
+        if image_sizes is not None:
+            self.img_names = self.group_by_size(img_names)
 
     def shuffle(self):
         random.shuffle(self.img_names)
+        if self.image_sizes is not None:
+            self.img_names = self.group_by_size(self.img_names, shuffle_batches=True)
+
+    def group_by_size(self, img_names, shuffle_batches=False):
+        """
+        Reorder image names so that batch_size chunks hold images of a single size, keeping the order within a size.
+        Returns:
+            list: The reordered image names.
+        """
+        groups = {}
+        for img_name in img_names:
+            groups.setdefault(self.image_sizes[img_name], []).append(img_name)
+        batches = [group[i:i + self.batch_size] for group in groups.values()
+                   for i in range(0, len(group), self.batch_size)]
+        if shuffle_batches:
+            random.shuffle(batches)
+        return [img_name for batch in batches for img_name in batch]
 
     def __iter__(self):
         self.index = 0
+        if self.prefetch > 0:
+            for _, futures in self.pending:
+                for future in futures:
+                    future.cancel()
+            self.pending.clear()
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.io_threads)
+            self.schedule()
         return self
 
     def __next__(self):
@@ -35,33 +133,138 @@ class DataLoader:
             list: List of image names for this batch
             list: List of list. The inner list contains the different sources, Images, for one instance.
                   The sequence of the inner list follows the given source_dirs.
+                  With the numpy backend, a list of (N, H, W, C) uint8 arrays, one per source, instead.
+        """
+        if self.prefetch > 0:
+            if len(self.pending) == 0:
+                raise StopIteration
+            img_names, futures = self.pending.popleft()
+            self.schedule()
+            batch = [future.result() for future in futures]
+        else:
+            img_names = self.next_batch_names()
+            if img_names is None:
+                raise StopIteration
+            batch = [self.load_group(img_name) for img_name in img_names]
+        if self.backend == 'numpy':
+            batch = stack_batch(batch)
+        return img_names, batch
+
+    def next_batch_names(self):
+        """
+        Returns:
+            list: The image names of the next batch, None when the epoch is over.
         """
         if self.index >= len(self.img_names) or (not self.keep_last_batch and
                                                  len(self.img_names) - self.index < self.batch_size):
-            raise StopIteration
-
-        batch_size = min(len(self.img_names) - self.index, self.batch_size)
-        batch = []
-        img_names = []
-        # load image batch and collate to numpy array
-        for _ in range(batch_size):
-            image_group = []
-            for i, src_dir in enumerate(self.source_dirs):
-                self.load(src_dir, self.img_names[self.index], image_group)
-            batch.append(image_group)
-            img_names.append(self.img_names[self.index])
-            self.index += 1
-        return img_names, batch
+            return None
+        img_names = self.img_names[self.index:self.index + self.batch_size]
+        if self.image_sizes is not None:
+            # the last chunk of a size is cut short rather than mixed with the next size
+            size = self.image_sizes[img_names[0]]
+            img_names = img_names[:next((k for k, img_name in enumerate(img_names)
+                                         if self.image_sizes[img_name] != size), len(img_names))]
+        self.index += len(img_names)
+        return img_names
+
+    def schedule(self):
+        """Submit batches to the background threads until self.prefetch batches are in flight."""
+        while len(self.pending) < self.prefetch:
+            img_names = self.next_batch_names()
+            if img_names is None:
+                return
+            self.pending.append((img_names, [self.executor.submit(self.load_group, name) for name in img_names]))
+
+    def load_group(self, img_name):
+        """
+        Read and decode every source of one instance.
+        Returns:
+            list: List of Image, the sequence follows the given source_dirs.
+        """
+        if self.store is not None and img_name in self.store:
+            start = time.perf_counter()
+            image_group = self.store.load(img_name)
+            if self.profiler is not None:
+                self.profiler.record_stage('load/store', time.perf_counter() - start,
+                                           sum(image_nbytes(img) for img in image_group))
+            return image_group
+        image_group = []
+        for src_dir in self.source_dirs:
+            img = self.cache.get((src_dir, img_name)) if self.cache is not None else None
+            if img is None:
+                start = time.perf_counter()
+                self.load(src_dir, img_name, image_group, self.native_depth)
+                img = image_group.pop()
+                # Image.open is lazy, decode here rather than at first use
+                img.load()
+                if self.profiler is not None:
+                    self.profiler.record_stage('load/' + src_dir.split('/')[-1], time.perf_counter() - start,
+                                               getsize(join(src_dir, img_name)))
+                if self.cache is not None:
+                    self.cache.put((src_dir, img_name), img)
+            image_group.append(img)
+        return image_group
+
+    def close(self):
+        """Stop the background threads."""
+        if self.executor is not None:
+            for _, futures in self.pending:
+                for future in futures:
+                    future.cancel()
+            self.pending.clear()
+            self.executor.shutdown()
+            self.executor = None
 
     @staticmethod
-    def load(source_dir, img_name, target_pool):
+    def load(source_dir, img_name, target_pool, native_depth=False):
         img = Image.open(join(source_dir, img_name))
-        if img.mode == 'I':
+        if native_depth and (img.mode == 'I' or img.mode.startswith('I;16')):
+            # an 'I;16' decode is kept as is, saved back as a 16-bit png. Older Pillow versions decode 16-bit pngs
+            # as 32-bit 'I', narrowing those to uint16 copies the pixels once
+            if img.mode != 'I;16':
+                img = Image.fromarray(np.asarray(img).astype(np.uint16))
+        elif img.mode == 'I':
             img = ImageMath.eval('img/256', {'img': img}).convert('RGB')
         target_pool.append(img)
         return
 
 
+def image_nbytes(img):
+    """Approximate decoded size of an Image."""
+    bytes_per_band = 4 if img.mode in ('I', 'F') else 2 if img.mode.startswith('I;16') else 1
+    return img.width * img.height * len(img.getbands()) * bytes_per_band
+
+
+def stack_batch(batch):
+    """
+    Stack a batch of image groups into one (N, H, W, C) array per source, uint8 or uint16 for native depth.
+    Args:
+        batch (list): List of list. The inner list contains the different sources, Images, for one instance.
+    Returns:
+        list: List of np.ndarray, one per source.
+    """
+    stacked = []
+    for j in range(len(batch[0])):
+        images = [np.asarray(image_group[j]) for image_group in batch]
+        if any(img.shape != images[0].shape for img in images):
+            raise ValueError("Images are not in same size.")
+        images = np.stack(images)
+        stacked.append(images if images.ndim == 4 else images[..., None])
+    return stacked
+
+
+def unstack_batch(batch):
+    """
+    Inverse of stack_batch.
+    Args:
+        batch (list): List of np.ndarray, one (N, H, W, C) uint8 array per source.
+    Returns:
+        list: List of list. The inner list contains the different sources, Images, for one instance.
+    """
+    return [[Image.fromarray(images[n] if images.shape[3] > 1 else images[n, ..., 0]) for images in batch]
+            for n in range(len(batch[0]))]
+
+
 if __name__ == '__main__':
     data_root = '../data'
     source_dirs = [join(data_root, dir_name) for dir_name in listdir(data_root)
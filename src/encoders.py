@@ -0,0 +1,154 @@
+import io
+import numpy as np
+from PIL import Image
+
+
+class Codec:
+    """
+    Encode an output image into the content of one file.
+    Args:
+        spec (str): The codec spec it was built from, 'name' or 'name:param', see get_codec.
+    """
+    ext = ''
+    # whether the codec takes a parameter, passed to its constructor
+    has_param = False
+
+    def __init__(self, spec):
+        self.spec = spec
+
+    def encode(self, img):
+        """
+        Args:
+            img (Image): The image to encode.
+        Returns:
+            bytes: The file content.
+        """
+        raise RuntimeError("Illegal call to base class.")
+
+
+class PngCodec(Codec):
+    """PNG at a zlib compress level, 0 (stored) to 9, 1 by default. 16-bit images are saved as 16-bit PNGs."""
+    ext = '.png'
+    has_param = True
+
+    def __init__(self, spec, level='1'):
+        super(PngCodec, self).__init__(spec)
+        self.level = int(level)
+
+    def encode(self, img):
+        buffer = io.BytesIO()
+        img.save(buffer, format='PNG', compress_level=self.level)
+        return buffer.getvalue()
+
+
+class Png16Codec(PngCodec):
+    """16-bit single channel PNG for depth, 32-bit integer images are clipped to [0, 65535]."""
+    def encode(self, img):
+        if img.mode == 'I':
+            img = Image.fromarray(np.clip(np.asarray(img), 0, 65535).astype(np.uint16))
+        elif not img.mode.startswith('I;16'):
+            raise ValueError(f"png16 expects 16-bit images, got mode {img.mode}, depth is kept 16-bit with "
+                             f"--native-depth")
+        return super(Png16Codec, self).encode(img)
+
+
+class NpyCodec(Codec):
+    """Uncompressed .npy of the image array, (H, W, C) or (H, W), no encoding cost at all."""
+    ext = '.npy'
+
+    def encode(self, img):
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(img), allow_pickle=False)
+        return buffer.getvalue()
+
+
+class Float16Codec(Codec):
+    """
+    .npy of the image values times a scale as float16, e.g. float16:0.001 for depth in millimetres saved in metres.
+    Exact for 8-bit images, integers above 2048 lose precision.
+    """
+    ext = '.npy'
+    has_param = True
+
+    def __init__(self, spec, scale='1'):
+        super(Float16Codec, self).__init__(spec)
+        self.scale = float(scale)
+
+    def encode(self, img):
+        buffer = io.BytesIO()
+        np.save(buffer, (np.asarray(img, dtype=np.float32) * self.scale).astype(np.float16), allow_pickle=False)
+        return buffer.getvalue()
+
+
+class WebpCodec(Codec):
+    """
+    Lossless WebP at an effort method, 0 (fastest) to 6, 0 by default. Several times faster than PNG and smaller
+    for 8-bit RGB/RGBA images, which are the only modes it keeps exactly.
+    """
+    ext = '.webp'
+    has_param = True
+
+    def __init__(self, spec, method='0'):
+        super(WebpCodec, self).__init__(spec)
+        self.method = int(method)
+
+    def encode(self, img):
+        if img.mode not in ('RGB', 'RGBA'):
+            raise ValueError(f"webp expects RGB or RGBA images, got mode {img.mode}")
+        buffer = io.BytesIO()
+        img.save(buffer, format='WEBP', lossless=True, quality=0, method=self.method)
+        return buffer.getvalue()
+
+
+class TiffCodec(Codec):
+    """LZW compressed TIFF, lossless and fast for every mode, 16-bit depth included."""
+    ext = '.tif'
+
+    def encode(self, img):
+        buffer = io.BytesIO()
+        img.save(buffer, format='TIFF', compression='tiff_lzw')
+        return buffer.getvalue()
+
+
+CODECS = {
+    'png': PngCodec,
+    'png16': Png16Codec,
+    'npy': NpyCodec,
+    'float16': Float16Codec,
+    'webp': WebpCodec,
+    'tiff': TiffCodec,
+}
+
+
+def get_codec(spec):
+    """
+    Args:
+        spec (str): 'name' or 'name:param', e.g. 'png:6', 'float16:0.001', name one of CODECS.
+    Returns:
+        Codec: The codec.
+    """
+    name, _, param = spec.partition(':')
+    if name not in CODECS:
+        raise ValueError(f"Expect output codecs: ({', '.join(CODECS)}), got {spec}")
+    if not param:
+        return CODECS[name](spec)
+    if not CODECS[name].has_param:
+        raise ValueError(f"Codec {name} takes no parameter, got {spec}")
+    try:
+        return CODECS[name](spec, param)
+    except ValueError:
+        raise ValueError(f"Invalid parameter of codec {name}, got {spec}") from None
+
+
+def get_codecs(output_codecs, src_names):
+    """
+    Args:
+        output_codecs (dict): Source name to codec spec, 'default' for the sources not listed.
+        src_names (list): List of source names, in source_dirs order.
+    Returns:
+        list: List of Codec, one per source.
+    """
+    unknown = set(output_codecs) - set(src_names) - {'default'}
+    if unknown:
+        raise ValueError(f"Output codecs given for unknown sources {sorted(unknown)}, expect ({', '.join(src_names)})")
+    return [get_codec(output_codecs.get(src_name, output_codecs.get('default', 'png:1'))) for src_name in src_names]
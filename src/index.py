@@ -0,0 +1,110 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os.path import abspath, dirname, exists, join
+from PIL import Image, UnidentifiedImageError
+
+INDEX_VERSION = 1
+
+
+class DatasetIndex:
+    """
+    Cached listing of a multi-source dataset, the image names present with the same size in every source, along with
+    the width, height, mode, byte size and mtime of each file.
+    The index is kept in a JSON file, next to the source directories by default, and updated incrementally: a source
+    whose directory mtime did not change since it was indexed is not listed again, otherwise it is listed with
+    os.scandir and only the new or modified files have their header read. Files modified in place do not change the
+    directory mtime, rescan checks every file. Listing and header reads run on a thread pool.
+    Args:
+        source_dirs (list): List of source directories, ['./data/rgb', './data/depth', ...]
+        index_path (str): Path of the index file, <parent of the first source>/.dataset_index.json by default.
+        threads (int): Number of threads listing the sources and reading headers.
+        rescan (bool): Whether to list every source and check every file even if its directory did not change.
+    """
+    def __init__(self, source_dirs, index_path=None, threads=8, rescan=False):
+        self.source_dirs = source_dirs
+        self.index_path = index_path or join(dirname(abspath(source_dirs[0])), '.dataset_index.json')
+        self.threads = threads
+        cached = {}
+        if exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index.get('version') == INDEX_VERSION:
+                cached = index['sources']
+        self.sources = {}
+        self.changed = False
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for src_dir in source_dirs:
+                self.sources[abspath(src_dir)] = self.scan(src_dir, cached.get(abspath(src_dir)), rescan, executor)
+        self.img_names, self.excluded = self.align()
+        if self.changed:
+            cached.update(self.sources)
+            self.save(cached)
+
+    def scan(self, src_dir, cached, rescan, executor):
+        """
+        Returns:
+            dict: {'mtime_ns': directory mtime, 'files': file name to [mtime_ns, bytes, width, height, mode]}, mode is
+                  None for files that are not images.
+        """
+        mtime_ns = os.stat(src_dir).st_mtime_ns
+        if cached is not None and cached['mtime_ns'] == mtime_ns and not rescan:
+            return cached
+        self.changed = True
+        cached_files = cached['files'] if cached is not None else {}
+        with os.scandir(src_dir) as entries:
+            entries = [entry for entry in entries if entry.is_file()]
+
+        def describe(entry):
+            stat = entry.stat()
+            known = cached_files.get(entry.name)
+            if known is not None and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+                return entry.name, known
+            try:
+                with Image.open(entry.path) as img:
+                    return entry.name, [stat.st_mtime_ns, stat.st_size, img.width, img.height, img.mode]
+            except UnidentifiedImageError:
+                return entry.name, [stat.st_mtime_ns, stat.st_size, 0, 0, None]
+
+        return {'mtime_ns': mtime_ns, 'files': dict(executor.map(describe, entries))}
+
+    def align(self):
+        """
+        Returns:
+            tuple: (img_names, excluded), the sorted image names present with the same size in every source, and
+                   the names left out with the reason why.
+        """
+        sources = [self.sources[abspath(src_dir)]['files'] for src_dir in self.source_dirs]
+        img_names = []
+        excluded = {}
+        for img_name in sorted(set().union(*sources)):
+            files = [files.get(img_name) for files in sources]
+            missing = [src_dir for src_dir, file in zip(self.source_dirs, files) if file is None]
+            if missing:
+                excluded[img_name] = 'missing from ' + ', '.join(missing)
+            elif any(file[4] is None for file in files):
+                excluded[img_name] = 'not an image'
+            elif len({(file[2], file[3]) for file in files}) > 1:
+                excluded[img_name] = 'sources of different sizes'
+            else:
+                img_names.append(img_name)
+        return img_names, excluded
+
+    def save(self, sources):
+        try:
+            tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': INDEX_VERSION, 'sources': sources}, f)
+            # atomic, concurrent runs never read a partial index
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f"Failed to save the dataset index to {self.index_path}: {e}")
+
+    def get_size(self, img_name):
+        """The (height, width) of an image, the same in every source."""
+        _, _, width, height, _ = self.sources[abspath(self.source_dirs[0])]['files'][img_name]
+        return height, width
+
+    def get_sizes(self):
+        """Image name to (height, width), for every aligned image."""
+        return {img_name: self.get_size(img_name) for img_name in self.img_names}
@@ -0,0 +1,128 @@
+import argparse
+import json
+import random
+import threading
+from glob import glob
+from os import makedirs
+from os.path import exists, join
+
+
+def get_manifest_names(num_shards=1, shard_index=0):
+    """The run and completed file names of a manifest, one pair per shard of a job split over several nodes."""
+    if num_shards == 1:
+        return 'run.json', 'completed.jsonl'
+    suffix = f'{shard_index:05d}-of-{num_shards:05d}'
+    return f'run-{suffix}.json', f'completed-{suffix}.jsonl'
+
+
+def read_completed(completed_path):
+    with open(completed_path, 'rb+') as f:
+        lines = f.readlines()
+        if lines and not lines[-1].endswith(b'\n'):
+            # the record of an interrupted item, dropped so that appending starts on a fresh line
+            lines.pop()
+            f.truncate(sum(len(line) for line in lines))
+    return {(record['img_name'], record['epoch']) for record in map(json.loads, lines)}
+
+
+class RunManifest:
+    """
+    Record of the (image, epoch) work items of a run that are saved, kept in the output directory so that an
+    interrupted run can be resumed where it stopped. output_dir/run.json holds the run seed, every item gets one
+    line in output_dir/completed.jsonl once all of its sources are written, flushed right away.
+    The shards of a job split over several nodes each keep their own pair of files, see get_manifest_names and
+    merge_manifests.
+    Args:
+        output_dir (str): The output directory path.
+        seed (int): Run seed. None reuses the seed of the recorded run, or draws a new one.
+        resume (bool): Whether to keep the items recorded by an earlier run in output_dir. If not, the record is
+              cleared and every item is produced again.
+        num_shards (int): Number of shards of the job.
+        shard_index (int): The shard run by this process.
+    """
+    def __init__(self, output_dir, seed=None, resume=False, num_shards=1, shard_index=0):
+        makedirs(output_dir, exist_ok=True)
+        run_name, completed_name = get_manifest_names(num_shards, shard_index)
+        run_path = join(output_dir, run_name)
+        completed_path = join(output_dir, completed_name)
+        recorded_seed = None
+        if resume and exists(run_path):
+            with open(run_path) as f:
+                recorded_seed = json.load(f)['seed']
+            if seed is not None and seed != recorded_seed:
+                raise ValueError(f"{output_dir} holds a run with seed {recorded_seed}, got seed {seed}. "
+                                 f"Use the same seed to resume it or run without --resume to start over.")
+        if recorded_seed is not None:
+            self.seed = recorded_seed
+        else:
+            self.seed = seed if seed is not None else random.SystemRandom().randrange(2 ** 32)
+            with open(run_path, 'w') as f:
+                json.dump({'seed': self.seed, 'num_shards': num_shards, 'shard_index': shard_index}, f)
+
+        self.completed = read_completed(completed_path) if resume and exists(completed_path) else set()
+        # the items of this run, None for every item
+        self.items = None
+        self.lock = threading.Lock()
+        self.file = open(completed_path, 'a' if resume else 'w')
+
+    def __len__(self):
+        return len(self.completed)
+
+    def assign(self, items):
+        """Restrict the run to a set of (img_name, epoch), e.g. the items of one shard."""
+        self.items = items
+
+    def is_pending(self, img_name, epoch):
+        key = (img_name, epoch)
+        return key not in self.completed and (self.items is None or key in self.items)
+
+    def pending_epochs(self, img_name, aug_times):
+        return [epoch for epoch in range(aug_times) if self.is_pending(img_name, epoch)]
+
+    def mark_done(self, img_name, epoch):
+        with self.lock:
+            self.completed.add((img_name, epoch))
+            self.file.write(json.dumps({'img_name': img_name, 'epoch': epoch}) + '\n')
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def merge_manifests(manifest_dirs, output_dir):
+    """
+    Merge the per shard manifests of a job, e.g. copied back from every node, into the manifest of a single run,
+    output_dir/run.json and output_dir/completed.jsonl, which an unsharded run in output_dir resumes with --resume.
+    Args:
+        manifest_dirs (list): Directories holding run-*.json and completed-*.jsonl files.
+        output_dir (str): The output directory path.
+    Returns:
+        int: Number of completed items.
+    """
+    seeds = set()
+    completed = set()
+    for manifest_dir in manifest_dirs:
+        for run_path in glob(join(manifest_dir, 'run-*-of-*.json')):
+            with open(run_path) as f:
+                seeds.add(json.load(f)['seed'])
+            completed_path = run_path.replace('run-', 'completed-')[:-len('.json')] + '.jsonl'
+            if exists(completed_path):
+                completed |= read_completed(completed_path)
+    if len(seeds) != 1:
+        raise ValueError(f"Expect shard manifests of a single run seed, got seeds {sorted(seeds)}")
+    makedirs(output_dir, exist_ok=True)
+    with open(join(output_dir, 'run.json'), 'w') as f:
+        json.dump({'seed': seeds.pop(), 'num_shards': 1, 'shard_index': 0}, f)
+    with open(join(output_dir, 'completed.jsonl'), 'w') as f:
+        for img_name, epoch in sorted(completed):
+            f.write(json.dumps({'img_name': img_name, 'epoch': epoch}) + '\n')
+    return len(completed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the per shard manifests of a job split over several nodes.')
+    parser.add_argument('manifest_dirs', nargs='+', help='Directories holding the shard manifests.')
+    parser.add_argument('--output-dir', type=str, required=True, help='Where the merged manifest is written.')
+    args = parser.parse_args()
+    print(f"Merged {merge_manifests(args.manifest_dirs, args.output_dir)} completed items")
@@ -0,0 +1,165 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def metrics_enabled(config):
+    """Whether the run exports metrics, which then need a profiler in every process, see MetricsReporter."""
+    return bool(config.metrics_path or config.metrics_port)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve the latest metrics of the reporter of the server on /metrics."""
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.reporter.text.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are not worth a line on stderr each
+        pass
+
+
+class MetricsReporter:
+    """
+    Live progress of a run for schedulers and alerting, so that a stalled job can be told from a slow one.
+    Every interval a background thread derives from the manifest and the profiler the work items done, their rate
+    and the ETA, the bytes read by the load stages and written by the encode stages with their rates, the busy
+    seconds per second of every stage and the registered gauges, e.g. queue depths. The metrics are rendered in the
+    Prometheus text format, written atomically to path, e.g. for the node_exporter textfile collector, served on
+    127.0.0.1:port/metrics and summarised in one printed progress line.
+    The rates are those of the last interval, the ETA uses the mean rate of the run. Worker profiles are merged as
+    their items complete, so the stage metrics of a parallel run lag by up to one item per worker.
+    Args:
+        profiler (profiler.Profiler): The profiler of the run, holding the stage times and bytes of every process.
+        manifest (manifest.RunManifest): The run manifest, the items it records as done after the start count.
+        total_items (int): Number of (image, epoch) work items of this run.
+        path (str): Path of the metrics file, empty for none.
+        port (int): Local HTTP port of the metrics endpoint, 0 for none.
+        interval (float): Seconds between updates.
+    """
+    def __init__(self, profiler, manifest, total_items, path='', port=0, interval=10.0):
+        self.profiler = profiler
+        self.manifest = manifest
+        self.total_items = total_items
+        self.path = path
+        self.interval = interval
+        self.gauges = {}
+        self.start_time = time.time()
+        self.start_done = len(manifest)
+        self.last_progress = self.start_time
+        # the (time, items done, bytes read, bytes written, stage seconds) of the previous update
+        self.previous = (self.start_time, 0, 0, 0, {})
+        self.text = ''
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.server = None
+        if port:
+            self.server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+            self.server.reporter = self
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def add_gauge(self, name, help_text, get_value):
+        """
+        Args:
+            name (str): Metric name, prefixed with augtool_.
+            help_text (str): Its description.
+            get_value (callable): Called at every update for the current value.
+        """
+        self.gauges[name] = (help_text, get_value)
+
+    def start(self):
+        self.update()
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.update()
+
+    def close(self):
+        """Stop the updates and the endpoint, the metrics file keeps the final values."""
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.update()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def snapshot(self):
+        done = len(self.manifest) - self.start_done
+        with self.profiler.lock:
+            nbytes = dict(self.profiler.bytes)
+            stage_seconds = {name: stats.total for name, stats in self.profiler.stages.items()}
+        read = sum(count for name, count in nbytes.items() if name.startswith('load/'))
+        written = sum(count for name, count in nbytes.items() if name.startswith('encode/'))
+        return time.time(), done, read, written, stage_seconds
+
+    def update(self):
+        now, done, read, written, stage_seconds = current = self.snapshot()
+        previous_time, previous_done, previous_read, previous_written, previous_seconds = self.previous
+        self.previous = current
+        if done > previous_done:
+            self.last_progress = now
+        elapsed = now - self.start_time
+        period = max(now - previous_time, 1e-9)
+        remaining = max(self.total_items - done, 0)
+        mean_rate = done / max(elapsed, 1e-9)
+        eta = remaining / mean_rate if mean_rate > 0 else -1
+        metrics = [
+            ('items_target', 'gauge', 'Work items, (image, epoch) outputs, of this run.', self.total_items),
+            ('items_done_total', 'counter', 'Work items completed by this run.', done),
+            ('items_per_second', 'gauge', 'Work items completed per second over the last interval.',
+             (done - previous_done) / period),
+            ('eta_seconds', 'gauge', 'Estimated seconds left at the mean rate of the run, -1 before the first item.',
+             eta if remaining else 0),
+            ('read_bytes_total', 'counter', 'Bytes read by the load stages.', read),
+            ('read_bytes_per_second', 'gauge', 'Bytes read per second over the last interval.',
+             (read - previous_read) / period),
+            ('written_bytes_total', 'counter', 'Bytes written by the encode stages.', written),
+            ('written_bytes_per_second', 'gauge', 'Bytes written per second over the last interval.',
+             (written - previous_written) / period),
+            ('elapsed_seconds', 'gauge', 'Seconds since the start of the run.', elapsed),
+            ('last_progress_timestamp_seconds', 'gauge', 'Unix time of the last update that saw new items done.',
+             self.last_progress),
+        ]
+        metrics += [(name, 'gauge', help_text, get_value()) for name, (help_text, get_value) in self.gauges.items()]
+        lines = []
+        for name, metric_type, help_text, value in metrics:
+            lines += [f'# HELP augtool_{name} {help_text}', f'# TYPE augtool_{name} {metric_type}',
+                      f'augtool_{name} {value}']
+        lines += ['# HELP augtool_stage_seconds_total Wall seconds spent in each stage, summed over threads and '
+                  'workers.', '# TYPE augtool_stage_seconds_total counter']
+        lines += [f'augtool_stage_seconds_total{{stage="{name}"}} {seconds}'
+                  for name, seconds in sorted(stage_seconds.items())]
+        lines += ['# HELP augtool_stage_utilisation Busy seconds per second of each stage over the last interval, '
+                  'above 1 when it runs on several threads or workers.', '# TYPE augtool_stage_utilisation gauge']
+        lines += [f'augtool_stage_utilisation{{stage="{name}"}} '
+                  f'{(seconds - previous_seconds.get(name, 0.0)) / period}'
+                  for name, seconds in sorted(stage_seconds.items())]
+        self.text = '\n'.join(lines) + '\n'
+        if self.path:
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(self.text)
+            os.replace(tmp_path, self.path)
+        print(f"Progress: {done}/{self.total_items} items, {(done - previous_done) / period:.2f} items/s, "
+              f"read {(read - previous_read) / period / 2 ** 20:.1f} MB/s, "
+              f"written {(written - previous_written) / period / 2 ** 20:.1f} MB/s, "
+              f"ETA {format_seconds(eta if remaining else 0)}")
+
+
+def format_seconds(seconds):
+    if seconds < 0:
+        return 'unknown'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}'
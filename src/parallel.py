@@ -0,0 +1,239 @@
+import random
+import time
+from os.path import getsize, join
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import Value
+from multiprocessing.util import Finalize
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from PIL import Image
+
+from augmentor import Augmentor, get_item_rng, get_modified
+from dataloader import DataLoader, image_nbytes, stack_batch, unstack_batch
+from encoders import get_codecs
+from shards import ShardWriter
+from writer import OutputDedup
+from metrics import metrics_enabled
+from profiler import Profiler
+from partition import get_node_prefix
+from prepared import SUPPORTED_MODES
+
+# per worker process state, set once by init_worker
+worker_state = {}
+
+
+class SharedImageGroup:
+    """
+    The decoded sources of one image group, copied once into a multiprocessing.shared_memory block so that
+    workers can attach to it instead of receiving pickled images.
+    Args:
+        images (list): List of Image, one per source.
+    """
+    def __init__(self, images):
+        arrays = [np.asarray(img) for img in images]
+        self.shm = SharedMemory(create=True, size=max(sum(array.nbytes for array in arrays), 1))
+        self.specs = []
+        offset = 0
+        for img, array in zip(images, arrays):
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=self.shm.buf, offset=offset)
+            view[...] = array
+            self.specs.append((offset, array.shape, array.dtype.str, img.mode))
+            offset += array.nbytes
+            del view
+
+    @property
+    def handle(self):
+        """Picklable description of the block, see attach_group."""
+        return self.shm.name, self.specs
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach_group(handle):
+    """
+    Rebuild the Images of a SharedImageGroup inside a worker, as read only views of the block for the modes whose
+    array layout is also their raw PIL layout, copies for the others. PIL copies a read only Image before writing to
+    it, so only the transforms needing writable memory pay for a copy.
+    The block stays mapped in the worker even once released by the main process, it is detached by
+    SharedMemory.close, which requires every view to be gone.
+    Args:
+        handle (tuple): SharedImageGroup.handle.
+    Returns:
+        tuple: (shm, images), the attached SharedMemory and the list of Image, one per source.
+    """
+    name, specs = handle
+    shm = SharedMemory(name=name)
+    images = []
+    for offset, shape, dtype, mode in specs:
+        if mode in SUPPORTED_MODES:
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            images.append(Image.frombuffer(mode, (shape[1], shape[0]), shm.buf[offset:offset + nbytes], 'raw', mode,
+                                           0, 1))
+        else:
+            view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+            images.append(Image.fromarray(np.array(view), mode))
+            del view
+    return shm, images
+
+
+def init_worker(config, src_names, raw_input_idx, seed, counter, save=True):
+    with counter.get_lock():
+        worker_idx = counter.value
+        counter.value += 1
+    profiler = Profiler(src_names) if config.profile or metrics_enabled(config) else None
+    worker_state.update(augmentor=Augmentor(config, profiler), config=config, src_names=src_names,
+                        raw_input_idx=raw_input_idx, seed=seed, profiler=profiler,
+                        codecs=get_codecs(config.data.output_codecs, src_names),
+                        dedup=OutputDedup() if config.data.dedup_outputs else None)
+    if save and config.data.output_format == 'shards':
+        node_prefix = get_node_prefix(config.num_shards, config.shard_index)
+        # saved in the worker itself, without encoder threads, the shards are closed when the worker exits
+        worker_state['writer'] = ShardWriter(src_names, config.data.output_dir, threads=0,
+                                             encoding=config.data.shard_encoding,
+                                             shard_bytes=config.data.shard_mb * 2 ** 20,
+                                             prefix=f'shard-{node_prefix}w{worker_idx:03d}-', profiler=profiler,
+                                             dedup=worker_state['dedup'])
+        Finalize(worker_state['writer'], worker_state['writer'].close, exitpriority=0)
+
+
+def augment_group(images, img_name, epoch):
+    """
+    Augment one (image group, epoch) work item inside a worker.
+    Args:
+        images (list): List of Image, one per source, see attach_group.
+    Returns:
+        list: List of Image, one per source.
+    """
+    config, augmentor, profiler = worker_state['config'], worker_state['augmentor'], worker_state['profiler']
+    batch = [images]
+    rngs = [get_item_rng(worker_state['seed'], img_name, epoch)]
+    start = time.perf_counter()
+    if config.backend == 'numpy':
+        augmented = unstack_batch(augmentor.augment(stack_batch(batch), worker_state['raw_input_idx'], rngs))
+    else:
+        augmented = augmentor.augment(batch, worker_state['raw_input_idx'], rngs)
+    if profiler is not None:
+        profiler.record_stage('augment', time.perf_counter() - start)
+    return augmented[0]
+
+
+def augment_item(handle, img_name, epoch):
+    """
+    Augment one (image group, epoch) work item and save it, runs inside a worker.
+    Returns:
+        tuple: (img_name, epoch, profile, dedup_counts), profile is what the worker profiler recorded for this item
+               and dedup_counts the outputs it wrote and referenced per source, or None.
+    """
+    # imported here to avoid a circular import, augment imports this module
+    from augment import save_results
+    config, profiler, dedup = worker_state['config'], worker_state['profiler'], worker_state['dedup']
+    shm, images = attach_group(handle)
+    image_group = augment_group(images, img_name, epoch)
+    modified = get_modified([images], [image_group])[0] if dedup is not None else None
+    if 'writer' in worker_state:
+        worker_state['writer'].save_group(img_name, image_group, epoch, modified)
+    else:
+        save_results(worker_state['src_names'], [img_name], [image_group], epoch, config.data.output_dir, profiler,
+                     worker_state['codecs'], dedup, [modified] if modified is not None else None)
+    # untouched sources are still views of the block
+    del images, image_group
+    shm.close()
+    return img_name, epoch, profiler.pop_state() if profiler is not None else None, \
+        dedup.pop_counts() if dedup is not None else None
+
+
+def stream_item(handle, img_name, epoch):
+    """
+    Augment one (image group, epoch) work item and send it back instead of saving it, runs inside a worker.
+    Returns:
+        tuple: (arrays, profile), one np.ndarray per source and what the worker profiler recorded, or None.
+    """
+    profiler = worker_state['profiler']
+    shm, images = attach_group(handle)
+    # np.asarray copies the pixels out of an Image
+    arrays = [np.asarray(img) for img in augment_group(images, img_name, epoch)]
+    del images
+    shm.close()
+    return arrays, profiler.pop_state() if profiler is not None else None
+
+
+def augment_parallel(config, source_dirs, image_names, raw_input_idx, workers, manifest, profiler=None, store=None,
+                     dedup=None):
+    """
+    Spread the (image group, epoch) work items over a pool of worker processes.
+    Every group is decoded once by this process, shared with the workers through shared memory for all of its
+    pending config.aug_times epochs and released once they are done. At most 2 * workers groups are resident at a
+    time. The output layout and, given the same seed, the outputs are the same as the sequential path.
+    Args:
+        config (addict.Dict): config specs.
+        source_dirs (list): List of source directories.
+        image_names (list): List of image names.
+        raw_input_idx (int): The index of the rgb input. -1 means rgb not existed.
+        workers (int): Number of worker processes.
+        manifest (manifest.RunManifest): The run seed and the pending items, the others are skipped.
+        profiler (profiler.Profiler): Optional profiler, the worker profiles are merged into it.
+        store (prepared.PreparedStore): Optional store of pre-decoded sources.
+        dedup (writer.OutputDedup): Optional, the written and referenced output counts of the workers are merged
+              into it.
+    """
+    src_names = [src_dir.split('/')[-1] for src_dir in source_dirs]
+    image_names = list(image_names)
+    if config.data.shuffle_load:
+        random.shuffle(image_names)
+    max_resident = 2 * workers
+    resident = {}
+    pending = set()
+
+    def collect():
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.discard(future)
+            img_name, epoch, profile, dedup_counts = future.result()
+            manifest.mark_done(img_name, epoch)
+            if profile is not None:
+                profiler.merge_state(profile)
+            if dedup_counts is not None:
+                dedup.merge_counts(dedup_counts)
+            group, remaining = resident[img_name]
+            if remaining == 1:
+                group.release()
+                del resident[img_name]
+            else:
+                resident[img_name] = (group, remaining - 1)
+
+    initargs = (config, src_names, raw_input_idx, manifest.seed, Value('i', 0))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=initargs) as executor:
+        try:
+            for i, img_name in enumerate(image_names):
+                epochs = manifest.pending_epochs(img_name, config.aug_times)
+                if not epochs:
+                    continue
+                while len(resident) >= max_resident:
+                    collect()
+                print(f"Augmenting image {i}: {img_name}")
+                images = []
+                if store is not None and img_name in store:
+                    start = time.perf_counter()
+                    images = store.load(img_name)
+                    if profiler is not None:
+                        profiler.record_stage('load/store', time.perf_counter() - start,
+                                              sum(image_nbytes(img) for img in images))
+                for src_dir in source_dirs[len(images):]:
+                    start = time.perf_counter()
+                    DataLoader.load(src_dir, img_name, images, config.data.native_depth)
+                    images[-1].load()
+                    if profiler is not None:
+                        profiler.record_stage('load/' + src_dir.split('/')[-1], time.perf_counter() - start,
+                                              getsize(join(src_dir, img_name)))
+                group = SharedImageGroup(images)
+                resident[img_name] = (group, len(epochs))
+                for epoch in epochs:
+                    pending.add(executor.submit(augment_item, group.handle, img_name, epoch))
+            while pending:
+                collect()
+        finally:
+            wait(pending)
+            for group, _ in resident.values():
+                group.release()
@@ -0,0 +1,37 @@
+def partition_items(img_names, pixel_counts, aug_times, num_shards, shard_index):
+    """
+    The (image, epoch) work items of one shard of a job split over num_shards nodes.
+    Items are ordered by image name then epoch and cut into num_shards contiguous ranges of about the same number
+    of pixels, every item going to the range holding its middle. The split only depends on the listing, not on the
+    listing order, and the epochs of an image mostly land on the same node so that it is decoded once.
+    Args:
+        img_names (list): List of image names.
+        pixel_counts (list): Pixel count of every image, in img_names order.
+        aug_times (int): Number of augmentation epochs.
+        num_shards (int): Number of shards.
+        shard_index (int): Index of the shard to return, in [0, num_shards).
+    Returns:
+        tuple: (items, pixels), the set of (img_name, epoch) of the shard and their total pixel count.
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Expect shard index in [0, {num_shards}), got {shard_index}")
+    weights = sorted(zip(img_names, pixel_counts))
+    total = sum(pixel_count for _, pixel_count in weights) * aug_times
+    if total == 0:
+        return set(), 0
+    items = set()
+    pixels = 0
+    done = 0
+    for img_name, pixel_count in weights:
+        for epoch in range(aug_times):
+            # integer arithmetic, the split must not depend on float rounding across machines
+            if (2 * done + pixel_count) * num_shards // (2 * total) == shard_index:
+                items.add((img_name, epoch))
+                pixels += pixel_count
+            done += pixel_count
+    return items, pixels
+
+
+def get_node_prefix(num_shards, shard_index):
+    """File name prefix that keeps the shard files of different nodes apart in a common output directory."""
+    return '' if num_shards == 1 else f'n{shard_index:03d}-'
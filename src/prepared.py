@@ -0,0 +1,165 @@
+import argparse
+import json
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs
+from os.path import abspath, exists, join
+import numpy as np
+from PIL import Image
+
+from dataloader import DataLoader
+from index import DatasetIndex
+from shards import ALIGNMENT
+
+STORE_VERSION = 1
+# modes whose np.asarray layout is also their raw PIL layout, others are left to regular decoding
+SUPPORTED_MODES = ('L', 'RGB', 'RGBA', 'I;16', 'I', 'F')
+
+
+class PreparedStore:
+    """
+    Sources decoded once into raw arrays on local disk and read back through memory maps, instead of decoding every
+    image again in every run. Every source has one append-only store_dir/<src_name>.bin file, blobs start on a page
+    boundary. store_dir/store.json holds, per image name and source, the offset, shape, dtype and mode of the blob and
+    the mtime and byte size of the file it was decoded from. Depth maps are converted as DataLoader.load does, so a
+    store is prepared either for native 16-bit depth or not.
+    Single channel sources, e.g. native depth, are served without any copy from the page cache, which every run and
+    worker process reading the store shares. PIL keeps RGB with 4 bytes per pixel, so these are one memcpy away.
+    Args:
+        store_dir (str): The store directory.
+        index (index.DatasetIndex): Optional dataset index, images whose source files changed since they were
+              prepared are left out.
+    """
+    def __init__(self, store_dir, index=None):
+        with open(join(store_dir, 'store.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != STORE_VERSION:
+            raise ValueError(f"Expect store version {STORE_VERSION}, got {meta['version']}")
+        self.store_dir = store_dir
+        self.src_names = meta['src_names']
+        self.native_depth = meta['native_depth']
+        self.images = meta['images']
+        if index is not None:
+            source_files = [index.sources[abspath(src_dir)]['files'] for src_dir in index.source_dirs]
+            self.images = {img_name: entries for img_name, entries in self.images.items()
+                           if all(source_files[j].get(img_name, [None, None])[:2] == entry['source']
+                                  for j, entry in enumerate(entries))}
+        self.maps = {}
+
+    def __contains__(self, img_name):
+        return img_name in self.images
+
+    def __len__(self):
+        return len(self.images)
+
+    def load(self, img_name):
+        """
+        Returns:
+            list: List of Image, one per source, read only views of the store for single channel sources.
+        """
+        image_group = []
+        for src_name, entry in zip(self.src_names, self.images[img_name]):
+            buffer = memoryview(self.get_map(src_name))
+            shape, mode = entry['shape'], entry['mode']
+            nbytes = int(np.prod(shape)) * np.dtype(entry['dtype']).itemsize
+            data = buffer[entry['offset']:entry['offset'] + nbytes]
+            image_group.append(Image.frombuffer(mode, (shape[1], shape[0]), data, 'raw', mode, 0, 1))
+        return image_group
+
+    def get_map(self, src_name):
+        if src_name not in self.maps:
+            with open(join(self.store_dir, src_name + '.bin'), 'rb') as f:
+                self.maps[src_name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[src_name]
+
+
+def open_store(store_dir, source_dirs, index, native_depth):
+    """
+    Open the store prepared for the sources of a run.
+    Args:
+        store_dir (str): The store directory, '' for none.
+        source_dirs (list): List of source directories.
+        index (index.DatasetIndex): The dataset index of the run.
+        native_depth (bool): The native_depth setting of the run.
+    Returns:
+        PreparedStore: The store, None without store_dir.
+    """
+    if not store_dir:
+        return None
+    store = PreparedStore(store_dir, index)
+    src_names = [src_dir.split('/')[-1] for src_dir in source_dirs]
+    if store.src_names != src_names or store.native_depth != native_depth:
+        raise ValueError(f"{store_dir} holds sources {store.src_names} with native_depth={store.native_depth}, "
+                         f"got sources {src_names} with native_depth={native_depth}")
+    return store
+
+
+def prepare(source_dirs, store_dir, native_depth=False, threads=8, index_path=None):
+    """
+    Decode every image of the dataset index into the store, appending only the images that are new or whose source
+    files changed since the last prepare.
+    Args:
+        source_dirs (list): List of source directories.
+        store_dir (str): The store directory.
+        native_depth (bool): Whether depth maps are kept as native 16-bit images, see DataLoader.load.
+        threads (int): Number of decoding threads.
+        index_path (str): Optional path of the dataset index file.
+    Returns:
+        int: Number of images decoded.
+    """
+    makedirs(store_dir, exist_ok=True)
+    src_names = [src_dir.split('/')[-1] for src_dir in source_dirs]
+    index = DatasetIndex(source_dirs, index_path, threads=threads)
+    meta_path = join(store_dir, 'store.json')
+    images = open_store(store_dir, source_dirs, index, native_depth).images if exists(meta_path) else {}
+    todo = [img_name for img_name in index.img_names if img_name not in images]
+    source_files = [index.sources[abspath(src_dir)]['files'] for src_dir in source_dirs]
+
+    def decode(img_name):
+        image_group = []
+        for src_dir in source_dirs:
+            DataLoader.load(src_dir, img_name, image_group, native_depth)
+        if any(img.mode not in SUPPORTED_MODES for img in image_group):
+            return None
+        return [np.ascontiguousarray(np.asarray(img)) for img in image_group], [img.mode for img in image_group]
+
+    bins = [open(join(store_dir, src_name + '.bin'), 'ab') for src_name in src_names]
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # bounded chunks, decoded images of the whole dataset would not fit in memory
+            for start in range(0, len(todo), threads * 4):
+                chunk = todo[start:start + threads * 4]
+                for img_name, decoded in zip(chunk, executor.map(decode, chunk)):
+                    if decoded is None:
+                        continue
+                    arrays, modes = decoded
+                    entries = []
+                    for j, (f, array, mode) in enumerate(zip(bins, arrays, modes)):
+                        f.write(b'\0' * (-f.tell() % ALIGNMENT))
+                        entries.append(dict(offset=f.tell(), shape=array.shape, dtype=array.dtype.str, mode=mode,
+                                            source=source_files[j][img_name][:2]))
+                        f.write(array.tobytes())
+                    images[img_name] = entries
+                print(f"Prepared {min(start + len(chunk), len(todo))}/{len(todo)} images")
+    finally:
+        for f in bins:
+            f.close()
+        # written on errors too so that the next prepare carries on, blobs of a killed one are just unreferenced
+        tmp_path = f'{meta_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': STORE_VERSION, 'src_names': src_names, 'native_depth': native_depth,
+                       'images': images}, f)
+        os.replace(tmp_path, meta_path)
+    return len(todo)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode the sources once into a memory mapped store.')
+    parser.add_argument('--source-dirs', nargs='+', required=True, help='The source directories.')
+    parser.add_argument('--store-dir', type=str, required=True, help='The store directory, on local disk.')
+    parser.add_argument('--native-depth', action='store_true', help='Whether to keep 16-bit depth maps as single '
+                        'channel 16-bit images, the runs reading the store must use the same setting.')
+    parser.add_argument('--threads', type=int, default=8, help='Number of decoding threads.')
+    args = parser.parse_args()
+    print(f"Decoded {prepare(args.source_dirs, args.store_dir, args.native_depth, args.threads)} images")
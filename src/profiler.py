@@ -0,0 +1,190 @@
+import json
+import random
+import threading
+import time
+from bisect import bisect_left
+
+from transform import Transform
+
+# upper bounds in seconds of the wall time histogram buckets, 10us doubling up to ~40s, the last bucket is open
+BUCKET_BOUNDS = [1e-5 * 2 ** k for k in range(23)]
+
+
+class TimeStats:
+    """Call count, total/min/max and a fixed bucket histogram of wall times."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.buckets[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile."""
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS + [self.max], self.buckets):
+            seen += count
+            if seen >= target and count:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return dict(count=self.count, total=self.total, mean=self.total / max(self.count, 1),
+                    min=self.min if self.count else 0.0, max=self.max, p50=self.quantile(0.5),
+                    p90=self.quantile(0.9), p99=self.quantile(0.99),
+                    histogram=dict(le=BUCKET_BOUNDS + ['inf'], counts=self.buckets))
+
+
+class Profiler:
+    """
+    Collect wall times of the pipeline stages (load, augment, save, per source where it applies) and of every
+    transform call, with the number of instances each transform was called on and actually modified each source
+    of, and the bytes written by each output codec. A numpy backend call covers a whole batch, whose instances all
+    count as modified for a source the call modified, the apply rates are then an upper bound.
+    Recording is a perf_counter pair and a locked dict update, cheap enough to leave on.
+    Args:
+        src_names (list): List of source names, in source_dirs order.
+    """
+    def __init__(self, src_names):
+        self.src_names = src_names
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.transforms = {}
+        self.instances = {}
+        self.applied = {}
+        self.bytes = {}
+
+    def record_stage(self, name, seconds, nbytes=None):
+        """
+        Args:
+            name (str): Stage name.
+            seconds (float): Wall time of the stage.
+            nbytes (int): Optional bytes read or produced by the stage, e.g. by a load/<source> or an
+                  encode/<codec> stage.
+        """
+        with self.lock:
+            self.stages.setdefault(name, TimeStats()).add(seconds)
+            if nbytes is not None:
+                self.bytes[name] = self.bytes.get(name, 0) + nbytes
+
+    def record_transform(self, name, seconds, applied, instances=1):
+        """
+        Args:
+            name (str): Transform type.
+            seconds (float): Wall time of the call.
+            applied (list): Whether the call modified each source, in source_dirs order.
+            instances (int): Number of instances of the call, the batch size of a numpy backend call.
+        """
+        with self.lock:
+            self.transforms.setdefault(name, TimeStats()).add(seconds)
+            self.instances[name] = self.instances.get(name, 0) + instances
+            counts = self.applied.setdefault(name, [0] * len(applied))
+            for j, modified in enumerate(applied):
+                counts[j] += instances * int(modified)
+
+    def wrap(self, transform_pipeline):
+        return [ProfiledTransform(trans_op, self) for trans_op in transform_pipeline]
+
+    def pop_state(self):
+        """Return and clear everything recorded so far, used to ship worker profiles to the main process."""
+        with self.lock:
+            state = (self.stages, self.transforms, self.instances, self.applied, self.bytes)
+            self.stages, self.transforms, self.instances, self.applied, self.bytes = {}, {}, {}, {}, {}
+        return state
+
+    def merge_state(self, state):
+        stages, transforms, instances, applied, nbytes = state
+        with self.lock:
+            for target, source in ((self.stages, stages), (self.transforms, transforms)):
+                for name, stats in source.items():
+                    target.setdefault(name, TimeStats()).merge(stats)
+            for name, count in instances.items():
+                self.instances[name] = self.instances.get(name, 0) + count
+            for name, counts in applied.items():
+                merged = self.applied.setdefault(name, [0] * len(counts))
+                self.applied[name] = [a + b for a, b in zip(merged, counts)]
+            for name, count in nbytes.items():
+                self.bytes[name] = self.bytes.get(name, 0) + count
+
+    def report(self):
+        with self.lock:
+            transforms = {}
+            for name, stats in self.transforms.items():
+                applied = self.applied.get(name, [])
+                instances = self.instances.get(name, stats.count)
+                transforms[name] = dict(stats.to_dict(), instances=instances,
+                                        ms_per_instance=stats.total / max(instances, 1) * 1e3,
+                                        applied=dict(zip(self.src_names, applied)),
+                                        apply_rate={src_name: count / max(instances, 1)
+                                                    for src_name, count in zip(self.src_names, applied)})
+            stages = {}
+            for name, stats in self.stages.items():
+                stages[name] = stats.to_dict()
+                if name in self.bytes:
+                    stages[name].update(bytes=self.bytes[name], mean_bytes=self.bytes[name] / max(stats.count, 1),
+                                        mb_per_s=self.bytes[name] / 2 ** 20 / max(stats.total, 1e-9))
+            return dict(stages=stages, transforms=transforms)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def summary(self):
+        """A plain text table of every stage and transform, sorted by total time."""
+        report = self.report()
+        lines = ['{:<32} {:>8} {:>10} {:>10} {:>10}  {}'.format('name', 'calls', 'total s', 'mean ms', 'p90 ms',
+                                                                  'apply rate')]
+        # the apply rate column holds the bytes per call and bandwidth of the stages recording bytes, load and encode
+        rows = [('stage/' + name, stats, f"{stats['mean_bytes'] / 2 ** 10:.1f} KB/image {stats['mb_per_s']:.1f} MB/s"
+                 if 'bytes' in stats else '') for name, stats in report['stages'].items()]
+        # the apply rates of the transforms are per instance, followed by the time per instance
+        rows += [('transform/' + name, stats,
+                  ' '.join(f'{src}={rate:.2f}' for src, rate in stats['apply_rate'].items()) +
+                  f" {stats['ms_per_instance']:.3f} ms/instance") for name, stats in report['transforms'].items()]
+        for name, stats, rate in sorted(rows, key=lambda row: -row[1]['total']):
+            lines.append('{:<32} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}  {}'.format(
+                name, stats['count'], stats['total'], stats['mean'] * 1e3, stats['p90'] * 1e3, rate))
+        return '\n'.join(lines)
+
+
+class ProfiledTransform(Transform):
+    """
+    Time a transform and record which sources it modified, detected by the identity of the returned images.
+    Args:
+        transform (Transform): The wrapped transform.
+        profiler (Profiler): Where to record.
+    """
+    def __init__(self, transform, profiler):
+        super(ProfiledTransform, self).__init__(transform.config)
+        self.transform = transform
+        self.profiler = profiler
+
+    def __call__(self, data, raw_input_idx, rng=random):
+        start = time.perf_counter()
+        augmented = self.transform(data, raw_input_idx, rng)
+        self.profiler.record_transform(self.config.type, time.perf_counter() - start,
+                                       [out is not img for img, out in zip(data, augmented)])
+        return augmented
+
+    def apply_batch(self, batch, raw_input_idx, rngs=None, out=None):
+        start = time.perf_counter()
+        augmented = self.transform.apply_batch(batch, raw_input_idx, rngs, out)
+        self.profiler.record_transform(self.config.type, time.perf_counter() - start,
+                                       [augmented_images is not images
+                                        for images, augmented_images in zip(batch, augmented)], len(batch[0]))
+        return augmented
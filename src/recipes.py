@@ -0,0 +1,269 @@
+import argparse
+import copy
+import hashlib
+import inspect
+import json
+import numpy as np
+from addict import Dict
+
+from augmentor import Augmentor
+from dataloader import DataLoader, unstack_batch, stack_batch
+from transform import RandomResizedCrop
+
+# the config entries that decide how a recipe is rendered
+RENDER_KEYS = ('pipeline', 'default_pipeline', 'RL_searched_pipeline', 'fuse_geometric', 'fuse_point_ops',
+               'backend', 'tile_size', 'tile_dir')
+
+
+class RecordingRandom:
+    """
+    Forward the draws of the transforms to a random.Random and keep every drawn value, choices as their index,
+    with the name of the parameter it is, '<position>:<transform type>.<draw>', owner being set by sample_params.
+    Args:
+        rng (random.Random): The drawing generator.
+    """
+    def __init__(self, rng):
+        self.rng = rng
+        self.owner = 'pipeline'
+        self.values = []
+        self.names = []
+
+    def record(self, draw, value):
+        self.values.append(value)
+        self.names.append(f'{self.owner}.{draw}')
+        return value
+
+    def random(self):
+        return self.record('random', self.rng.random())
+
+    def uniform(self, a, b):
+        return self.record('uniform', self.rng.uniform(a, b))
+
+    def randint(self, a, b):
+        return self.record('randint', self.rng.randint(a, b))
+
+    def randrange(self, stop):
+        return self.record('randrange', self.rng.randrange(stop))
+
+    def choice(self, seq):
+        # same draw as random.Random.choice
+        return seq[self.randrange(len(seq))]
+
+
+class ReplayRandom:
+    """
+    Hand the values kept by a RecordingRandom back to the transforms, in the same order. With the recorded names,
+    every draw of sample_params is checked to be the recorded parameter, so that a pipeline drawing other
+    parameters than the recorded one fails instead of rendering other variants.
+    Args:
+        values (np.ndarray): The recorded values.
+        names (list): Optional list of the recorded parameter names, one per value.
+    """
+    def __init__(self, values, names=None):
+        self.values = values.tolist()
+        self.names = names
+        self.owner = 'pipeline'
+        self.position = 0
+
+    def next(self, draw):
+        if self.position == len(self.values):
+            raise ValueError(f"The recipe holds {len(self.values)} parameters, {self.owner} draws more")
+        if self.names is not None and self.names[self.position] != f'{self.owner}.{draw}':
+            raise ValueError(f"Expect recorded parameter {self.names[self.position]}, got {self.owner}.{draw}")
+        self.position += 1
+        return self.values[self.position - 1]
+
+    def check_done(self):
+        if self.position != len(self.values):
+            raise ValueError(f"The recipe holds {len(self.values)} parameters, the pipeline draws {self.position}")
+
+    def random(self):
+        return self.next('random')
+
+    def uniform(self, a, b):
+        return self.next('uniform')
+
+    def randint(self, a, b):
+        return int(self.next('randint'))
+
+    def randrange(self, stop):
+        return int(self.next('randrange'))
+
+    def choice(self, seq):
+        return seq[self.randrange(len(seq))]
+
+
+def get_sampling_augmentor(config):
+    """An Augmentor of the unfused, unprofiled pipeline, only used for its parameter sampling."""
+    config = copy.deepcopy(config)
+    config.fuse_geometric = False
+    config.fuse_point_ops = False
+    return Augmentor(config)
+
+
+def get_fingerprint(augmentor):
+    """
+    Digest of the transforms a recipe is rendered with, their configs and the source code of their classes, so that
+    recipes are not rendered by changed transforms.
+    Args:
+        augmentor (Augmentor): See get_sampling_augmentor.
+    Returns:
+        str: The hex digest.
+    """
+    pipelines = augmentor.transform_pipeline if augmentor.config.pipeline == 'RL_searched' else \
+        [augmentor.transform_pipeline]
+    description = [[(trans_op.config.to_dict(), inspect.getsource(type(trans_op))) for trans_op in pipeline]
+                   for pipeline in pipelines]
+    description.append({key: augmentor.config[key] for key in RENDER_KEYS})
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def sample_params(augmentor, image_size, rng):
+    """
+    Draw the parameters of one instance without touching any pixel. The draws are the same, in the same order, as
+    the ones of Augmentor.augment on an image of that size, with or without fused groups.
+    Args:
+        augmentor (Augmentor): See get_sampling_augmentor.
+        image_size tuple (int, int): Image size of (height, width).
+        rng (RecordingRandom): Source of randomness, or a ReplayRandom checking the recorded parameters.
+    """
+    transform_pipeline = augmentor.transform_pipeline
+    rng.owner = 'pipeline'
+    if augmentor.config.pipeline == 'RL_searched':
+        transform_pipeline = rng.choice(transform_pipeline)
+    for i, trans_op in enumerate(transform_pipeline):
+        rng.owner = f'{i}:{trans_op.config.type}'
+        if isinstance(trans_op, RandomResizedCrop):
+            trans_op.get_params(image_size, rng)
+        else:
+            trans_op.get_params(rng)
+
+
+def write_recipes(path, config, src_names, seed, items, image_sizes, rngs):
+    """
+    Record the sampled parameters of every (image, epoch) item in a columnar .npz file, img_name, epoch, image_size,
+    the values of all items concatenated in one float64 column, the name of each value as an index into the
+    parameter names of the meta, and the offsets of each item in them, plus the config needed to render them back
+    and the fingerprint of its transforms, see RecipeRenderer.
+    Args:
+        path (str): The recipe file path.
+        config (addict.Dict): config specs.
+        src_names (list): List of source names, in source_dirs order.
+        seed (int): Run seed.
+        items (list): List of (img_name, epoch).
+        image_sizes (dict): Image name to size of (height, width).
+        rngs (callable): rngs(img_name, epoch), the random.Random of an item.
+    """
+    augmentor = get_sampling_augmentor(config)
+    values = []
+    params = []
+    param_names = {}
+    offsets = [0]
+    for img_name, epoch in items:
+        rng = RecordingRandom(rngs(img_name, epoch))
+        sample_params(augmentor, image_sizes[img_name], rng)
+        values.extend(rng.values)
+        params.extend(param_names.setdefault(name, len(param_names)) for name in rng.names)
+        offsets.append(len(values))
+    meta = dict(src_names=src_names, seed=seed, native_depth=bool(config.data.native_depth),
+                config={key: config[key] for key in RENDER_KEYS}, param_names=list(param_names),
+                fingerprint=get_fingerprint(augmentor))
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, img_name=np.array([img_name for img_name, _ in items], dtype=str),
+                            epoch=np.array([epoch for _, epoch in items], dtype=np.int32),
+                            image_size=np.array([image_sizes[img_name] for img_name, _ in items],
+                                                dtype=np.int32).reshape(-1, 2),
+                            offset=np.array(offsets, dtype=np.int64), value=np.array(values, dtype=np.float64),
+                            param=np.array(params, dtype=np.int32),
+                            meta=np.array(json.dumps(meta)))
+
+
+class RecipeRenderer:
+    """
+    Render the variants recorded by write_recipes from the original sources, the same as augment.py would have
+    saved them with the same config and seed. Recipes whose transform fingerprint differs from the one of the
+    current transforms are refused, and the parameters drawn by every render are checked against the recorded ones.
+    Args:
+        path (str): The recipe file path.
+        source_dirs (list): List of source directories, in the recorded source order.
+    """
+    def __init__(self, path, source_dirs):
+        with np.load(path) as recipes:
+            if 'param' not in recipes:
+                raise ValueError(f"{path} holds no parameter names, it was recorded by an earlier version, record "
+                                 f"it again")
+            self.img_names = recipes['img_name'].tolist()
+            self.epochs = recipes['epoch'].tolist()
+            self.image_sizes = recipes['image_size']
+            self.offsets = recipes['offset']
+            self.values = recipes['value']
+            self.params = recipes['param']
+            meta = json.loads(recipes['meta'].item())
+        self.src_names = meta['src_names']
+        self.native_depth = meta['native_depth']
+        self.seed = meta['seed']
+        src_names = [src_dir.split('/')[-1] for src_dir in source_dirs]
+        if src_names != self.src_names:
+            raise ValueError(f"Expect sources {self.src_names}, got {src_names}")
+        self.source_dirs = source_dirs
+        self.raw_input_idx = src_names.index('rgb') if 'rgb' in src_names else -1
+        self.config = Dict(meta['config'])
+        self.sampler = get_sampling_augmentor(self.config)
+        fingerprint = get_fingerprint(self.sampler)
+        if meta.get('fingerprint') != fingerprint:
+            raise ValueError(f"{path} was recorded with other transforms, fingerprint {meta.get('fingerprint')}, "
+                             f"the current ones are {fingerprint}. Render it with the code that recorded it")
+        self.param_names = meta['param_names']
+        self.augmentor = Augmentor(self.config)
+        self.positions = {(img_name, epoch): i for i, (img_name, epoch) in enumerate(zip(self.img_names, self.epochs))}
+        # the decoded sources of the last image, epochs of an image are usually rendered one after the other
+        self.last_group = (None, None)
+
+    def __len__(self):
+        return len(self.img_names)
+
+    def keys(self):
+        return list(zip(self.img_names, self.epochs))
+
+    def get(self, img_name, epoch):
+        return self.render(self.positions[(img_name, epoch)])
+
+    def render(self, i):
+        """
+        Args:
+            i (int): Recipe position.
+        Returns:
+            list: List of Image, one per source.
+        """
+        img_name = self.img_names[i]
+        if self.last_group[0] != img_name:
+            image_group = []
+            for src_dir in self.source_dirs:
+                DataLoader.load(src_dir, img_name, image_group, self.native_depth)
+            self.last_group = (img_name, image_group)
+        image_group = self.last_group[1]
+        if (image_group[0].height, image_group[0].width) != tuple(self.image_sizes[i]):
+            raise ValueError(f"{img_name} is not of the recorded size {tuple(self.image_sizes[i])}")
+        values = self.values[self.offsets[i]:self.offsets[i + 1]]
+        # the pipeline must draw the recorded parameters, in the recorded order
+        rng = ReplayRandom(values, [self.param_names[j] for j in self.params[self.offsets[i]:self.offsets[i + 1]]])
+        sample_params(self.sampler, tuple(self.image_sizes[i]), rng)
+        rng.check_done()
+        rngs = [ReplayRandom(values)]
+        if self.config.backend == 'numpy':
+            return unstack_batch(self.augmentor.augment(stack_batch([image_group]), self.raw_input_idx, rngs))[0]
+        return self.augmentor.augment([image_group], self.raw_input_idx, rngs)[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render recorded recipes into the augment.py output layout.')
+    parser.add_argument('--recipes', type=str, required=True, help='The recipe file path.')
+    parser.add_argument('--source-dirs', nargs='+', required=True, help='The original source directories.')
+    parser.add_argument('--output-dir', type=str, required=True, help='The output directory path.')
+    args = parser.parse_args()
+    # imported here to avoid a circular import, augment imports this module
+    from augment import save_results
+    renderer = RecipeRenderer(args.recipes, args.source_dirs)
+    for i, (img_name, epoch) in enumerate(renderer.keys()):
+        save_results(renderer.src_names, [img_name], [renderer.render(i)], epoch, args.output_dir)
+    print(f"Rendered {len(renderer)} variants to {args.output_dir}")
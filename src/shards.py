@@ -0,0 +1,208 @@
+import io
+import json
+import mmap
+import time
+from glob import glob
+from os.path import basename, exists, join
+import numpy as np
+from PIL import Image
+
+from encoders import get_codec
+from writer import AsyncWriter
+
+# every blob starts on a page boundary, so raw arrays can be mapped without copying
+ALIGNMENT = 4096
+
+
+class ShardWriter(AsyncWriter):
+    """
+    Pack augmented image groups into large append-only shard files instead of one file per image per epoch.
+    A record holds every source of one (image, epoch), each blob is either an encoded PNG or the raw array bytes.
+    Records are described by one JSON line each in the index file next to the shard, output_dir/<prefix>NNNNN.bin
+    and output_dir/<prefix>NNNNN.index.jsonl, both flushed after every record. A shard is closed and the next
+    one opened once it exceeds shard_bytes. Encoding runs on the AsyncWriter threads, appending is serialised.
+    Args:
+        src_names (list): List of source names, in source_dirs order.
+        output_dir (str): The output directory path.
+        threads (int): Number of encoder threads.
+        max_backlog (int): Maximum number of image groups queued or being encoded.
+        encoding (str): 'png', PNG at compress level 1 through encoders.get_codec, or 'raw'.
+        shard_bytes (int): Size after which a new shard is started.
+        prefix (str): Shard file name prefix, distinct for every process writing to the same output_dir.
+        profiler (profiler.Profiler): Optional profiler, records a save/<source> stage per encoded image.
+        manifest (manifest.RunManifest): Optional run manifest, every image group is marked done once appended.
+        dedup (writer.OutputDedup): Optional, an unchanged source identical to one already appended is recorded as a
+              reference to its blob, with the shard of that blob, instead of being encoded and appended again.
+    """
+    def __init__(self, src_names, output_dir, threads=4, max_backlog=16, encoding='png', shard_bytes=2 ** 30,
+                 prefix='shard-', profiler=None, manifest=None, dedup=None):
+        super(ShardWriter, self).__init__(src_names, output_dir, threads, max_backlog, profiler, manifest,
+                                          dedup=dedup)
+        if encoding not in ('png', 'raw'):
+            raise ValueError(f"Expect shard encodings: (png, raw), got {encoding}")
+        self.encoding = encoding
+        self.codec = get_codec(encoding) if encoding == 'png' else None
+        self.shard_bytes = shard_bytes
+        self.prefix = prefix
+        self.shard_idx = -1
+        self.shard_file = None
+        self.index_file = None
+        meta_path = join(output_dir, 'shards.json')
+        if not exists(meta_path):
+            with open(meta_path, 'w') as f:
+                json.dump({'src_names': src_names, 'encoding': encoding, 'alignment': ALIGNMENT}, f)
+
+    def save_group(self, img_name, image_group, epoch, modified=None):
+        modified = modified or [True] * len(image_group)
+        blobs = []
+        digests = []
+        for src_name, img, is_modified in zip(self.src_names, image_group, modified):
+            start = time.perf_counter()
+            digest = None
+            if self.dedup is not None and not is_modified:
+                digest = self.dedup.get_digest(img, self.codec.spec if self.codec is not None else self.encoding)
+            # entries are only ever added, a source found here is a reference in append as well
+            blob = None
+            if digest not in self.dedup_entries():
+                encode_start = time.perf_counter()
+                blob = self.encode(img)
+                if self.profiler is not None:
+                    self.profiler.record_stage('encode/shard-' + self.encoding, time.perf_counter() - encode_start,
+                                               len(blob))
+            blobs.append(blob)
+            digests.append(digest)
+            if self.profiler is not None:
+                self.profiler.record_stage('save/' + src_name, time.perf_counter() - start)
+        with self.lock:
+            referenced = self.append(img_name, epoch, image_group, blobs, digests)
+        if self.dedup is not None:
+            for src_name, is_referenced in zip(self.src_names, referenced):
+                self.dedup.count(src_name, is_referenced)
+        if self.manifest is not None:
+            self.manifest.mark_done(img_name, epoch)
+
+    def dedup_entries(self):
+        return self.dedup.entries if self.dedup is not None else {}
+
+    def encode(self, img):
+        if self.codec is None:
+            return np.ascontiguousarray(np.asarray(img)).tobytes()
+        return self.codec.encode(img)
+
+    def append(self, img_name, epoch, image_group, blobs, digests):
+        if self.shard_file is None or self.shard_file.tell() >= self.shard_bytes:
+            self.next_shard()
+        sources = []
+        referenced = []
+        entries = self.dedup_entries()
+        for img, blob, digest in zip(image_group, blobs, digests):
+            referenced.append(digest in entries)
+            if referenced[-1]:
+                sources.append(entries[digest])
+                continue
+            offset = self.shard_file.tell()
+            self.shard_file.write(blob)
+            self.shard_file.write(b'\0' * (-len(blob) % ALIGNMENT))
+            array = np.asarray(img) if self.encoding == 'raw' else None
+            sources.append(dict(offset=offset, length=len(blob), mode=img.mode, size=img.size,
+                                dtype=array.dtype.str if array is not None else None,
+                                shape=array.shape if array is not None else None))
+            if digest is not None:
+                entries[digest] = dict(sources[-1], shard=basename(self.shard_file.name))
+        self.shard_file.flush()
+        record = dict(img_name=img_name, epoch=epoch, shard=basename(self.shard_file.name), sources=sources)
+        self.index_file.write(json.dumps(record) + '\n')
+        self.index_file.flush()
+        return referenced
+
+    def next_shard(self):
+        self.close_shard()
+        self.shard_idx += 1
+        # never append to a shard left by an earlier run with the same prefix
+        while exists(join(self.output_dir, f'{self.prefix}{self.shard_idx:05d}.bin')):
+            self.shard_idx += 1
+        shard_name = f'{self.prefix}{self.shard_idx:05d}'
+        self.shard_file = open(join(self.output_dir, shard_name + '.bin'), 'wb')
+        self.index_file = open(join(self.output_dir, shard_name + '.index.jsonl'), 'w')
+
+    def close_shard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.index_file.close()
+            self.shard_file = None
+            self.index_file = None
+
+    def close(self):
+        try:
+            super(ShardWriter, self).close()
+        finally:
+            with self.lock:
+                self.close_shard()
+
+
+class ShardReader:
+    """
+    Random access and streaming over the records written by ShardWriter.
+    Args:
+        shard_dir (str): The directory holding the shards and their index files.
+    """
+    def __init__(self, shard_dir):
+        with open(join(shard_dir, 'shards.json')) as f:
+            meta = json.load(f)
+        self.shard_dir = shard_dir
+        self.src_names = meta['src_names']
+        self.encoding = meta['encoding']
+        self.records = []
+        for index_path in sorted(glob(join(shard_dir, '*.index.jsonl'))):
+            with open(index_path) as f:
+                # a trailing partial line is a record whose write was interrupted
+                self.records.extend(json.loads(line) for line in f if line.endswith('\n'))
+        self.positions = {(record['img_name'], record['epoch']): i for i, record in enumerate(self.records)}
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def keys(self):
+        return [(record['img_name'], record['epoch']) for record in self.records]
+
+    def __iter__(self):
+        # shard and offset order, i.e. sequential reads
+        for i in range(len(self.records)):
+            yield self.read(i)
+
+    def get(self, img_name, epoch, as_array=False):
+        return self.read(self.positions[(img_name, epoch)], as_array)[2]
+
+    def read(self, i, as_array=False):
+        """
+        Args:
+            i (int): Record position.
+            as_array (bool): Whether to return np.ndarray instead of Image. Raw records are then views of the
+                  mapped shard, without any copy.
+        Returns:
+            tuple: (img_name, epoch, list of Image or np.ndarray in src_names order).
+        """
+        record = self.records[i]
+        images = []
+        for source in record['sources']:
+            # a deduplicated source points at the blob of an earlier record, possibly in another shard
+            buffer = self.get_map(source.get('shard', record['shard']))
+            offset, length = source['offset'], source['length']
+            if self.encoding == 'raw':
+                array = np.frombuffer(buffer, dtype=np.dtype(source['dtype']), count=int(np.prod(source['shape'])),
+                                      offset=offset).reshape(source['shape'])
+                images.append(array if as_array else Image.fromarray(array.copy(), source['mode']))
+            else:
+                img = Image.open(io.BytesIO(buffer[offset:offset + length]))
+                images.append(np.asarray(img) if as_array else img)
+        return record['img_name'], record['epoch'], images
+
+    def get_map(self, shard):
+        if shard not in self.maps:
+            with open(join(self.shard_dir, shard), 'rb') as f:
+                self.maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[shard]
+
+    def close(self):
+        self.maps.clear()
@@ -0,0 +1,120 @@
+import itertools
+import random
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import Value
+import numpy as np
+
+from augmentor import Augmentor, get_item_rng
+from dataloader import DataLoader
+from index import DatasetIndex
+from parallel import SharedImageGroup, init_worker, stream_item
+from prepared import open_store
+
+
+class AugmentationStream:
+    """
+    Augmented multi-source samples served from memory to a training loop, nothing is written to disk.
+    Iterating yields (img_name, epoch, arrays) tuples, arrays holding one np.ndarray per source, (H, W, C) or (H, W)
+    for single channel sources, epoch after epoch, endlessly when epochs is None. Given the same seed, the samples
+    are the same as the outputs of augment.py.
+    With a single worker, batches are read by the DataLoader prefetch threads and augmented in this process. With more,
+    image groups are read here and augmented by a pool of worker processes through shared memory, with up to
+    prefetch * workers items in flight. Samples are yielded in loading order either way.
+
+    Args:
+        config (addict.Dict): config specs.
+        source_dirs (list): List of source directories, ['./data/rgb', './data/depth', ...]
+        img_names (list): List of image names, every image of the dataset index by default.
+        epochs (int): Number of epochs, None for an endless stream.
+        workers (int): Number of worker processes, 1 augments in this process.
+        prefetch (int): Batches read ahead with a single worker, items in flight per worker process otherwise.
+        seed (int): Run seed, config.seed by default. None draws one.
+        profiler (profiler.Profiler): Optional profiler.
+    """
+    def __init__(self, config, source_dirs, img_names=None, epochs=None, workers=1, prefetch=2, seed=None,
+                 profiler=None):
+        self.config = config
+        self.source_dirs = source_dirs
+        self.src_names = [src_dir.split('/')[-1] for src_dir in source_dirs]
+        self.raw_input_idx = self.src_names.index('rgb') if 'rgb' in self.src_names else -1
+        index = DatasetIndex(source_dirs, config.data.index_path, threads=config.data.io_threads)
+        self.img_names = list(img_names if img_names is not None else index.img_names)
+        self.image_sizes = index.get_sizes()
+        self.store = open_store(config.data.prepared_dir, source_dirs, index, config.data.native_depth)
+        self.epochs = epochs
+        self.workers = workers
+        self.prefetch = prefetch
+        if seed is None:
+            seed = config.seed if config.seed is not None else random.SystemRandom().randrange(2 ** 32)
+        self.seed = seed
+        self.profiler = profiler
+
+    def __iter__(self):
+        epochs = itertools.count() if self.epochs is None else range(self.epochs)
+        if self.workers > 1:
+            return self.iterate_parallel(epochs)
+        return self.iterate(epochs)
+
+    def build_dataloader(self, backend, prefetch):
+        return DataLoader(self.source_dirs, list(self.img_names), batch_size=self.config.data.batch_size,
+                          backend=backend, prefetch=prefetch, io_threads=self.config.data.io_threads,
+                          cache_bytes=self.config.data.cache_mb * 2 ** 20, native_depth=self.config.data.native_depth,
+                          profiler=self.profiler, image_sizes=self.image_sizes, store=self.store)
+
+    def iterate(self, epochs):
+        augmentor = Augmentor(self.config, self.profiler)
+        dataloader = self.build_dataloader(self.config.backend, self.prefetch)
+        try:
+            for epoch in epochs:
+                if self.config.data.shuffle_load:
+                    dataloader.shuffle()
+                for img_names, batch in dataloader:
+                    rngs = [get_item_rng(self.seed, img_name, epoch) for img_name in img_names]
+                    augmented = augmentor.augment(batch, self.raw_input_idx, rngs)
+                    for n, img_name in enumerate(img_names):
+                        if self.config.backend == 'numpy':
+                            arrays = [images[n] if images.shape[3] > 1 else images[n, ..., 0] for images in augmented]
+                        else:
+                            arrays = [np.asarray(img) for img in augmented[n]]
+                        yield img_name, epoch, arrays
+        finally:
+            dataloader.close()
+
+    def iterate_parallel(self, epochs):
+        # the loader threads only decode, augmentation runs in the workers
+        dataloader = self.build_dataloader('pil', max(self.prefetch, 1))
+        max_in_flight = self.prefetch * self.workers
+        in_flight = deque()
+        initargs = (self.config, self.src_names, self.raw_input_idx, self.seed, Value('i', 0), False)
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, initargs=initargs) as executor:
+            try:
+                for epoch in epochs:
+                    if self.config.data.shuffle_load:
+                        dataloader.shuffle()
+                    for img_names, batch in dataloader:
+                        for img_name, image_group in zip(img_names, batch):
+                            group = SharedImageGroup(image_group)
+                            future = executor.submit(stream_item, group.handle, img_name, epoch)
+                            in_flight.append((img_name, epoch, group, future))
+                            while len(in_flight) >= max(max_in_flight, 1):
+                                yield self.collect(in_flight.popleft())
+                while in_flight:
+                    yield self.collect(in_flight.popleft())
+            finally:
+                dataloader.close()
+                for _, _, _, future in in_flight:
+                    future.cancel()
+                wait([future for _, _, _, future in in_flight])
+                for _, _, group, _ in in_flight:
+                    group.release()
+
+    def collect(self, entry):
+        img_name, epoch, group, future = entry
+        try:
+            arrays, profile = future.result()
+        finally:
+            group.release()
+        if profile is not None and self.profiler is not None:
+            self.profiler.merge_state(profile)
+        return img_name, epoch, arrays
@@ -0,0 +1,235 @@
+import mmap
+import tempfile
+import time
+import numpy as np
+
+from profiler import ProfiledTransform
+from transform import AffineGroup, Color, GeometricTransform, PointOpGroup, PointTransform, RandomResizedCrop, \
+    Sharpness, get_shift, get_source_coords
+
+
+class TileBuffer:
+    """
+    An (H, W, C) array backed by an unlinked temporary file instead of memory, whose resident pages can be dropped
+    at any time, their content stays in the file.
+    Args:
+        shape (tuple): Array shape.
+        dtype (np.dtype): Array dtype.
+        work_dir (str): Directory of the temporary file, the system default if empty.
+    """
+    def __init__(self, shape, dtype, work_dir=None):
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.file = tempfile.TemporaryFile(dir=work_dir or None)
+        self.file.truncate(nbytes)
+        self.map = mmap.mmap(self.file.fileno(), nbytes)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.map)
+
+    def release(self):
+        if hasattr(mmap, 'MADV_DONTNEED'):
+            self.map.madvise(mmap.MADV_DONTNEED)
+
+
+class TiledExecutor:
+    """
+    Out-of-core execution of a pipeline over one image group, for images too large to keep several decoded copies
+    of in memory. Every transform is evaluated tile by tile, each output tile reading only the region of the source
+    it samples from: the inverse warp of the tile for geometric transforms, its rows and columns of the resize for
+    RandomResizedCrop and a one pixel margin for Sharpness. The lookup tables of AutoContrast and Equalize need the
+    histogram of the whole image, which a first streaming pass over the tiles computes.
+    Like augmentor.BufferPool, the intermediate images of every source alternate between two TileBuffers, kept on
+    disk rather than in memory and reused from image to image while the size does not change. Their pages are
+    dropped after every tile, so that the intermediate images only take memory in proportion to the tile size. The
+    decoded sources and the results are still full frames in memory, decoding and encoding are not tiled.
+    The parameters are sampled as by the numpy backend and the results are the same as its kernels.
+    Args:
+        tile_size (int): Height and width of the tiles.
+        work_dir (str): Directory of the tile buffers, on local disk, the system temporary directory if empty.
+    """
+    def __init__(self, tile_size=512, work_dir=None):
+        self.tile_size = tile_size
+        self.work_dir = work_dir
+        self.buffers = {}
+
+    def get_buffers(self, j, array):
+        pair = self.buffers.get(j)
+        if pair is None or pair[0].array.shape != array.shape or pair[0].array.dtype != array.dtype:
+            pair = tuple(TileBuffer(array.shape, array.dtype, self.work_dir) for _ in range(2))
+            self.buffers[j] = pair
+        return pair
+
+    def get_tiles(self, height, width):
+        for y0 in range(0, height, self.tile_size):
+            for x0 in range(0, width, self.tile_size):
+                yield y0, min(y0 + self.tile_size, height), x0, min(x0 + self.tile_size, width)
+
+    def release(self):
+        for pair in self.buffers.values():
+            for buffer in pair:
+                buffer.release()
+
+    def run(self, transform_pipeline, arrays, raw_input_idx, rng):
+        """
+        Args:
+            transform_pipeline (list): List of Transform.
+            arrays (list): List of np.ndarray, one (H, W, C) array per source, left untouched.
+            raw_input_idx (int): The index of the rgb input. -1 means rgb not existed.
+            rng (random.Random): Source of randomness of the instance.
+        Returns:
+            list: List of np.ndarray, one (H, W, C) array per source, copied out of the tile buffers.
+        """
+        buffers = [self.get_buffers(j, array) for j, array in enumerate(arrays)]
+        # which buffer of each source holds its current image, None for the input
+        current = [None] * len(arrays)
+        for trans_op in transform_pipeline:
+            out = [(pair[1] if k == 0 else pair[0]).array for pair, k in zip(buffers, current)]
+            augmented = self.apply(trans_op, arrays, raw_input_idx, rng, out)
+            for j, array in enumerate(augmented):
+                if array is out[j]:
+                    current[j] = 1 if current[j] == 0 else 0
+            arrays = augmented
+        results = [np.array(array) if k is not None else array for array, k in zip(arrays, current)]
+        self.release()
+        return results
+
+    def apply(self, trans_op, arrays, raw_input_idx, rng, out):
+        profiled = isinstance(trans_op, ProfiledTransform)
+        op = trans_op.transform if profiled else trans_op
+        start = time.perf_counter()
+        if isinstance(op, (GeometricTransform, AffineGroup)):
+            augmented = self.warp(op, arrays, rng, out)
+        elif isinstance(op, (PointTransform, PointOpGroup)):
+            augmented = self.map_points(op, arrays, raw_input_idx, rng, out)
+        elif isinstance(op, Color):
+            augmented = self.blend(op, arrays, raw_input_idx, rng, out)
+        elif isinstance(op, Sharpness):
+            augmented = self.sharpen(op, arrays, raw_input_idx, rng, out)
+        elif isinstance(op, RandomResizedCrop):
+            augmented = self.resized_crop(op, arrays, rng, out)
+        else:
+            raise TypeError(f"{op.config.type} has no tiled kernel")
+        if profiled:
+            trans_op.profiler.record_transform(op.config.type, time.perf_counter() - start,
+                                               [result is not array for array, result in zip(arrays, augmented)])
+        return augmented
+
+    def warp(self, op, arrays, rng, out):
+        if isinstance(op, AffineGroup):
+            applied = []
+            for trans_op in op.transforms:
+                prob, value = trans_op.get_params(rng)
+                if prob < trans_op.apply_prob:
+                    applied.append((trans_op, value))
+            if not applied:
+                return arrays
+            get_matrix = lambda size: AffineGroup.get_matrix(size, applied)
+        else:
+            prob, value = op.get_params(rng)
+            if prob >= op.apply_prob:
+                return arrays
+            get_matrix = lambda size: op.get_matrix(size, value)
+
+        augmented = []
+        for array, warped in zip(arrays, out):
+            height, width = array.shape[:2]
+            matrix = get_matrix((width, height))
+            shift = get_shift(matrix)
+            for y0, y1, x0, x1 in self.get_tiles(height, width):
+                if shift is not None:
+                    src_x, src_y = np.meshgrid(np.arange(x0, x1) + shift[0], np.arange(y0, y1) + shift[1])
+                else:
+                    xs = np.arange(x0, x1, dtype=np.float32)[None, :] + 0.5
+                    ys = np.arange(y0, y1, dtype=np.float32)[:, None] + 0.5
+                    src_x, src_y = get_source_coords(matrix, xs, ys)
+                inside = (src_x >= 0) & (src_x < width) & (src_y >= 0) & (src_y < height)
+                tile = warped[y0:y1, x0:x1]
+                if inside.any():
+                    # the bounding box of the pixels sampled inside the source
+                    top, bottom = np.where(inside, src_y, height).min(), np.where(inside, src_y, -1).max() + 1
+                    left, right = np.where(inside, src_x, width).min(), np.where(inside, src_x, -1).max() + 1
+                    region = np.ascontiguousarray(array[top:bottom, left:right]).reshape(-1, array.shape[2])
+                    index = np.where(inside, (src_y - top) * (right - left) + src_x - left, 0)
+                    tile[...] = np.take(region, index.ravel(), axis=0).reshape(tile.shape)
+                    tile[~inside] = 0
+                else:
+                    tile[...] = 0
+                self.release()
+            augmented.append(warped)
+        return augmented
+
+    def map_points(self, op, arrays, raw_input_idx, rng, out):
+        transforms = op.transforms if isinstance(op, PointOpGroup) else [op]
+        params = [trans_op.get_params(rng) for trans_op in transforms]
+        augmented = []
+        for i, (array, mapped) in enumerate(zip(arrays, out)):
+            applied = [(trans_op, value) for trans_op, (prob, value) in zip(transforms, params)
+                       if (trans_op.apply_all or i == raw_input_idx) and prob < trans_op.apply_prob]
+            if not applied or array.dtype != np.uint8:
+                augmented.append(array)
+                continue
+            height, width, channels = array.shape
+            histogram = np.zeros((channels, 256), dtype=np.int64)
+            if any(trans_op.needs_histogram for trans_op, _ in applied):
+                # first pass, the statistics of the whole image
+                for y0, y1, x0, x1 in self.get_tiles(height, width):
+                    tile = array[y0:y1, x0:x1]
+                    histogram += np.stack([np.bincount(tile[..., c].ravel(), minlength=256) for c in range(channels)])
+                    self.release()
+            lut = PointOpGroup.get_lut(histogram, applied).astype(np.uint8)
+            for y0, y1, x0, x1 in self.get_tiles(height, width):
+                tile = array[y0:y1, x0:x1]
+                if (lut == lut[0]).all():
+                    mapped[y0:y1, x0:x1] = lut[0][tile]
+                else:
+                    for c in range(channels):
+                        mapped[y0:y1, x0:x1, c] = lut[c][tile[..., c]]
+                self.release()
+            augmented.append(mapped)
+        return augmented
+
+    def blend(self, op, arrays, raw_input_idx, rng, out):
+        prob, value = op.get_params(rng)
+        augmented = []
+        for i, (array, blended) in enumerate(zip(arrays, out)):
+            if prob >= op.apply_prob or not (op.apply_all or i == raw_input_idx) or array.shape[2] != 3 or \
+                    array.dtype != np.uint8:
+                augmented.append(array)
+                continue
+            for y0, y1, x0, x1 in self.get_tiles(*array.shape[:2]):
+                blended[y0:y1, x0:x1] = Color.blend(array[y0:y1, x0:x1], value)
+                self.release()
+            augmented.append(blended)
+        return augmented
+
+    def sharpen(self, op, arrays, raw_input_idx, rng, out):
+        prob, value = op.get_params(rng)
+        augmented = []
+        for i, (array, sharpened) in enumerate(zip(arrays, out)):
+            if prob >= op.apply_prob or not (op.apply_all or i == raw_input_idx) or array.dtype != np.uint8:
+                augmented.append(array)
+                continue
+            height, width = array.shape[:2]
+            for y0, y1, x0, x1 in self.get_tiles(height, width):
+                top, left = max(y0 - 1, 0), max(x0 - 1, 0)
+                region = array[top:min(y1 + 1, height), left:min(x1 + 1, width)]
+                sharpened[y0:y1, x0:x1] = Sharpness.sharpen(region, value)[y0 - top:y1 - top, x0 - left:x1 - left]
+                self.release()
+            augmented.append(sharpened)
+        return augmented
+
+    def resized_crop(self, op, arrays, rng, out):
+        height, width = arrays[0].shape[:2]
+        resized, pad, box = op.get_params((height, width), rng)
+        rows = op.get_sample_coords(height, resized[0], pad[1], box[1])
+        cols = op.get_sample_coords(width, resized[1], pad[0], box[0])
+        augmented = []
+        for array, resampled in zip(arrays, out):
+            for y0, y1, x0, x1 in self.get_tiles(height, width):
+                lower_y, upper_y, wy, valid_y = [coords[y0:y1] for coords in rows]
+                lower_x, upper_x, wx, valid_x = [coords[x0:x1] for coords in cols]
+                top, left = lower_y.min(), lower_x.min()
+                region = array[top:upper_y.max() + 1, left:upper_x.max() + 1]
+                resampled[y0:y1, x0:x1] = RandomResizedCrop.resample(
+                    region, (lower_y - top, upper_y - top, wy, valid_y), (lower_x - left, upper_x - left, wx, valid_x))
+                self.release()
+            augmented.append(resampled)
+        return augmented
@@ -1,3 +1,5 @@
+import functools
+import math
 import random
 from addict import Dict
 import numpy as np
@@ -7,32 +9,93 @@ from PIL import Image, ImageOps, ImageEnhance
 class Transform:
     """
     Base class for transform operations.
+    Deterministic transforms have no sampled magnitude, only their apply roll, so that their result only depends on
+    the input. With a memo set, see augmentor.TransformMemo, the pil backend serves their results from it.
+    Involutions are deterministic transforms that give the input back when applied twice.
     """
+    deterministic = False
+    involution = False
+    memo = None
+
     def __init__(self, config):
         self.config = config
 
-    def __call__(self, data, raw_input_idx):
+    def __call__(self, data, raw_input_idx, rng=random):
         """
         Args:
             data (list): List of list. The inner list contains the different sources, Images, for one instance.
                   The sequence of the inner list follows the given source_dirs.
             raw_input_idx (int): The index of the rgb input. -1 means rgb not existed.
+            rng (random.Random): Source of the sampled parameters, the global random module by default.
         Returns:
             list: List of Image, the sequence of the Images is determined by the input source directories sequence.
         """
         raise RuntimeError("Illegal call to base class.")
 
+    def apply_batch(self, batch, raw_input_idx, rngs=None, out=None):
+        """
+        Vectorised kernel of the numpy backend, parameters are sampled independently for every instance.
+        Sources the transform leaves untouched are returned as is, the input arrays are never modified.
+        Args:
+            batch (list): List of np.ndarray, one (N, H, W, C) uint8 array per source.
+                  The sequence of the list follows the given source_dirs.
+            raw_input_idx (int): The index of the rgb input. -1 means rgb not existed.
+            rngs (list): Optional list of random.Random, the source of the parameters of each instance.
+            out (list): Optional list of np.ndarray, one preallocated array per source shaped like batch, distinct
+                 from it. Modified sources are written into it instead of newly allocated arrays, see
+                 augmentor.BufferPool.
+        Returns:
+            list: List of np.ndarray, one (N, H, W, C) uint8 array per source.
+        """
+        raise RuntimeError("Illegal call to base class.")
+
+    def apply_memoized(self, img, value):
+        """apply_image of a deterministic transform, through the memo if one is set."""
+        if self.memo is None:
+            return self.apply_image(img, value)
+        return self.memo.apply(self, img, value)
+
+
+class GeometricTransform(Transform):
+    """
+    Base class for geometric operations that can be expressed as an affine warp.
+    Subclasses sample their parameters in get_params() and describe themselves with get_matrix(),
+    which lets neighbouring geometric operations be fused into a single warp, see AffineGroup.
+    """
+    def get_params(self, rng=random):
+        """
+        Args:
+            rng (random.Random): Source of randomness.
+        Returns:
+            tuple: (prob, value), the apply probability roll and the sampled magnitude (None if not used).
+        """
+        raise RuntimeError("Illegal call to base class.")
+
+    def get_matrix(self, size, value):
+        """
+        Args:
+            size tuple (int, int): Image size of (width, height).
+            value (float): The sampled magnitude.
+        Returns:
+            np.ndarray: 3x3 inverse affine matrix, mapping output coordinates to input coordinates.
+        """
+        raise RuntimeError("Illegal call to base class.")
+
+    def apply_batch(self, batch, raw_input_idx, rngs=None, out=None):
+        params = [self.get_params(rng) for rng in get_rngs(rngs, len(batch[0]))]
+        idx = [n for n, (prob, _) in enumerate(params) if prob < self.apply_prob]
+        return warp_affine_batch(batch, idx, lambda size, n: self.get_matrix(size, params[n][1]), out)
 
-class Rotate(Transform):
+
+class Rotate(GeometricTransform):
     def __init__(self, config):
         super(Rotate, self).__init__(config)
         self.apply_prob = config.apply_prob
         self.value_range = config.value_range
-        self.gen_rand_value = lambda: random.uniform(self.value_range[0], self.value_range[1])
+        self.gen_rand_value = lambda rng: rng.uniform(self.value_range[0], self.value_range[1])
 
-    def __call__(self, data, _):
-        prob = random.random()
-        value = self.gen_rand_value()
+    def __call__(self, data, _, rng=random):
+        prob, value = self.get_params(rng)
         augmented = []
         for img in data:
             if prob < self.apply_prob:
@@ -42,17 +105,31 @@ class Rotate(Transform):
                 augmented.append(img)
         return augmented
 
+    def get_params(self, rng=random):
+        prob = rng.random()
+        value = self.gen_rand_value(rng)
+        return prob, value
+
+    def get_matrix(self, size, value):
+        # same matrix as Image.rotate builds, counter clockwise around the image center
+        width, height = size
+        center_x, center_y = width / 2.0, height / 2.0
+        angle = -math.radians(value)
+        cos, sin = round(math.cos(angle), 15), round(math.sin(angle), 15)
+        return np.array([[cos, sin, center_x - cos * center_x - sin * center_y],
+                         [-sin, cos, center_y + sin * center_x - cos * center_y],
+                         [0, 0, 1]])
 
-class ShearX(Transform):
+
+class ShearX(GeometricTransform):
     def __init__(self, config):
         super(ShearX, self).__init__(config)
         self.apply_prob = config.apply_prob
         self.value_range = config.value_range
-        self.gen_rand_value = lambda: random.uniform(self.value_range[0], self.value_range[1])
+        self.gen_rand_value = lambda rng: rng.uniform(self.value_range[0], self.value_range[1])
 
-    def __call__(self, data, _):
-        prob = random.random()
-        value = self.gen_rand_value()
+    def __call__(self, data, _, rng=random):
+        prob, value = self.get_params(rng)
         augmented = []
         for i, img in enumerate(data):
             if prob < self.apply_prob:
@@ -62,17 +139,24 @@ class ShearX(Transform):
                 augmented.append(img)
         return augmented
 
+    def get_params(self, rng=random):
+        prob = rng.random()
+        value = self.gen_rand_value(rng)
+        return prob, value
+
+    def get_matrix(self, size, value):
+        return np.array([[1, value, 0], [0, 1, 0], [0, 0, 1]], dtype=np.float64)
 
-class ShearY(Transform):
+
+class ShearY(GeometricTransform):
     def __init__(self, config):
         super(ShearY, self).__init__(config)
         self.apply_prob = config.apply_prob
         self.value_range = config.value_range
-        self.gen_rand_value = lambda: random.uniform(self.value_range[0], self.value_range[1])
+        self.gen_rand_value = lambda rng: rng.uniform(self.value_range[0], self.value_range[1])
 
-    def __call__(self, data, raw_input_idx):
-        prob = random.random()
-        value = self.gen_rand_value()
+    def __call__(self, data, raw_input_idx, rng=random):
+        prob, value = self.get_params(rng)
         augmented = []
         for i, img in enumerate(data):
             if prob < self.apply_prob:
@@ -81,17 +165,24 @@ class ShearY(Transform):
                 augmented.append(img)
         return augmented
 
+    def get_params(self, rng=random):
+        prob = rng.random()
+        value = self.gen_rand_value(rng)
+        return prob, value
+
+    def get_matrix(self, size, value):
+        return np.array([[1, 0, value], [0, 1, 0], [0, 0, 1]], dtype=np.float64)
 
-class TranslateX(Transform):
+
+class TranslateX(GeometricTransform):
     def __init__(self, config):
         super(TranslateX, self).__init__(config)
         self.apply_prob = config.apply_prob
         self.value_range = config.value_range
-        self.gen_rand_value = lambda: random.uniform(self.value_range[0], self.value_range[1])
+        self.gen_rand_value = lambda rng: rng.uniform(self.value_range[0], self.value_range[1])
 
-    def __call__(self, data, raw_input_idx):
-        prob = random.random()
-        value = self.gen_rand_value()
+    def __call__(self, data, raw_input_idx, rng=random):
+        prob, value = self.get_params(rng)
         augmented = []
         for i, img in enumerate(data):
             if prob < self.apply_prob:
@@ -101,17 +192,24 @@ class TranslateX(Transform):
                 augmented.append(img)
         return augmented
 
+    def get_params(self, rng=random):
+        prob = rng.random()
+        value = self.gen_rand_value(rng)
+        return prob, value
+
+    def get_matrix(self, size, value):
+        return np.array([[1, 0, value * size[0]], [0, 1, 0], [0, 0, 1]], dtype=np.float64)
 
-class TranslateY(Transform):
+
+class TranslateY(GeometricTransform):
     def __init__(self, config):
         super(TranslateY, self).__init__(config)
         self.apply_prob = config.apply_prob
         self.value_range = config.value_range
-        self.gen_rand_value = lambda: random.uniform(self.value_range[0], self.value_range[1])
+        self.gen_rand_value = lambda rng: rng.uniform(self.value_range[0], self.value_range[1])
 
-    def __call__(self, data, raw_input_idx):
-        prob = random.random()
-        value = self.gen_rand_value()
+    def __call__(self, data, raw_input_idx, rng=random):
+        prob, value = self.get_params(rng)
         augmented = []
         for i, img in enumerate(data):
             if prob < self.apply_prob:
@@ -121,166 +219,312 @@ class TranslateY(Transform):
                 augmented.append(img)
         return augmented
 
+    def get_params(self, rng=random):
+        prob = rng.random()
+        value = self.gen_rand_value(rng)
+        return prob, value
 
-class AutoContrast(Transform):
-    def __init__(self, config):
-        super(AutoContrast, self).__init__(config)
-        self.apply_all = config.apply_all[0]
-        self.apply_prob = config.apply_prob
+    def get_matrix(self, size, value):
+        return np.array([[1, 0, 0], [0, 1, value * size[0]], [0, 0, 1]], dtype=np.float64)
+
+
+class PointTransform(Transform):
+    """
+    Base class for photometric operations that map every pixel value independently, per channel.
+    Subclasses sample their parameters in get_params() and describe themselves with get_lut(), which lets
+    neighbouring point operations be compiled into a single lookup table, see PointOpGroup.
+    Operations whose table depends on the image content set needs_histogram.
+    """
+    needs_histogram = False
 
-    def __call__(self, data, raw_input_idx):
-        prob = random.random()
+    def __call__(self, data, raw_input_idx, rng=random):
+        prob, value = self.get_params(rng)
         augmented = []
         for i, img in enumerate(data):
             if (self.apply_all or i == raw_input_idx) and prob < self.apply_prob:
-                try:
-                    augmented.append(ImageOps.autocontrast(img))
-                except OSError:
-                    augmented.append(img)
+                augmented.append(self.apply_memoized(img, value) if self.deterministic else
+                                 self.apply_image(img, value))
             else:
                 augmented.append(img)
         return augmented
 
+    def get_params(self, rng=random):
+        """
+        Args:
+            rng (random.Random): Source of randomness.
+        Returns:
+            tuple: (prob, value), the apply probability roll and the sampled magnitude (None if not used).
+        """
+        raise RuntimeError("Illegal call to base class.")
+
+    def apply_image(self, img, value):
+        """
+        Apply the operation to a single Image, leaving it untouched if its mode is not supported.
+        """
+        raise RuntimeError("Illegal call to base class.")
+
+    def get_lut(self, histogram, value):
+        """
+        Args:
+            histogram (np.ndarray): Histogram of the input, one row of 256 bins per channel.
+            value (float): The sampled magnitude.
+        Returns:
+            np.ndarray: Lookup table of the same shape as histogram.
+        """
+        raise RuntimeError("Illegal call to base class.")
+
+    def apply_batch(self, batch, raw_input_idx, rngs=None, out=None):
+        params = [self.get_params(rng) for rng in get_rngs(rngs, len(batch[0]))]
+        augmented = []
+        for i, images in enumerate(batch):
+            applied = [[(self, value)] if (self.apply_all or i == raw_input_idx) and prob < self.apply_prob else []
+                       for prob, value in params]
+            augmented.append(apply_lut_batch(images, applied, get_out(out, i)))
+        return augmented
+
+
+class AutoContrast(PointTransform):
+    needs_histogram = True
+    deterministic = True
+
+    def __init__(self, config):
+        super(AutoContrast, self).__init__(config)
+        self.apply_all = config.apply_all[0]
+        self.apply_prob = config.apply_prob
+
+    def get_params(self, rng=random):
+        return rng.random(), None
+
+    def apply_image(self, img, value):
+        try:
+            return ImageOps.autocontrast(img)
+        except OSError:
+            return img
+
+    def get_lut(self, histogram, value):
+        # same as ImageOps.autocontrast with cutoff=0, stretch every channel to (0, 255)
+        lut = np.tile(np.arange(256), (len(histogram), 1))
+        for band, h in enumerate(histogram):
+            nonzero = np.flatnonzero(h)
+            if len(nonzero) == 0 or nonzero[-1] <= nonzero[0]:
+                continue
+            lo, hi = nonzero[0], nonzero[-1]
+            scale = 255.0 / (hi - lo)
+            lut[band] = np.clip((np.arange(256) * scale - lo * scale).astype(np.int64), 0, 255)
+        return lut
+
+
+class Invert(PointTransform):
+    deterministic = True
+    involution = True
 
-class Invert(Transform):
     def __init__(self, config):
         super(Invert, self).__init__(config)
         self.apply_all = config.apply_all[0]
         self.apply_prob = config.apply_prob
 
-    def __call__(self, data, raw_input_idx):
-        prob = random.random()
-        augmented = []
-        for i, img in enumerate(data):
-            if (self.apply_all or i == raw_input_idx) and prob < self.apply_prob:
-                try:
-                    augmented.append(ImageOps.invert(img))
-                except OSError:
-                    augmented.append(img)
-            else:
-                augmented.append(img)
-        return augmented
+    def get_params(self, rng=random):
+        return rng.random(), None
+
+    def apply_image(self, img, value):
+        try:
+            return ImageOps.invert(img)
+        except OSError:
+            return img
+
+    def get_lut(self, histogram, value):
+        return np.tile(255 - np.arange(256), (len(histogram), 1))
+
 
+class Equalize(PointTransform):
+    needs_histogram = True
+    deterministic = True
 
-class Equalize(Transform):
     def __init__(self, config):
         super(Equalize, self).__init__(config)
         self.apply_all = config.apply_all[0]
         self.apply_prob = config.apply_prob
 
-    def __call__(self, data, raw_input_idx):
-        prob = random.random()
-        augmented = []
-        for i, img in enumerate(data):
-            if (self.apply_all or i == raw_input_idx) and prob < self.apply_prob:
-                try:
-                    augmented.append(ImageOps.equalize(img))
-                except OSError:
-                    augmented.append(img)
-            else:
-                augmented.append(img)
-        return augmented
-
+    def get_params(self, rng=random):
+        return rng.random(), None
+
+    def apply_image(self, img, value):
+        try:
+            return ImageOps.equalize(img)
+        except OSError:
+            return img
+
+    def get_lut(self, histogram, value):
+        # same as ImageOps.equalize
+        lut = np.tile(np.arange(256), (len(histogram), 1))
+        for band, h in enumerate(histogram):
+            nonzero = h[h > 0]
+            if len(nonzero) <= 1:
+                continue
+            step = int(nonzero.sum() - nonzero[-1]) // 255
+            if not step:
+                continue
+            cumsum = np.concatenate(([0], np.cumsum(h[:-1], dtype=np.int64)))
+            lut[band] = np.minimum((step // 2 + cumsum) // step, 255)
+        return lut
+
+
+class Mirror(GeometricTransform):
+    deterministic = True
+    involution = True
 
-class Mirror(Transform):
     def __init__(self, config):
         super(Mirror, self).__init__(config)
         self.apply_prob = config.apply_prob
 
-    def __call__(self, data, raw_input_idx):
-        prob = random.random()
+    def __call__(self, data, raw_input_idx, rng=random):
+        prob, _ = self.get_params(rng)
         augmented = []
         for i, img in enumerate(data):
             if prob < self.apply_prob:
-                augmented.append(ImageOps.mirror(img))
+                augmented.append(self.apply_memoized(img, None))
             else:
                 augmented.append(img)
         return augmented
 
+    def get_params(self, rng=random):
+        return rng.random(), None
+
+    def apply_image(self, img, value):
+        return ImageOps.mirror(img)
+
+    def get_matrix(self, size, value):
+        return np.array([[-1, 0, size[0]], [0, 1, 0], [0, 0, 1]], dtype=np.float64)
+
+    def apply_batch(self, batch, raw_input_idx, rngs=None, out=None):
+        idx = [n for n, rng in enumerate(get_rngs(rngs, len(batch[0]))) if self.get_params(rng)[0] < self.apply_prob]
+        if not idx:
+            return batch
+        augmented = []
+        for i, images in enumerate(batch):
+            mirrored = get_output(images, get_out(out, i))
+            for n in range(len(images)):
+                mirrored[n] = images[n, :, ::-1] if n in idx else images[n]
+            augmented.append(mirrored)
+        return augmented
+
+
+class Flip(GeometricTransform):
+    deterministic = True
+    involution = True
 
-class Flip(Transform):
     def __init__(self, config):
         super(Flip, self).__init__(config)
         self.apply_prob = config.apply_prob
 
-    def __call__(self, data, raw_input_idx):
-        prob = random.random()
+    def __call__(self, data, raw_input_idx, rng=random):
+        prob, _ = self.get_params(rng)
         augmented = []
         for i, img in enumerate(data):
             if prob < self.apply_prob:
-                augmented.append(ImageOps.flip(img))
+                augmented.append(self.apply_memoized(img, None))
             else:
                 augmented.append(img)
         return augmented
 
+    def get_params(self, rng=random):
+        return rng.random(), None
+
+    def apply_image(self, img, value):
+        return ImageOps.flip(img)
+
+    def get_matrix(self, size, value):
+        return np.array([[1, 0, 0], [0, -1, size[1]], [0, 0, 1]], dtype=np.float64)
+
+    def apply_batch(self, batch, raw_input_idx, rngs=None, out=None):
+        idx = [n for n, rng in enumerate(get_rngs(rngs, len(batch[0]))) if self.get_params(rng)[0] < self.apply_prob]
+        if not idx:
+            return batch
+        augmented = []
+        for i, images in enumerate(batch):
+            flipped = get_output(images, get_out(out, i))
+            for n in range(len(images)):
+                flipped[n] = images[n, ::-1] if n in idx else images[n]
+            augmented.append(flipped)
+        return augmented
+
 
-class Solarize(Transform):
+class Solarize(PointTransform):
     def __init__(self, config):
         super(Solarize, self).__init__(config)
         self.apply_prob = config.apply_prob
         self.apply_all = config.apply_all[0]
         self.value_range = config.value_range
-        self.gen_rand_value = lambda: random.uniform(self.value_range[0], self.value_range[1])
+        self.gen_rand_value = lambda rng: rng.uniform(self.value_range[0], self.value_range[1])
 
-    def __call__(self, data, raw_input_idx):
-        prob = random.random()
-        value = self.gen_rand_value()
-        augmented = []
-        for i, img in enumerate(data):
-            if (self.apply_all or i == raw_input_idx) and prob < self.apply_prob:
-                try:
-                    augmented.append(ImageOps.solarize(img, value))
-                except OSError:
-                    augmented.append(img)
-            else:
-                augmented.append(img)
-        return augmented
+    def get_params(self, rng=random):
+        prob = rng.random()
+        value = self.gen_rand_value(rng)
+        return prob, value
+
+    def apply_image(self, img, value):
+        try:
+            return ImageOps.solarize(img, value)
+        except OSError:
+            return img
+
+    def get_lut(self, histogram, value):
+        levels = np.arange(256)
+        return np.tile(np.where(levels < value, levels, 255 - levels), (len(histogram), 1))
 
 
-class Posterize(Transform):
+class Posterize(PointTransform):
     def __init__(self, config):
         super(Posterize, self).__init__(config)
         self.apply_prob = config.apply_prob
         self.apply_all = config.apply_all[0]
         self.value_range = config.value_range
-        self.gen_rand_value = lambda: random.randint(self.value_range[0], self.value_range[1])
+        self.gen_rand_value = lambda rng: rng.randint(self.value_range[0], self.value_range[1])
+
+    def get_params(self, rng=random):
+        prob = rng.random()
+        value = self.gen_rand_value(rng)
+        return prob, value
+
+    def apply_image(self, img, value):
+        try:
+            return ImageOps.posterize(img, value)
+        except OSError:
+            return img
+
+    def get_lut(self, histogram, value):
+        mask = ~(2 ** (8 - value) - 1)
+        return np.tile(np.arange(256) & mask, (len(histogram), 1))
 
-    def __call__(self, data, raw_input_idx):
-        prob = random.random()
-        value = self.gen_rand_value()
-        augmented = []
-        for i, img in enumerate(data):
-            if (self.apply_all or i == raw_input_idx) and prob < self.apply_prob:
-                try:
-                    augmented.append(ImageOps.posterize(img, value))
-                except OSError:
-                    augmented.append(img)
-            else:
-                augmented.append(img)
-        return augmented
 
+class Contrast(PointTransform):
+    needs_histogram = True
 
-class Contrast(Transform):
     def __init__(self, config):
         super(Contrast, self).__init__(config)
         self.apply_prob = config.apply_prob
         self.apply_all = config.apply_all[0]
         self.value_range = config.value_range
-        self.gen_rand_value = lambda: random.uniform(self.value_range[0], self.value_range[1])
+        self.gen_rand_value = lambda rng: rng.uniform(self.value_range[0], self.value_range[1])
 
-    def __call__(self, data, raw_input_idx):
-        prob = random.random()
-        value = self.gen_rand_value()
-        augmented = []
-        for i, img in enumerate(data):
-            if (self.apply_all or i == raw_input_idx) and prob < self.apply_prob:
-                try:
-                    augmented.append(ImageEnhance.Contrast(img).enhance(value))
-                except OSError and ValueError:
-                    augmented.append(img)
-            else:
-                augmented.append(img)
-        return augmented
+    def get_params(self, rng=random):
+        prob = rng.random()
+        value = self.gen_rand_value(rng)
+        return prob, value
+
+    def apply_image(self, img, value):
+        try:
+            return ImageEnhance.Contrast(img).enhance(value)
+        except OSError and ValueError:
+            return img
+
+    def get_lut(self, histogram, value):
+        # ImageEnhance.Contrast blends with the mean of the grayscale image, estimated here from the channel means
+        means = (histogram * np.arange(256)).sum(axis=1) / np.maximum(histogram.sum(axis=1), 1)
+        gray_mean = means[0] if len(histogram) == 1 else np.dot(means[:3], (0.299, 0.587, 0.114))
+        gray_mean = int(gray_mean + 0.5)
+        levels = gray_mean + np.float32(value) * (np.arange(256, dtype=np.float32) - gray_mean)
+        return np.tile(np.clip(levels, 0, 255).astype(np.int64), (len(histogram), 1))
 
 
 class Color(Transform):
@@ -289,11 +533,10 @@ class Color(Transform):
         self.apply_prob = config.apply_prob
         self.apply_all = config.apply_all[0]
         self.value_range = config.value_range
-        self.gen_rand_value = lambda: random.uniform(self.value_range[0], self.value_range[1])
+        self.gen_rand_value = lambda rng: rng.uniform(self.value_range[0], self.value_range[1])
 
-    def __call__(self, data, raw_input_idx):
-        prob = random.random()
-        value = self.gen_rand_value()
+    def __call__(self, data, raw_input_idx, rng=random):
+        prob, value = self.get_params(rng)
         augmented = []
         for i, img in enumerate(data):
             if (self.apply_all or i == raw_input_idx) and prob < self.apply_prob:
@@ -305,28 +548,58 @@ class Color(Transform):
                 augmented.append(img)
         return augmented
 
+    def get_params(self, rng=random):
+        prob = rng.random()
+        value = self.gen_rand_value(rng)
+        return prob, value
+
+    def apply_batch(self, batch, raw_input_idx, rngs=None, out=None):
+        params = [self.get_params(rng) for rng in get_rngs(rngs, len(batch[0]))]
+        idx = [n for n, (prob, _) in enumerate(params) if prob < self.apply_prob]
+        augmented = []
+        for i, images in enumerate(batch):
+            if not idx or not (self.apply_all or i == raw_input_idx) or images.shape[3] != 3 or \
+                    images.dtype != np.uint8:
+                augmented.append(images)
+                continue
+            # blend with the grayscale image, same fixed point weights as Image.convert('L')
+            blended = get_output(images, get_out(out, i), copy=True)
+            for n in idx:
+                blended[n] = self.blend(images[n], params[n][1])
+            augmented.append(blended)
+        return augmented
+
+    @staticmethod
+    def blend(image, value):
+        """Blend an (H, W, 3) uint8 array or any region of it with its grayscale version, pixel by pixel."""
+        rgb = image.astype(np.uint32)
+        gray = ((rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16)[..., None]
+        gray = gray.astype(np.float32)
+        return np.clip(gray + np.float32(value) * (image - gray), 0, 255)
+
 
-class Brightness(Transform):
+class Brightness(PointTransform):
     def __init__(self, config):
         super(Brightness, self).__init__(config)
         self.apply_prob = config.apply_prob
         self.apply_all = config.apply_all[0]
         self.value_range = config.value_range
-        self.gen_rand_value = lambda: random.uniform(self.value_range[0], self.value_range[1])
+        self.gen_rand_value = lambda rng: rng.uniform(self.value_range[0], self.value_range[1])
 
-    def __call__(self, data, raw_input_idx):
-        prob = random.random()
-        value = self.gen_rand_value()
-        augmented = []
-        for i, img in enumerate(data):
-            if (self.apply_all or i == raw_input_idx) and prob < self.apply_prob:
-                try:
-                    augmented.append(ImageEnhance.Brightness(img).enhance(value))
-                except OSError and ValueError:
-                    augmented.append(img)
-            else:
-                augmented.append(img)
-        return augmented
+    def get_params(self, rng=random):
+        prob = rng.random()
+        value = self.gen_rand_value(rng)
+        return prob, value
+
+    def apply_image(self, img, value):
+        try:
+            return ImageEnhance.Brightness(img).enhance(value)
+        except OSError and ValueError:
+            return img
+
+    def get_lut(self, histogram, value):
+        levels = np.float32(value) * np.arange(256, dtype=np.float32)
+        return np.tile(np.clip(levels, 0, 255).astype(np.int64), (len(histogram), 1))
 
 
 class Sharpness(Transform):
@@ -335,11 +608,10 @@ class Sharpness(Transform):
         self.apply_prob = config.apply_prob
         self.apply_all = config.apply_all[0]
         self.value_range = config.value_range
-        self.gen_rand_value = lambda: random.uniform(self.value_range[0], self.value_range[1])
+        self.gen_rand_value = lambda rng: rng.uniform(self.value_range[0], self.value_range[1])
 
-    def __call__(self, data, raw_input_idx):
-        prob = random.random()
-        value = self.gen_rand_value()
+    def __call__(self, data, raw_input_idx, rng=random):
+        prob, value = self.get_params(rng)
         augmented = []
         for i, img in enumerate(data):
             if (self.apply_all or i == raw_input_idx) and prob < self.apply_prob:
@@ -351,6 +623,42 @@ class Sharpness(Transform):
                 augmented.append(img)
         return augmented
 
+    def get_params(self, rng=random):
+        prob = rng.random()
+        value = self.gen_rand_value(rng)
+        return prob, value
+
+    def apply_batch(self, batch, raw_input_idx, rngs=None, out=None):
+        params = [self.get_params(rng) for rng in get_rngs(rngs, len(batch[0]))]
+        idx = [n for n, (prob, _) in enumerate(params) if prob < self.apply_prob]
+        augmented = []
+        for i, images in enumerate(batch):
+            if not idx or not (self.apply_all or i == raw_input_idx) or images.dtype != np.uint8:
+                augmented.append(images)
+                continue
+            # blend with ImageFilter.SMOOTH, a 3x3 kernel of ones with 5 in the center, borders left untouched
+            sharpened = get_output(images, get_out(out, i), copy=True)
+            for n in idx:
+                sharpened[n] = self.sharpen(images[n], params[n][1])
+            augmented.append(sharpened)
+        return augmented
+
+    @staticmethod
+    def sharpen(image, value):
+        """
+        Sharpen an (H, W, C) uint8 array, its border is left untouched. On a region of the image with a one pixel
+        margin, the values inside the margin are the same as on the whole image.
+        """
+        height, width = image.shape[:2]
+        image = image.astype(np.uint16)
+        window_sum = 4 * image[1:-1, 1:-1]
+        for dy in range(3):
+            for dx in range(3):
+                window_sum += image[dy:dy + height - 2, dx:dx + width - 2]
+        smoothed = image.astype(np.float32)
+        smoothed[1:-1, 1:-1] = (window_sum + 6) // 13
+        return np.clip(smoothed + np.float32(value) * (image - smoothed), 0, 255)
+
 
 class RandomResizedCrop(Transform):
     def __init__(self, config):
@@ -358,7 +666,7 @@ class RandomResizedCrop(Transform):
         self.scale = config.scale
         self.padding_mode = config.padding_mode
 
-    def __call__(self, data, raw_input_idx):
+    def __call__(self, data, raw_input_idx, rng=random):
         if len(data) == 0:
             return data
         if not isinstance(data[0], Image.Image):
@@ -366,39 +674,147 @@ class RandomResizedCrop(Transform):
 
         augmented = []
         width, height = data[0].size
-
-        resized_height, resized_width = self.get_resize_params((height, width), self.scale)
-        pad_left, pad_top, pad_right, pad_bottom = self.get_pad_params(
-            (height, width), (resized_height, resized_width), ratio=0.2)
-        left, top, right, bottom = self.get_crop_params(
-            (resized_height + pad_top + pad_bottom, resized_width + pad_left + pad_right), (height, width))
+        (resized_height, resized_width), (pad_left, pad_top), (left, top, right, bottom) = \
+            self.get_params((height, width), rng)
 
         for i, img in enumerate(data):
             if (width, height) != img.size:
                 raise ValueError("Images are not in same size.")
-            # resize
-            img = img.resize((resized_width, resized_height))
-            # padding
-            img = self.pad(img, (pad_left, pad_top, pad_right, pad_bottom), self.padding_mode)
-            # cropping
-            img = img.crop((left, top, right, bottom))
-
+            img = self.resized_crop(img, (resized_height, resized_width), (pad_left, pad_top),
+                                    (left, top, right, bottom))
             augmented.append(img)
 
         return augmented
 
-    def get_resize_params(self, image_size, scale=(0.8, 1.2)):
+    def get_params(self, image_size, rng=random):
+        """Sample the resize, padding and crop parameters for one instance.
+        Args:
+            image_size tuple (int, int): Image size of (height, width).
+            rng (random.Random): Source of randomness.
+        Returns:
+            tuple: (resized_height, resized_width), (pad_left, pad_top) and (left, top, right, bottom).
+        """
+        height, width = image_size
+        resized_height, resized_width = self.get_resize_params((height, width), self.scale, rng)
+        pad_left, pad_top, pad_right, pad_bottom = self.get_pad_params(
+            (height, width), (resized_height, resized_width), ratio=0.2)
+        crop_box = self.get_crop_params(
+            (resized_height + pad_top + pad_bottom, resized_width + pad_left + pad_right), (height, width), rng)
+        return (resized_height, resized_width), (pad_left, pad_top), crop_box
+
+    def apply_batch(self, batch, raw_input_idx, rngs=None, out=None):
+        """
+        Bilinear sampling through separable per instance index vectors, padding is resolved on the indices.
+        Unlike the bicubic Image.resize of the pil backend there is no antialiasing filter when downscaling, the
+        results differ from it by up to 125 levels on edges.
+        """
+        height, width = batch[0].shape[1:3]
+        params = [self.get_params((height, width), rng) for rng in get_rngs(rngs, len(batch[0]))]
+        rows = [self.get_sample_coords(height, resized[0], pad[1], box[1]) for resized, pad, box in params]
+        cols = [self.get_sample_coords(width, resized[1], pad[0], box[0]) for resized, pad, box in params]
+
+        augmented = []
+        for i, images in enumerate(batch):
+            resampled = get_output(images, get_out(out, i))
+            for n in range(len(images)):
+                resampled[n] = self.resample(images[n], rows[n], cols[n])
+            augmented.append(resampled)
+        return augmented
+
+    @staticmethod
+    def resample(image, rows, cols):
+        """
+        Bilinear sampling of an (H, W, C) array.
+        Args:
+            image (np.ndarray): The source, or the region of it the sample coordinates are relative to.
+            rows (tuple): Sample coordinates along the height, see get_sample_coords.
+            cols (tuple): Sample coordinates along the width.
+        Returns:
+            np.ndarray: The (len(rows), len(cols), C) samples, rounded and clipped to the range of image.dtype.
+        """
+        (y0, y1, wy, valid_y), (x0, x1, wx, valid_x) = rows, cols
+        # separable: interpolate whole rows first, then columns
+        wy, wx = wy[:, None, None], wx[None, :, None]
+        sampled_rows = image[y0] * (1 - wy) + image[y1] * wy
+        sampled = sampled_rows[:, x0] * (1 - wx) + sampled_rows[:, x1] * wx
+        if not valid_y.all() or not valid_x.all():
+            sampled *= (valid_y[:, None] & valid_x[None, :])[..., None]
+        return np.clip(sampled + 0.5, 0, np.iinfo(image.dtype).max)
+
+    def get_sample_coords(self, size, resized_size, pad_before, crop_start):
+        """Map the output pixels along one axis back to the source axis.
+        Args:
+            size (int): Source and output length along the axis.
+            resized_size (int): Resized length along the axis.
+            pad_before (int): Padding before the resized image on the canvas.
+            crop_start (int): Crop offset on the canvas.
+        Returns:
+            tuple: Lower and upper source indices, the bilinear weight of the upper one and the validity mask,
+                   which is False where constant padding is sampled.
+        """
+        resized = np.arange(size) + crop_start - pad_before
+        valid = np.ones(size, dtype=bool)
+        if self.padding_mode == 'constant':
+            valid = (resized >= 0) & (resized < resized_size)
+        elif self.padding_mode == 'edge':
+            resized = np.clip(resized, 0, resized_size - 1)
+        elif self.padding_mode == 'reflect':
+            resized = np.where(resized < 0, -resized, resized)
+            resized = np.where(resized >= resized_size, 2 * (resized_size - 1) - resized, resized)
+        elif self.padding_mode == 'symmetric':
+            resized = np.where(resized < 0, -resized - 1, resized)
+            resized = np.where(resized >= resized_size, 2 * resized_size - 1 - resized, resized)
+        else:
+            raise ValueError("Padding mode should be either constant, edge, reflect or symmetric")
+        coords = np.clip((resized + 0.5) * size / resized_size - 0.5, 0, size - 1)
+        lower = np.floor(coords).astype(np.intp)
+        upper = np.minimum(lower + 1, size - 1)
+        return lower, upper, (coords - lower).astype(np.float32), valid
+
+    def resized_crop(self, img, resized_image_size, pad_offset, crop_box):
+        """Resize, pad and crop in one pass.
+        The crop window is mapped back onto the source image and only the region it covers is resampled, the
+        resized and padded canvas is never built. Padding is filled in around the resampled region afterwards.
+        Args:
+            img (Image): Source image.
+            resized_image_size tuple (int, int): Resized image size of (height, width).
+            pad_offset tuple (int, int): Params (pad_left, pad_top) the resized image is shifted by on the canvas.
+            crop_box tuple (int, int, int, int): Params (left, top, right, bottom) of the crop on the canvas.
+        Returns:
+            Image: The cropped image, same as resizing, padding and cropping the full image.
+        """
+        resized_height, resized_width = resized_image_size
+        pad_left, pad_top = pad_offset
+        left, top, right, bottom = crop_box
+        # crop window in resized image coordinates, clipped to the resized image
+        x0, y0 = max(left - pad_left, 0), max(top - pad_top, 0)
+        x1, y1 = min(right - pad_left, resized_width), min(bottom - pad_top, resized_height)
+        scale_x, scale_y = img.width / resized_width, img.height / resized_height
+        region = img.resize((x1 - x0, y1 - y0), box=(x0 * scale_x, y0 * scale_y, x1 * scale_x, y1 * scale_y))
+
+        border = (x0 - (left - pad_left), y0 - (top - pad_top), right - pad_left - x1, bottom - pad_top - y1)
+        if not any(border):
+            return region
+        if self.padding_mode == 'constant':
+            canvas = Image.new(region.mode, (right - left, bottom - top))
+            canvas.paste(region, border[:2])
+            return canvas
+        # the region touches every border it is padded on, so padding it equals padding the full resized image
+        return self.pad(region, border, self.padding_mode)
+
+    def get_resize_params(self, image_size, scale=(0.8, 1.2), rng=random):
         """Get resized image size.
         Args:
             image_size tuple (int, int): Image size of (height, width).
             scale tuple (float, float): (min, max) of resize ratio.
+            rng (random.Random): Source of randomness.
         Returns:
             tuple: Output image size of (height, width).
         """
         if self.scale[0] > self.scale[1]:
             raise ValueError("Scale ratio should be of kind (min, max)")
 
-        ratio = random.randint(int(100 * scale[0]), int(100 * scale[1])) / 100.0
+        ratio = rng.randint(int(100 * scale[0]), int(100 * scale[1])) / 100.0
         height, width = image_size
         new_height = int(ratio * height)
         new_width = int(ratio * width)
@@ -425,11 +841,12 @@ class RandomResizedCrop(Transform):
             pad_w = int((width * (1 + ratio) - resized_width) / 2)
         return pad_w, pad_h, pad_w, pad_h
 
-    def get_crop_params(self, input_size, output_size):
+    def get_crop_params(self, input_size, output_size, rng=random):
         """Get parameters for a random crop.
         Args:
             input_size tuple (int, int): Input image size of (height, width).
             output_size tuple (int, int): Output image size of (height, width).
+            rng (random.Random): Source of randomness.
         Returns:
             tuple: Params (left, top, right, bottom) for random crop.
         """
@@ -442,8 +859,8 @@ class RandomResizedCrop(Transform):
         if w_in == w_out and h_in == h_out:
             return 0, 0, h_in, w_in
 
-        top = random.randint(0, h_in - h_out)
-        left = random.randint(0, w_in - w_out)
+        top = rng.randint(0, h_in - h_out)
+        left = rng.randint(0, w_in - w_out)
         return left, top, left + w_out, top + h_out
 
     def pad(self, img, pad_size, padding_mode="constant"):
@@ -463,6 +880,302 @@ class RandomResizedCrop(Transform):
         return Image.fromarray(img)
 
 
+class AffineGroup(Transform):
+    """
+    A run of neighbouring geometric transforms fused into a single affine warp.
+    The parameters of every member are sampled in pipeline order, their matrices are composed and each image
+    is resampled once with Image.transform, instead of once per applied member. Apart from the removed
+    intermediate rounding, the only difference to the sequential pipeline is that content pushed out of the frame
+    by one member and brought back by a later one is kept instead of filled black.
+
+    Args:
+        transforms (list): List of GeometricTransform, in pipeline order.
+    """
+    def __init__(self, transforms):
+        super(AffineGroup, self).__init__(Dict(type='AffineGroup', transforms=[t.config for t in transforms]))
+        self.transforms = transforms
+
+    def __call__(self, data, raw_input_idx, rng=random):
+        applied = []
+        for trans_op in self.transforms:
+            prob, value = trans_op.get_params(rng)
+            if prob < trans_op.apply_prob:
+                applied.append((trans_op, value))
+        if len(applied) == 0:
+            return list(data)
+
+        coeffs = {}
+        augmented = []
+        for img in data:
+            if img.size not in coeffs:
+                coeffs[img.size] = self.get_coeffs(img.size, applied)
+            augmented.append(img.transform(img.size, Image.AFFINE, coeffs[img.size]))
+        return augmented
+
+    def apply_batch(self, batch, raw_input_idx, rngs=None, out=None):
+        applied = []
+        for rng in get_rngs(rngs, len(batch[0])):
+            params = [(trans_op, trans_op.get_params(rng)) for trans_op in self.transforms]
+            applied.append([(trans_op, value) for trans_op, (prob, value) in params if prob < trans_op.apply_prob])
+        idx = [n for n in range(len(applied)) if applied[n]]
+        return warp_affine_batch(batch, idx, lambda size, n: self.get_matrix(size, applied[n]), out)
+
+    @staticmethod
+    def get_matrix(size, applied):
+        """Compose the inverse matrices of the applied transforms.
+        Args:
+            size tuple (int, int): Image size of (width, height).
+            applied (list): List of (GeometricTransform, value) in pipeline order.
+        Returns:
+            np.ndarray: The composed 3x3 inverse affine matrix.
+        """
+        # each matrix maps output coordinates back to its input, so the first op ends up leftmost
+        matrix = np.eye(3)
+        for trans_op, value in applied:
+            matrix = matrix @ trans_op.get_matrix(size, value)
+        return matrix
+
+    @staticmethod
+    def get_coeffs(size, applied):
+        """Compose the inverse matrices of the applied transforms.
+        Args:
+            size tuple (int, int): Image size of (width, height).
+            applied (list): List of (GeometricTransform, value) in pipeline order.
+        Returns:
+            tuple: The (a, b, c, d, e, f) affine data expected by Image.transform.
+        """
+        return tuple(AffineGroup.get_matrix(size, applied)[:2].flatten())
+
+
+class PointOpGroup(Transform):
+    """
+    A run of neighbouring point operations compiled into a single lookup table per channel.
+    The parameters of every member are sampled in pipeline order. For each image the histogram is computed once,
+    data dependent members (AutoContrast, Equalize, Contrast) derive their table from that histogram pushed through
+    the tables of the members before them, and the composed table is applied with a single Image.point.
+
+    Args:
+        transforms (list): List of PointTransform, in pipeline order.
+    """
+    supported_modes = ('L', 'RGB')
+
+    def __init__(self, transforms):
+        super(PointOpGroup, self).__init__(Dict(type='PointOpGroup', transforms=[t.config for t in transforms]))
+        self.transforms = transforms
+
+    def __call__(self, data, raw_input_idx, rng=random):
+        params = [trans_op.get_params(rng) for trans_op in self.transforms]
+        augmented = []
+        for i, img in enumerate(data):
+            applied = [(trans_op, value) for trans_op, (prob, value) in zip(self.transforms, params)
+                       if (trans_op.apply_all or i == raw_input_idx) and prob < trans_op.apply_prob]
+            if len(applied) == 0:
+                augmented.append(img)
+            elif img.mode not in self.supported_modes:
+                for trans_op, value in applied:
+                    img = trans_op.apply_image(img, value)
+                augmented.append(img)
+            else:
+                histogram = np.array(img.histogram(), dtype=np.int64).reshape(-1, 256)
+                augmented.append(img.point(self.get_lut(histogram, applied).flatten().tolist()))
+        return augmented
+
+    def apply_batch(self, batch, raw_input_idx, rngs=None, out=None):
+        params = [[trans_op.get_params(rng) for trans_op in self.transforms] for rng in get_rngs(rngs, len(batch[0]))]
+        augmented = []
+        for i, images in enumerate(batch):
+            applied = [[(trans_op, value) for trans_op, (prob, value) in zip(self.transforms, instance_params)
+                        if (trans_op.apply_all or i == raw_input_idx) and prob < trans_op.apply_prob]
+                       for instance_params in params]
+            augmented.append(apply_lut_batch(images, applied, get_out(out, i)))
+        return augmented
+
+    @staticmethod
+    def get_lut(source_histogram, applied):
+        """Compose the lookup tables of the applied transforms.
+        Args:
+            source_histogram (np.ndarray): Histogram of the input image, one row of 256 bins per channel.
+            applied (list): List of (PointTransform, value) in pipeline order.
+        Returns:
+            np.ndarray: The composed lookup table, one row of 256 entries per channel.
+        """
+        lut = np.tile(np.arange(256), (len(source_histogram), 1))
+        for trans_op, value in applied:
+            # histogram of the intermediate image, as if every previous member had been applied
+            histogram = np.stack([np.bincount(band_lut, weights=band_histogram, minlength=256).astype(np.int64)
+                                  for band_lut, band_histogram in zip(lut, source_histogram)])
+            op_lut = trans_op.get_lut(histogram, value)
+            lut = np.stack([band_op_lut[band_lut] for band_op_lut, band_lut in zip(op_lut, lut)])
+        return lut
+
+
+def get_rngs(rngs, batch_size):
+    """The per instance sources of randomness of a batch, the global random module for all when not given."""
+    return rngs if rngs is not None else [random] * batch_size
+
+
+def get_out(out, i):
+    """The preallocated output array of source i, None when there are none."""
+    return out[i] if out is not None else None
+
+
+def get_output(images, out=None, copy=False):
+    """
+    The array a kernel writes its result for one source into.
+    Args:
+        images (np.ndarray): The (N, H, W, C) input array.
+        out (np.ndarray): Optional preallocated array shaped like images.
+        copy (bool): Whether the result must start as a copy of images, for kernels that only modify some instances.
+    Returns:
+        np.ndarray: out, or a new array when not given.
+    """
+    if out is None:
+        return images.copy() if copy else np.empty_like(images)
+    if copy:
+        np.copyto(out, images)
+    return out
+
+
+@functools.lru_cache(maxsize=8)
+def get_coordinate_grid(height, width):
+    """Pixel center coordinates of a (height, width) image, as a (1, width) and a (height, 1) float32 array."""
+    return np.arange(width, dtype=np.float32)[None, :] + 0.5, np.arange(height, dtype=np.float32)[:, None] + 0.5
+
+
+def get_shift(matrix):
+    """The (dx, dy) integer translation, source minus output position, of a translation-only warp, None otherwise."""
+    (a, b, c), (d, e, f) = matrix[:2]
+    if a == 1 and b == 0 and d == 0 and e == 1:
+        return int(math.floor(0.5 + c)), int(math.floor(0.5 + f))
+    return None
+
+
+def get_source_coords(matrix, xs, ys):
+    """
+    Nearest neighbour source pixel of output pixel centers, same sampling as Image.transform.
+    Args:
+        matrix (np.ndarray): 3x3 inverse affine matrix.
+        xs (np.ndarray): (1, W) float32 pixel center x coordinates, see get_coordinate_grid.
+        ys (np.ndarray): (H, 1) float32 pixel center y coordinates.
+    Returns:
+        tuple: (src_x, src_y), (H, W) int32 arrays, possibly outside the source.
+    """
+    (a, b, c), (d, e, f) = matrix[:2]
+    src_x = np.floor(np.float32(a) * xs + np.float32(b) * ys + np.float32(c)).astype(np.int32)
+    src_y = np.floor(np.float32(d) * xs + np.float32(e) * ys + np.float32(f)).astype(np.int32)
+    return src_x, src_y
+
+
+def get_warp_index(height, width, matrix):
+    """Nearest neighbour sampling positions of an affine warp, same sampling as Image.transform.
+    Args:
+        height (int): Image height.
+        width (int): Image width.
+        matrix (np.ndarray): 3x3 inverse affine matrix.
+    Returns:
+        tuple: Either ('shift', (dx, dy)) when the warp is an integer translation, or ('take', (index, outside)) with
+               the flat source index of every output pixel and the mask of the pixels sampled outside the image.
+    """
+    shift = get_shift(matrix)
+    if shift is not None:
+        return 'shift', shift
+    src_x, src_y = get_source_coords(matrix, *get_coordinate_grid(height, width))
+    outside = (src_x < 0) | (src_x >= width) | (src_y < 0) | (src_y >= height)
+    index = np.where(outside, 0, src_y * width + src_x)
+    return 'take', (index.ravel(), outside)
+
+
+def warp_affine_batch(batch, idx, get_matrix, out=None):
+    """Affine warp of the selected instances. The sampling positions of an instance are computed once and shared
+    by all its sources of the same size.
+    Args:
+        batch (list): List of np.ndarray, one (N, H, W, C) uint8 array per source.
+        idx (list): Indices of the instances to warp, the others are passed through.
+        get_matrix (callable): get_matrix(size, n), the 3x3 inverse affine matrix of instance n for a (width, height)
+                   image.
+        out (list): Optional list of preallocated output arrays, one per source.
+    Returns:
+        list: List of np.ndarray, one (N, H, W, C) uint8 array per source.
+    """
+    if not idx:
+        return batch
+    augmented = [get_output(images, get_out(out, i), copy=True) for i, images in enumerate(batch)]
+    for n in idx:
+        warp_index = {}
+        for images, warped in zip(batch, augmented):
+            height, width, channels = images.shape[1:]
+            if (height, width) not in warp_index:
+                warp_index[(height, width)] = get_warp_index(height, width, get_matrix((width, height), n))
+            kind, index = warp_index[(height, width)]
+            if kind == 'shift':
+                dx, dy = index
+                warped[n] = 0
+                if abs(dx) < width and abs(dy) < height:
+                    warped[n, max(-dy, 0):height - max(dy, 0), max(-dx, 0):width - max(dx, 0)] = \
+                        images[n, max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)]
+            else:
+                flat_index, outside = index
+                pixels = images[n].reshape(-1, channels)
+                warped[n] = np.take(pixels, flat_index, axis=0).reshape(height, width, channels)
+                warped[n][outside] = 0
+    return augmented
+
+
+def apply_lut_batch(images, applied, out=None):
+    """Apply per instance compositions of point operations through one lookup table per instance and channel.
+    Like their PIL counterparts, point operations leave non 8-bit sources, e.g. 16-bit depth, untouched.
+    Args:
+        images (np.ndarray): (N, H, W, C) uint8 array.
+        applied (list): For every instance, the list of (PointTransform, value) to apply in order.
+        out (np.ndarray): Optional preallocated output array.
+    Returns:
+        np.ndarray: (N, H, W, C) uint8 array.
+    """
+    idx = [n for n in range(len(applied)) if applied[n]]
+    if not idx or images.dtype != np.uint8:
+        return images
+    augmented = get_output(images, out, copy=True)
+    channels = images.shape[3]
+    for n in idx:
+        if any(trans_op.needs_histogram for trans_op, _ in applied[n]):
+            histogram = np.stack([np.bincount(images[n, ..., c].ravel(), minlength=256) for c in range(channels)])
+        else:
+            histogram = np.zeros((channels, 256), dtype=np.int64)
+        lut = PointOpGroup.get_lut(histogram, applied[n]).astype(np.uint8)
+        if (lut == lut[0]).all():
+            augmented[n] = lut[0][images[n]]
+            continue
+        for c in range(channels):
+            augmented[n, ..., c] = lut[c][images[n, ..., c]]
+    return augmented
+
+
+def fuse_transforms(transform_pipeline, member_type, group_type):
+    """
+    Replace every run of at least two neighbouring transforms of member_type with one group_type.
+    Args:
+        transform_pipeline (list): List of Transform.
+        member_type (type): The Transform base class to fuse, e.g. GeometricTransform.
+        group_type (type): The group built from a run, e.g. AffineGroup.
+    Returns:
+        list: List of Transform.
+    """
+    fused = []
+    run = []
+    for trans_op in transform_pipeline + [None]:
+        if isinstance(trans_op, member_type):
+            run.append(trans_op)
+            continue
+        if len(run) > 1:
+            fused.append(group_type(run))
+        else:
+            fused.extend(run)
+        run = []
+        if trans_op is not None:
+            fused.append(trans_op)
+    return fused
+
+
 def build_transform(config):
     if not isinstance(config, Dict):
         raise TypeError(f'config must be a addict.Dict, but got {type(config)}')
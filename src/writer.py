@@ -0,0 +1,211 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs
+from os.path import join, splitext
+
+from encoders import get_codecs
+
+
+def get_output_dir(output_dir, src_name, img_name):
+    """The directory holding every epoch of one source image, output_dir/<src_name>-<img_name stem>."""
+    return join(output_dir, '{}-{}'.format(src_name, splitext(img_name)[0]))
+
+
+class OutputDedup:
+    """
+    References between identical outputs instead of new encodes, for the sources no transform modified in an epoch,
+    which is common for depth and normal maps. Only those unchanged outputs, see augmentor.get_modified, are hashed,
+    a digest of their codec and pixels, the modified ones are always encoded. A later unchanged output identical to
+    one written by the same process becomes a hardlink to that file, shard records instead point at the blob of the
+    first identical record written by the same ShardWriter. The digests are only kept in memory, nothing is added to
+    the output directory.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # the first file written by digest
+        self.paths = {}
+        # shard entries by digest
+        self.entries = {}
+        # source name to [written, referenced]
+        self.counts = {}
+
+    @staticmethod
+    def get_digest(img, codec_spec):
+        digest = hashlib.blake2b(f'{codec_spec}/{img.mode}/{img.size}'.encode(), digest_size=16)
+        digest.update(img.tobytes())
+        return digest.hexdigest()
+
+    def link(self, digest, path):
+        """Hardlink path to the file of an identical output, returns False if there is none yet."""
+        with self.lock:
+            target = self.paths.get(digest)
+        if target is None:
+            return False
+        try:
+            os.link(target, path)
+            return True
+        except FileNotFoundError:
+            # removed since, e.g. by hand during the run
+            return False
+
+    def publish(self, digest, path):
+        """Make a file just written the one identical outputs link to."""
+        with self.lock:
+            # written concurrently by another thread, either one will do
+            self.paths.setdefault(digest, path)
+
+    def count(self, src_name, referenced):
+        with self.lock:
+            counts = self.counts.setdefault(src_name, [0, 0])
+            counts[int(referenced)] += 1
+
+    def pop_counts(self):
+        """Return and clear the counts, used to ship worker counts to the main process."""
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def merge_counts(self, counts):
+        with self.lock:
+            for src_name, (written, referenced) in counts.items():
+                merged = self.counts.setdefault(src_name, [0, 0])
+                merged[0] += written
+                merged[1] += referenced
+
+    def summary(self):
+        with self.lock:
+            return 'Skipped identical outputs: ' + ', '.join(
+                f'{src_name} {referenced}/{written + referenced} ({referenced / max(written + referenced, 1):.1%})'
+                for src_name, (written, referenced) in self.counts.items())
+
+
+def write_output(path_stem, img, codec, profiler=None, dedup=None, modified=True):
+    """
+    Encode an image and write it to path_stem plus the codec extension.
+    Args:
+        path_stem (str): Output path without extension.
+        img (Image): The image to save.
+        codec (encoders.Codec): The codec of its source.
+        profiler (profiler.Profiler): Optional profiler, records an encode/<codec spec> stage with the bytes written.
+        dedup (OutputDedup): Optional, an unchanged output identical to an earlier one is hardlinked to it instead.
+        modified (bool): Whether a transform modified the image, only unchanged ones are deduplicated.
+    Returns:
+        bool: Whether the output is a hardlink to an identical output.
+    """
+    path = path_stem + codec.ext
+    try:
+        # never write through a hardlink, it would change every output sharing the file
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    digest = None
+    if dedup is not None and not modified:
+        digest = dedup.get_digest(img, codec.spec)
+        if dedup.link(digest, path):
+            return True
+    start = time.perf_counter()
+    content = codec.encode(img)
+    if profiler is not None:
+        profiler.record_stage('encode/' + codec.spec, time.perf_counter() - start, len(content))
+    with open(path, 'wb') as f:
+        f.write(content)
+    if digest is not None:
+        dedup.publish(digest, path)
+    return False
+
+
+class AsyncWriter:
+    """
+    Save augmented image groups on a pool of encoder threads, so that encoding overlaps the augmentation of
+    the next batch. The output layout is the same as augment.save_results.
+    Args:
+        src_names (list): List of source names, in source_dirs order.
+        output_dir (str): The output directory path.
+        threads (int): Number of encoder threads, 0 for none, save_group is then only called directly.
+        max_backlog (int): Maximum number of image groups queued or being encoded, submit() blocks beyond it.
+        profiler (profiler.Profiler): Optional profiler, records a save/<source> stage per image.
+        manifest (manifest.RunManifest): Optional run manifest, every image group is marked done once saved.
+        codecs (list): Optional list of encoders.Codec, one per source, see encoders.get_codecs for the default.
+        dedup (OutputDedup): Optional, unchanged outputs identical to earlier ones become references to them.
+    """
+    def __init__(self, src_names, output_dir, threads=4, max_backlog=16, profiler=None, manifest=None, codecs=None,
+                 dedup=None):
+        self.src_names = src_names
+        self.output_dir = output_dir
+        self.codecs = codecs or get_codecs({}, src_names)
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads else None
+        self.backlog = threading.BoundedSemaphore(max_backlog)
+        # image groups queued or being saved
+        self.queued = 0
+        self.lock = threading.Lock()
+        self.created_dirs = set()
+        self.errors = []
+        self.profiler = profiler
+        self.manifest = manifest
+        self.dedup = dedup
+        makedirs(output_dir, exist_ok=True)
+
+    def submit(self, img_names, data, epoch, modified=None):
+        """
+        Queue a batch for saving, same arguments as augment.save_results.
+        Args:
+            img_names (list): List of image names for this batch.
+            data (list): List of list. The inner list contains the different sources, Images, for one instance.
+            epoch (int): Augmentation epoch, used as the output file name.
+            modified (list): Optional list of list, whether a transform modified each source of each instance, see
+                  augmentor.get_modified. Every source counts as modified if not given.
+        """
+        self.raise_errors()
+        for n, (img_name, image_group) in enumerate(zip(img_names, data)):
+            self.backlog.acquire()
+            with self.lock:
+                self.queued += 1
+            future = self.executor.submit(self.save_group, img_name, image_group, epoch,
+                                          modified[n] if modified is not None else None)
+            future.add_done_callback(self.on_done)
+        return
+
+    def save_group(self, img_name, image_group, epoch, modified=None):
+        modified = modified or [True] * len(image_group)
+        for src_name, img, codec, is_modified in zip(self.src_names, image_group, self.codecs, modified):
+            start = time.perf_counter()
+            save_image_dir = get_output_dir(self.output_dir, src_name, img_name)
+            self.make_dir(save_image_dir)
+            referenced = write_output(join(save_image_dir, '{:04d}'.format(epoch)), img, codec, self.profiler,
+                                      self.dedup, is_modified)
+            if self.dedup is not None:
+                self.dedup.count(src_name, referenced)
+            if self.profiler is not None:
+                self.profiler.record_stage('save/' + src_name, time.perf_counter() - start)
+        if self.manifest is not None:
+            self.manifest.mark_done(img_name, epoch)
+
+    def make_dir(self, save_image_dir):
+        with self.lock:
+            if save_image_dir in self.created_dirs:
+                return
+            makedirs(save_image_dir, exist_ok=True)
+            self.created_dirs.add(save_image_dir)
+
+    def on_done(self, future):
+        self.backlog.release()
+        with self.lock:
+            self.queued -= 1
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+
+    def raise_errors(self):
+        with self.lock:
+            errors = list(self.errors)
+        if errors:
+            raise RuntimeError(f"Failed to save {len(errors)} image groups, first error: {errors[0]!r}") \
+                from errors[0]
+
+    def close(self):
+        """Wait for every queued image group to be written, then report any failure."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        self.raise_errors()
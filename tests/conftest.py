@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+from os.path import abspath, dirname, join
+import numpy as np
+import pytest
+from PIL import Image
+
+ROOT = dirname(dirname(abspath(__file__)))
+SRC_DIR = join(ROOT, 'src')
+CONFIG_PATH = join(ROOT, 'configs', 'synthetic_3d_config.py')
+sys.path.insert(0, SRC_DIR)
+
+from benchmark import generate_dataset  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def source_dirs(tmp_path_factory):
+    """A small synthetic rgb/depth/normal dataset shared by every test."""
+    return generate_dataset(str(tmp_path_factory.mktemp('data')), num_images=4, height=48, width=64)
+
+
+def run_augment(source_dirs, output_dir, *args, count=2, seed=7):
+    """Run augment.py on source_dirs in a child process, as a user would."""
+    command = [sys.executable, join(SRC_DIR, 'augment.py'), '--config', CONFIG_PATH, '--source-dirs', *source_dirs,
+               '--output-dir', str(output_dir), '--count', str(count), '--seed', str(seed), *args]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, cwd=ROOT)
+    return str(output_dir)
+
+
+def read_outputs(output_dir):
+    """The pixels of every output file under output_dir, by path relative to it."""
+    outputs = {}
+    for dir_path, _, file_names in os.walk(output_dir):
+        for file_name in file_names:
+            if file_name.endswith('.png'):
+                path = join(dir_path, file_name)
+                outputs[os.path.relpath(path, output_dir)] = np.asarray(Image.open(path))
+    return outputs
+
+
+def assert_same_outputs(outputs, expected):
+    assert sorted(outputs) == sorted(expected)
+    for path, array in expected.items():
+        np.testing.assert_array_equal(outputs[path], array, err_msg=path)
@@ -0,0 +1,30 @@
+import pytest
+
+from conftest import assert_same_outputs, read_outputs, run_augment
+from prepared import prepare
+
+
+@pytest.fixture(scope='module')
+def reference(source_dirs, tmp_path_factory):
+    """The outputs of a plain sequential pil run, every variant below must save the same pixels."""
+    return {pipeline: read_outputs(run_augment(source_dirs, tmp_path_factory.mktemp('reference'),
+                                               '--pipeline', pipeline))
+            for pipeline in ('default', 'RL_searched')}
+
+
+@pytest.mark.parametrize('pipeline', ['default', 'RL_searched'])
+@pytest.mark.parametrize('args', [['--workers', '2'], ['--workers', '2', '--batch-size', '3'],
+                                  ['--prefetch', '2', '--io-threads', '2', '--batch-size', '3']],
+                         ids=lambda args: ' '.join(args))
+def test_same_outputs(source_dirs, tmp_path, reference, pipeline, args):
+    outputs = read_outputs(run_augment(source_dirs, tmp_path, '--pipeline', pipeline, *args))
+    assert_same_outputs(outputs, reference[pipeline])
+
+
+@pytest.mark.parametrize('pipeline', ['default', 'RL_searched'])
+def test_prepared_store(source_dirs, tmp_path, reference, pipeline):
+    store_dir = str(tmp_path / 'store')
+    assert prepare(source_dirs, store_dir, threads=2) == 4
+    outputs = read_outputs(run_augment(source_dirs, tmp_path / 'outputs', '--pipeline', pipeline,
+                                       '--prepared-dir', store_dir))
+    assert_same_outputs(outputs, reference[pipeline])
@@ -0,0 +1,52 @@
+import json
+from os.path import join
+import numpy as np
+import pytest
+
+from conftest import assert_same_outputs, read_outputs, run_augment
+from recipes import RecipeRenderer
+from writer import get_output_dir
+
+
+def render_outputs(renderer):
+    """The pixels of every rendered variant, by the path augment.py saves it to."""
+    outputs = {}
+    for i, (img_name, epoch) in enumerate(renderer.keys()):
+        for src_name, img in zip(renderer.src_names, renderer.render(i)):
+            path = join(get_output_dir('', src_name, img_name), f'{epoch:04d}.png')
+            outputs[path] = np.asarray(img)
+    return outputs
+
+
+@pytest.mark.parametrize('backend', ['pil', 'numpy', 'tiled'])
+@pytest.mark.parametrize('pipeline', ['default', 'RL_searched'])
+def test_render_round_trip(source_dirs, tmp_path, backend, pipeline):
+    args = ['--backend', backend, '--pipeline', pipeline, '--tile-size', '32']
+    saved = read_outputs(run_augment(source_dirs, tmp_path / 'files', *args))
+    recipe_dir = run_augment(source_dirs, tmp_path / 'recipes', *args, '--output-format', 'recipes')
+    renderer = RecipeRenderer(join(recipe_dir, 'recipes.npz'), source_dirs)
+    assert_same_outputs(render_outputs(renderer), saved)
+
+
+def test_refuse_other_transforms(source_dirs, tmp_path):
+    recipe_dir = run_augment(source_dirs, tmp_path, '--output-format', 'recipes')
+    path = join(recipe_dir, 'recipes.npz')
+    with np.load(path) as recipes:
+        columns = dict(recipes)
+    meta = json.loads(columns['meta'].item())
+    meta['config']['default_pipeline'][0]['apply_prob'] = 0.123
+    columns['meta'] = np.array(json.dumps(meta))
+    np.savez(path, **columns)
+    with pytest.raises(ValueError):
+        RecipeRenderer(path, source_dirs)
+
+
+def test_refuse_recipes_without_parameter_names(source_dirs, tmp_path):
+    recipe_dir = run_augment(source_dirs, tmp_path, '--output-format', 'recipes')
+    path = join(recipe_dir, 'recipes.npz')
+    with np.load(path) as recipes:
+        columns = dict(recipes)
+    del columns['param']
+    np.savez(path, **columns)
+    with pytest.raises(ValueError, match='parameter names'):
+        RecipeRenderer(path, source_dirs)
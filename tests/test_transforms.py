@@ -0,0 +1,42 @@
+import random
+import numpy as np
+import pytest
+
+from benchmark import load_dataset
+from conftest import CONFIG_PATH
+from config import load_config
+from transform import PointOpGroup, PointTransform, build_transform
+
+
+def get_point_transforms(photo_distort_all, apply_prob=None):
+    """The point operations of the default pipeline, in pipeline order, with every apply_prob overridden if given."""
+    config = load_config(CONFIG_PATH, photo_distort_all)
+    transforms = []
+    for transform_config in config.default_pipeline:
+        transform_config = transform_config.copy()
+        if apply_prob is not None:
+            transform_config.apply_prob = apply_prob
+        trans_op = build_transform(transform_config)
+        if isinstance(trans_op, PointTransform):
+            transforms.append(trans_op)
+    return transforms
+
+
+@pytest.mark.parametrize('photo_distort_all', [False, True])
+@pytest.mark.parametrize('apply_prob', [None, 1.0])
+@pytest.mark.parametrize('order', ['pipeline', 'reversed'])
+def test_point_op_group(source_dirs, photo_distort_all, apply_prob, order):
+    """A PointOpGroup gives the same pixels as its members applied one after the other."""
+    transforms = get_point_transforms(photo_distort_all, apply_prob)
+    if order == 'reversed':
+        transforms = transforms[::-1]
+    group = PointOpGroup(transforms)
+    for n, image_group in enumerate(load_dataset(source_dirs)):
+        for seed in range(8):
+            expected = image_group
+            rng = random.Random(seed * 100 + n)
+            for trans_op in transforms:
+                expected = trans_op(expected, 0, rng)
+            augmented = group(image_group, 0, random.Random(seed * 100 + n))
+            for img, expected_img in zip(augmented, expected):
+                np.testing.assert_array_equal(np.asarray(img), np.asarray(expected_img))